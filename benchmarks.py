@@ -0,0 +1,691 @@
+"""
+Benchmarks for the calc toolchain.
+
+    python benchmarks.py                # run all of them
+    python benchmarks.py lazy_import    # run some by name
+"""
+import glob
+import importlib
+import marshal
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from textwrap import dedent
+
+import bundle
+import calcprofile
+import compile
+import completer
+import debugrepl
+import importhack
+import instrument
+import incremental
+import interp
+import linter
+import scope_analysis as scope_analysis_module
+import typeinfer
+import parse as parse_module
+from parse import parse, BinaryOp
+from tokens import Token, tokenize
+
+BENCHMARKS = {}
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+def timed(f, *args):
+    t0 = time.perf_counter()
+    result = f(*args)
+    return time.perf_counter() - t0, result
+
+def generated_module_source(i, n_functions=20):
+    """Some plausible calc module: a few globals and functions that use them"""
+    lines = [f'name = "module {i}";', f'offset = {i};']
+    for j in range(n_functions):
+        lines.append(f'f{j} = (x, y) =>')
+        lines.append(f'  z = offset;')
+        lines.append(f'  print(name);')
+        lines.append(f'  return z;')
+        lines.append(f'end;')
+    return '\n'.join(lines) + '\n'
+
+def write_module_tree(directory, n_modules, prefix='calcbench'):
+    names = []
+    for i in range(n_modules):
+        name = f'{prefix}{i}'
+        with open(os.path.join(directory, name + '.calc'), 'w') as f:
+            f.write(generated_module_source(i))
+        names.append(name)
+    return names
+
+def import_all(names):
+    return [importlib.import_module(name) for name in names]
+
+def forget_modules(names):
+    for name in names:
+        sys.modules.pop(name, None)
+
+@benchmark
+def lazy_import(n_modules=200, n_used=5):
+    """Eager vs lazy import of a tree of calc modules, of which only a few get used"""
+    orig_dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = False
+    with tempfile.TemporaryDirectory() as directory:
+        sys.path.insert(0, directory)
+        try:
+            names = write_module_tree(directory, n_modules)
+
+            importhack.shim()
+            cold, _ = timed(import_all, names)  # also writes the pycs
+            forget_modules(names)
+
+            importhack.shim()
+            eager, _ = timed(import_all, names)
+            forget_modules(names)
+
+            importhack.shim(lazy=True)
+            lazy, modules = timed(import_all, names)
+            use, _ = timed(lambda: [module.offset for module in modules[:n_used]])
+            forget_modules(names)
+        finally:
+            sys.path.remove(directory)
+            importhack.shim()
+            sys.dont_write_bytecode = orig_dont_write_bytecode
+
+    print(f'importing {n_modules} calc modules, then using {n_used} of them')
+    print(f'  cold (compiling):  {cold * 1000:8.2f}ms')
+    print(f'  eager (from pyc):  {eager * 1000:8.2f}ms')
+    print(f'  lazy (from pyc):   {lazy * 1000:8.2f}ms + {use * 1000:.2f}ms on first use')
+
+@benchmark
+def bundle_import(n_modules=200):
+    """Importing every module of a tree from per-module pycs vs from a single bundle"""
+    orig_dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = False
+    with tempfile.TemporaryDirectory() as directory:
+        sys.path.insert(0, directory)
+        try:
+            names = write_module_tree(directory, n_modules)
+            bundle_path = os.path.join(directory, 'app.bundle')
+            bundle.build_bundle(directory, bundle_path)
+
+            importhack.shim()
+            import_all(names)  # writes the pycs
+            forget_modules(names)
+            pycs, _ = timed(import_all, names)
+            forget_modules(names)
+
+            importhack.shim(bundles=[bundle_path])
+            bundled, _ = timed(import_all, names)
+            forget_modules(names)
+
+            importhack.shim(lazy=True, bundles=[bundle_path])
+            lazy_bundled, _ = timed(import_all, names)
+            forget_modules(names)
+        finally:
+            sys.path.remove(directory)
+            importhack.shim()
+            sys.dont_write_bytecode = orig_dont_write_bytecode
+
+    print(f'importing {n_modules} calc modules')
+    print(f'  from pycs:          {pycs * 1000:8.2f}ms')
+    print(f'  from bundle:        {bundled * 1000:8.2f}ms')
+    print(f'  lazy from bundle:   {lazy_bundled * 1000:8.2f}ms')
+
+class Counter:
+    def __init__(self):
+        self.total = 0
+
+    def add(self, n):
+        self.total += n
+
+@benchmark
+def method_calls(calls_per_function=100, repeats=10000):
+    """Calc code calling methods on a Python object, with and without LOAD_METHOD/CALL_METHOD"""
+    # calc loops don't compile yet, so the loop is unrolled
+    body = ''.join(f'  counter.add({i});\n' for i in range(calls_per_function))
+    source = f'f = (counter) =>\n{body}end;'
+
+    results = {}
+    orig = compile.METHOD_CALL_OPS
+    try:
+        for method_call_ops in sorted({False, orig}):
+            compile.METHOD_CALL_OPS = method_call_ops
+            f = compile.calc_source_to_python_module(source).f
+            counter = Counter()
+            results[method_call_ops], _ = timed(lambda: [f(counter) for _ in range(repeats)])
+    finally:
+        compile.METHOD_CALL_OPS = orig
+
+    print(f'{calls_per_function * repeats} method calls from compiled calc')
+    print(f'  LOAD_ATTR + CALL_FUNCTION:   {results[False] * 1000:8.2f}ms')
+    if True in results:
+        print(f'  LOAD_METHOD + CALL_METHOD:   {results[True] * 1000:8.2f}ms')
+
+class DictInstance:
+    """What an instance costs if it keeps its props in a dict of its own"""
+    def __init__(self, cls):
+        self.cls = cls
+        self.props = {}
+
+def measure_memory(f):
+    tracemalloc.start()
+    try:
+        result = f()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size, result
+
+def interpret(source):
+    builtin_scope = interp.Scope()
+    for name in interp.builtin_funcs:
+        builtin_scope.set(name, interp.builtin_funcs[name])
+    interp.execute_program(parse(tokenize(source)), builtin_scope.create_child_scope())
+
+@benchmark
+def hidden_classes(n_instances=1000000, iterations=20000):
+    """Memory for instances with shapes vs dicts, and interpreter prop access with and without inline caches"""
+    cls = interp.ClassObj('Point', interp.Scope())
+
+    def make_shaped():
+        instances = []
+        for i in range(n_instances):
+            instance = interp.Instance(cls)
+            instance.prop_assign('x', i)
+            instance.prop_assign('y', i)
+            instances.append(instance)
+        return instances
+
+    def make_dicts():
+        instances = []
+        for i in range(n_instances):
+            instance = DictInstance(cls)
+            instance.props['x'] = i
+            instance.props['y'] = i
+            instances.append(instance)
+        return instances
+
+    shaped_size, _ = measure_memory(make_shaped)
+    dict_size, _ = measure_memory(make_dicts)
+
+    source = dedent(f"""
+        class Base
+          getx = (this) => return this.x; end;
+        end;
+        class Point extends Base
+          init = (this, x, y) => this.x = x; this.y = y; end;
+        end;
+        p = Point();
+        p.init(1, 2);
+        total = 0;
+        i = 0;
+        while i < {iterations} do
+          total = total + p.x + p.y + p.getx();
+          p.y = i;
+          i = i + 1;
+        end;
+        """)
+    times = {}
+    orig = interp.PROP_CACHES
+    try:
+        for prop_caches in (False, True):
+            interp.PROP_CACHES = prop_caches
+            times[prop_caches], _ = timed(interpret, source)
+    finally:
+        interp.PROP_CACHES = orig
+
+    print(f'{n_instances} instances with two props')
+    print(f'  dict per instance:   {dict_size / 2**20:8.1f}MB')
+    print(f'  shapes + values:     {shaped_size / 2**20:8.1f}MB')
+    print(f'{iterations} interpreted loop iterations doing 3 prop loads, a method call and a prop store')
+    print(f'  uncached:            {times[False] * 1000:8.2f}ms')
+    print(f'  inline caches:       {times[True] * 1000:8.2f}ms')
+
+@benchmark
+def closure_memory(n_closures=20000):
+    """Memory kept alive by closures made in a loop, each in a call with a big local"""
+    source = dedent(f"""
+        make = (i) =>
+          big = string(i) + "{'x' * 1000}";
+          f = () => return i; end;
+          return f;
+        end;
+        closures = makelist();
+        i = 0;
+        while i < {n_closures} do
+          closures.append(make(i));
+          i = i + 1;
+        end;
+        """)
+    builtin_scope = interp.Scope()
+    for name in interp.builtin_funcs:
+        builtin_scope.set(name, interp.builtin_funcs[name])
+    builtin_scope.set('makelist', list)
+    variables = builtin_scope.create_child_scope()
+    size, _ = measure_memory(lambda: interp.execute_program(parse(tokenize(source)), variables))
+    print(f"{n_closures} closures, each made in a call with a 1KB local they do not use")
+    print(f'  retained:  {size / 2**20:8.1f}MB, {size / n_closures:.0f} bytes per closure')
+
+@benchmark
+def type_specialization(iterations=200000):
+    """Interpreting calls with and without the specializations type inference allows"""
+    source = dedent(f"""
+        square = (x) => return x * x; end;
+        total = 0;
+        i = 0;
+        while i < {iterations} do
+          total = total + square(i % 7) - 1;
+          i = i + 1;
+        end;
+        """)
+    stmts = parse(tokenize(source))
+    analyzer = interp.ScopeAnalyzer(assignments_rebind_outer=True)
+    analyzer.discover_symbols(stmts)
+    inference, _ = timed(typeinfer.infer_types, stmts, analyzer)
+
+    times = {}
+    orig = interp.TYPE_SPECIALIZATION
+    try:
+        for specialize in (False, True):
+            interp.TYPE_SPECIALIZATION = specialize
+            times[specialize], _ = timed(interpret, source)
+    finally:
+        interp.TYPE_SPECIALIZATION = orig
+
+    print(f'{iterations} interpreted loop iterations doing 5 arithmetic ops and a call')
+    print(f'  type inference:      {inference * 1000:8.2f}ms')
+    print(f'  generic:             {times[False] * 1000:8.2f}ms')
+    print(f'  specialized:         {times[True] * 1000:8.2f}ms')
+
+HELPERS = """
+    sq = (x) => return x * x; end;
+    hyp = (a, b) => s = sq(a) + sq(b); return s; end;
+    """
+
+@benchmark
+def inlining(iterations=100000, calls_per_function=50, repeats=10000):
+    """Call-heavy code with and without small helper functions inlined, interpreted and compiled"""
+    # in a function, because calls at module level are only inlined as expressions
+    source = dedent(HELPERS) + dedent(f"""
+        loop = (n) =>
+          i = 0;
+          total = 0;
+          while i < n do
+            h = hyp(i, 3);
+            total = total + h + sq(2);
+            i = i + 1;
+          end;
+          return total;
+        end;
+        total = loop({iterations});
+        """)
+    interpreted = {}
+    orig = interp.INLINING, interp.MEMOIZATION
+    try:
+        interp.MEMOIZATION = False  # sq would be memoized
+        for inline in (False, True):
+            interp.INLINING = inline
+            variables = interp.Scope().create_child_scope()
+            interpreted[inline], _ = timed(interp.execute_program, parse(tokenize(source)), variables, True)
+    finally:
+        interp.INLINING, interp.MEMOIZATION = orig
+
+    # calc loops don't compile yet, so the loop is unrolled
+    body = ''.join(f'  h = hyp(x, {i});\n  total = total + h + sq({i});\n' for i in range(calls_per_function))
+    source = dedent(HELPERS) + f'f = (x) =>\n  total = 0;\n{body}  return total;\nend;'
+    compiled = {}
+    orig = compile.INLINING, compile.MEMOIZATION
+    try:
+        compile.MEMOIZATION = False
+        for inline in (False, True):
+            compile.INLINING = inline
+            f = compile.calc_source_to_python_module(source).f
+            compiled[inline], _ = timed(lambda: [f(i) for i in range(repeats)])
+    finally:
+        compile.INLINING, compile.MEMOIZATION = orig
+
+    print(f'{iterations} interpreted loop iterations, each making 4 helper calls')
+    print(f'  calls:       {interpreted[False] * 1000:8.2f}ms')
+    print(f'  inlined:     {interpreted[True] * 1000:8.2f}ms')
+    print(f'{calls_per_function * 4 * repeats} helper calls from compiled calc')
+    print(f'  calls:       {compiled[False] * 1000:8.2f}ms')
+    print(f'  inlined:     {compiled[True] * 1000:8.2f}ms')
+
+@benchmark
+def memoization(interpreted_n=20, compiled_n=27):
+    """Naively recursive fib, with and without automatic memoization of pure functions"""
+    fib = 'fib = (n) => if n < 2 then return n; end; return fib(n - 1) + fib(n - 2); end;\n'
+    interpreted = {}
+    compiled = {}
+    orig = interp.MEMOIZATION, compile.MEMOIZATION
+    try:
+        for memoize in (False, True):
+            interp.MEMOIZATION = compile.MEMOIZATION = memoize
+            source = fib + f'x = fib({interpreted_n});'
+            interpreted[memoize], _ = timed(interp.execute_program, parse(tokenize(source)),
+                                            interp.Scope().create_child_scope(), True)
+            compiled[memoize], _ = timed(compile.calc_source_to_python_module, fib + f'x = fib({compiled_n});')
+    finally:
+        interp.MEMOIZATION, compile.MEMOIZATION = orig
+
+    print(f'interpreted fib({interpreted_n})')
+    print(f'  plain:       {interpreted[False] * 1000:8.2f}ms')
+    print(f'  memoized:    {interpreted[True] * 1000:8.2f}ms')
+    print(f'compiled fib({compiled_n}), including compiling it')
+    print(f'  plain:       {compiled[False] * 1000:8.2f}ms')
+    print(f'  memoized:    {compiled[True] * 1000:8.2f}ms')
+
+@benchmark
+def dead_functions(n_functions=300, n_used=5, repeats=20):
+    """Compiling and loading a generated library of which a program uses a few functions"""
+    source = generated_module_source(0, n_functions) + ''.join(f'f{j}(1, 2);\n' for j in range(n_used))
+    stmts = parse(tokenize(source))
+    sizes = {}
+    compile_times = {}
+    load_times = {}
+    for drop_dead in (False, True):
+        compile_times[drop_dead], code = timed(compile.calc_ast_to_python_code_object, stmts,
+                                               'lib.calc', '<module>', drop_dead)
+        data = marshal.dumps(code)
+        sizes[drop_dead] = len(data)
+        load_times[drop_dead], _ = timed(lambda: [marshal.loads(data) for _ in range(repeats)])
+
+    print(f'a module defining {n_functions} functions and calling {n_used}')
+    print(f'  all functions:   {sizes[False]:8} bytes, compiled in {compile_times[False] * 1000:.2f}ms, '
+          f'unmarshalled in {load_times[False] / repeats * 1000:.3f}ms')
+    print(f'  dead dropped:    {sizes[True]:8} bytes, compiled in {compile_times[True] * 1000:.2f}ms, '
+          f'unmarshalled in {load_times[True] / repeats * 1000:.3f}ms')
+
+def nested_functions_source(depth, stmts_per_level=5):
+    """Functions nested depth deep, each assigning locals and using a variable of the outermost one"""
+    lines = []
+    for i in range(depth):
+        lines.append(f'f{i} = (x{i}) =>')
+        for j in range(stmts_per_level):
+            lines.append(f'  v{j} = x{i} + x0 * {j};')
+    lines.append('  return x0;')
+    lines.extend(['  end;'] * depth)
+    return '\n'.join(lines)
+
+@benchmark
+def scope_analysis(depths=(50, 100, 200, 400), n_stmts=20000):
+    """Scope analysis of deeply nested functions, and one walk per scope vs one per kind of node"""
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))  # parsing recurses once per level
+    print('scope analysis of functions nested n deep')
+    for depth in depths:
+        stmts = parse(tokenize(nested_functions_source(depth)))
+        analysis, _ = timed(lambda: interp.ScopeAnalyzer().discover_symbols(stmts))
+        print(f'  n = {depth:4}: {analysis * 1000:8.2f}ms, {analysis / depth * 1e6:6.1f}us per level')
+
+    stmts = [stmt for i in range(n_stmts)
+             for stmt in parse(tokenize(f'a{i} = b{i} + f(c{i}, () => return 1; end);'))]
+    separate, _ = timed(lambda: [(scope_analysis_module.find_all_assigned_names(stmt),
+                                  scope_analysis_module.find_all_variable_lookups(stmt),
+                                  scope_analysis_module.find_all_nested_scopes(stmt))
+                                 for stmt in stmts])
+    single, _ = timed(scope_analysis_module.ScopeContents, stmts)
+    print(f'finding the assignments, lookups and nested scopes of {n_stmts} statements')
+    print(f'  three walks:   {separate * 1000:8.2f}ms')
+    print(f'  one walk:      {single * 1000:8.2f}ms')
+
+@benchmark
+def incremental_reanalysis(n_functions=2000, repeats=10):
+    """Re-analysing a 10K line module after single character edits, from scratch and incrementally"""
+    source = generated_module_source(0, n_functions)
+    n_lines = source.count('\n')
+    scratch, program = timed(incremental.IncrementalProgram, source)
+    middle = source.index(f'f{n_functions // 2} =')
+    body = source.index('z = offset', middle)
+    edits = {
+        'type in a function body': (body, body, 'z'),
+        'rename a function': (middle, middle + 1, 'g'),
+        'rebind a global used everywhere': (source.index('offset'), source.index('offset') + 1, 'O'),
+        'add a line': (body, body, '\n'),
+        'unmatch an end': (source.index('end;', middle), source.index('end;', middle) + 1, 'x'),
+    }
+    times = {}
+    for description, (start, end, text) in edits.items():
+        old = source[start:end]
+        t, _ = timed(lambda: [(program.edit(start, end, text), program.edit(start, start + len(text), old))
+                              for _ in range(repeats)])
+        times[description] = t / (2 * repeats)
+    edited = source.replace(f'f{n_functions // 2} =', f'g{n_functions // 2} =')
+    t, _ = timed(lambda: [(program.update(edited), program.update(source)) for _ in range(repeats)])
+    times['update with the whole buffer'] = t / (2 * repeats)
+    compiling, _ = timed(program.code)
+
+    print(f'a {n_lines} line module')
+    print(f'  from scratch:                      {scratch * 1000:8.2f}ms')
+    for description, t in times.items():
+        print(f'  {description + ":":34} {t * 1000:8.2f}ms')
+    print(f'  compiling it:                      {compiling * 1000:8.2f}ms')
+
+@benchmark
+def repl_paste(n_functions=1000):
+    """Deciding when pasted lines are complete statements in the debug REPL, and parsing them"""
+    lines = generated_module_source(0, n_functions).splitlines()
+
+    def speculative_parsing():
+        # what debug_repl used to do: try parsing the first line, then parse it all at the end
+        tokens = []
+        for line in lines:
+            if not tokens:
+                tokens = tokenize(line)
+                try:
+                    parse(tokens)
+                except Exception:
+                    continue
+                tokens = []
+            else:
+                tokens += tokenize(line)
+        return parse(tokens)
+
+    def tracking_depth():
+        stmts = []
+        pending = debugrepl.PendingInput()
+        for line in lines:
+            pending.add(tokenize(line))
+            if pending.complete:
+                statements, rest = incremental.split_statements(pending.tokens)
+                stmts.extend(stmt for stmt_tokens in statements for stmt in parse(stmt_tokens))
+                pending = debugrepl.PendingInput()
+        return stmts
+
+    speculative, _ = timed(speculative_parsing)
+    tracked, _ = timed(tracking_depth)
+    print(f'pasting {len(lines)} lines defining {n_functions} functions')
+    print(f'  speculative parsing:   {speculative * 1000:8.2f}ms')
+    print(f'  tracking block depth:  {tracked * 1000:8.2f}ms')
+
+@benchmark
+def tab_completion(n_variables=2000, n_modules=200, presses=5):
+    """TAB presses in the REPL with lots of variables and modules to complete"""
+    scope = interp.Scope()
+    for i in range(n_variables):
+        scope.bindings[f'value{i}'] = i
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(n_modules):
+            open(os.path.join(directory, f'module{i}.calc'), 'w').close()
+
+        def old_completer(text, state):
+            # the old completer, which also completed variables
+            modules = [os.path.basename(filename)[:-5]
+                       for filename in glob.glob(os.path.join(directory, '*.calc'))]
+            candidates = completer.words + modules + list(scope.bindings)
+            matches = [word for word in candidates if word.startswith(text)]
+            return matches[state] if state < len(matches) else None
+
+        def press_tab(complete, text):
+            # readline asks for matches until it gets None
+            state = 0
+            while complete(text, state) is not None:
+                state += 1
+            return state
+
+        times = {}
+        for name, complete in [('rebuilding every call', old_completer),
+                               ('prefix index', completer.Completer(scope, directory))]:
+            times[name], _ = timed(lambda: [press_tab(complete, prefix)
+                                            for _ in range(presses) for prefix in ('value1', 'module', 'e')])
+
+    print(f'{n_variables} variables and {n_modules} modules, {presses * 3} TAB presses')
+    for name, t in times.items():
+        print(f'  {name + ":":24} {t * 1000:8.2f}ms, {t / presses / 3 * 1000:.2f}ms per press')
+
+@benchmark
+def repl_compiled(iterations=50000):
+    """A loop typed at the REPL, interpreted and compiled"""
+    lines = ['total = 0;', 'i = 0;',
+             f'while i < {iterations} do total = total + i % 7; i = i + 1; end;']
+    statements = [tokenize(line) for line in lines]
+
+    def interpret():
+        variables = interp.Scope().create_child_scope()
+        for tokens in statements:
+            interp.execute_program(parse(tokens), variables)
+
+    compiled = debugrepl.CompiledStatements(interp.Scope().create_child_scope())
+    def run_compiled():
+        for tokens in statements:
+            compiled.run(*compiled.compile(tokens))
+
+    interpreted, _ = timed(interpret)
+    compiling, _ = timed(lambda: [compiled.compile(tokens) for tokens in statements])
+    cached, _ = timed(lambda: [compiled.compile(tokens) for tokens in statements])
+    running, _ = timed(run_compiled)
+    print(f'a loop of {iterations} iterations typed at the REPL')
+    print(f'  interpreted:                   {interpreted * 1000:8.2f}ms')
+    print(f'  compiled:                      {running * 1000:8.2f}ms')
+    print(f'  compiling it:                  {compiling * 1000:8.2f}ms, {cached * 1000:.3f}ms from the cache')
+
+def deep_expression(depth):
+    """1 + (1 + (1 + ...)), built without the parser, which recurses"""
+    one = tokenize('1')[0]
+    plus = tokenize('+')[0]
+    node = one
+    for _ in range(depth):
+        node = BinaryOp(one, plus, node)
+    return node
+
+@benchmark
+def ast_printing(depths=(250, 500, 1000, 2000), n_functions=1000):
+    """Formatting ASTs the way the debug REPL shows them"""
+    print('formatting an expression nested n deep')
+    for depth in depths:
+        node = deep_expression(depth)
+        t, _ = timed(parse_module.pformat_full_tree, node)
+        capped, _ = timed(parse_module.pformat_full_tree, node, 0, debugrepl.AST_MAX_DEPTH, debugrepl.AST_MAX_SIZE)
+        print(f'  n = {depth:5}: {t * 1000:8.2f}ms, {capped * 1000:.2f}ms as the REPL shows it')
+    stmts = [stmt for i in range(n_functions)
+             for stmt in parse(tokenize(generated_module_source(i, 1)))]
+    t, _ = timed(lambda: [parse_module.pformat_full_tree(stmt) for stmt in stmts])
+    print(f'formatting {len(stmts)} statements: {t * 1000:8.2f}ms')
+
+
+@benchmark
+def span_lookups(n_functions=1000):
+    """Looking up where each statement and expression of a module came from"""
+    stmts, spans = [], parse_module.SpanTable()
+    for i in range(n_functions):
+        stmts.extend(parse(tokenize(generated_module_source(i, 1)), spans))
+    nodes = []
+    todo = list(stmts)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, list):
+            todo.extend(node)
+        elif isinstance(node, tuple) and not isinstance(node, Token):
+            nodes.append(node)
+            todo.extend(node)
+    walked, _ = timed(lambda: [parse_module.find_span(node) for node in nodes])
+    looked_up, _ = timed(lambda: [parse_module.start_end(node, spans) for node in nodes])
+    print(f'spans of {len(nodes)} nodes: {walked * 1000:8.2f}ms walking their subtrees, '
+          f'{looked_up * 1000:.2f}ms from the table parse() filled in')
+
+
+@benchmark
+def lint_directory(n_modules=200, n_functions=200):
+    """Linting a tree of calc modules: one process, a pool, and from the cache"""
+    stmts = parse(tokenize(generated_module_source(0, n_functions)))
+    one_walk, _ = timed(linter.lint_statements, stmts)
+    walk_per_rule, _ = timed(lambda: [linter.lint_statements(stmts, rule_names=[name]) for name in linter.rules])
+    print(f'{len(linter.rules)} rules over {len(stmts)} statements: {one_walk * 1000:8.2f}ms in one walk, '
+          f'{walk_per_rule * 1000:.2f}ms walking once per rule')
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_module_tree(directory, n_modules)
+        cache_dir = os.path.join(directory, '.calclint')
+        serial, _ = timed(lambda: list(linter.lint_paths([directory], workers=1, cache_dir=None)))
+        pool, _ = timed(lambda: list(linter.lint_paths([directory], cache_dir=cache_dir)))
+        cached, results = timed(lambda: list(linter.lint_paths([directory], cache_dir=cache_dir)))
+        assert all(result.status == 'cached' for result in results)
+    print(f'linting {n_modules} calc modules')
+    print(f'  one process:       {serial * 1000:8.2f}ms')
+    print(f'  process pool:      {pool * 1000:8.2f}ms (with {os.cpu_count()} cores)')
+    print(f'  cached:            {cached * 1000:8.2f}ms')
+
+
+@benchmark
+def instrumentation(calls=100000, n_functions=100):
+    """What instrument.phase costs a call when it's off and on, and a pipeline run with it on"""
+    from tokens import tokenize as instrumented_tokenize
+    uninstrumented = instrumented_tokenize.__wrapped__
+    bare, _ = timed(lambda: [uninstrumented('a') for _ in range(calls)])
+    off, _ = timed(lambda: [instrumented_tokenize('a') for _ in range(calls)])
+    instrument.enable()
+    try:
+        on, _ = timed(lambda: [instrumented_tokenize('a') for _ in range(calls)])
+        instrument.reset()
+        source = generated_module_source(0, n_functions)
+        timed(lambda: compile.calc_source_to_python_module(source))
+        phases = instrument.report()['phases']
+    finally:
+        instrument.disable()
+        instrument.reset()
+    print(f'tokenizing "a" {calls} times, per call: {bare / calls * 1e9:.0f}ns uninstrumented, '
+          f'{(off - bare) / calls * 1e9:+.0f}ns with instrumentation off, {(on - bare) / calls * 1e9:+.0f}ns on')
+    print(f'compiling a module of {n_functions} functions:')
+    for name, phase in phases.items():
+        if phase['calls']:
+            print(f"  {name:<17} {phase['seconds'] * 1000:8.2f}ms  {phase['calls']:4} calls  {phase['size']} {phase['unit']}")
+
+
+@benchmark
+def profiler(n=18, iterations=20000):
+    """What profiling the interpreter costs: recursive calls, and a loop of small nodes"""
+    programs = [
+        (f'fib({n})', f'fib = (n) => if n < 2 then return n; end; return fib(n - 1) + fib(n - 2); end; x = fib({n});'),
+        (f'{iterations} loop iterations', f'i = 0; while i < {iterations} do i = i + 1; end;'),
+    ]
+    for name, source in programs:
+        stmts = parse(tokenize(source))
+        interp.execute_program(stmts, interp.Scope().create_child_scope())  # caches and specializes nodes
+        plain, _ = timed(interp.execute_program, stmts, interp.Scope().create_child_scope())
+        with calcprofile.Profiler() as p:
+            profiled, _ = timed(interp.execute_program, stmts, interp.Scope().create_child_scope())
+        after, _ = timed(interp.execute_program, stmts, interp.Scope().create_child_scope())
+        print(f'{name:<22} {plain * 1000:8.2f}ms, {profiled * 1000:8.2f}ms profiled '
+              f'({profiled / plain:.1f}x, {sum(p.counts.values())} nodes timed), {after * 1000:8.2f}ms after')
+
+
+@benchmark
+def line_profiler(n=22):
+    """What profiling compiled calc code line by line costs"""
+    code = compile.calc_ast_to_python_code_object(parse(tokenize(
+        f'fib = (n) => if n < 2 then return n; end; return fib(n - 1) + fib(n - 2); end;\nx = fib({n});')),
+        'fib.calc', whole_program=False)  # not memoized
+    plain, _ = timed(exec, code, {})
+    with calcprofile.LineProfiler() as p:
+        profiled, _ = timed(exec, code, {})
+    tracer = 'sys.monitoring' if hasattr(sys, 'monitoring') else 'sys.settrace'
+    print(f'compiled fib({n}): {plain * 1000:8.2f}ms, {profiled * 1000:8.2f}ms profiled with {tracer} '
+          f'({profiled / plain:.1f}x, {sum(p.hits.values())} lines run)')
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,121 @@
+"""
+Bundles pack the compiled code of a whole tree of .calc modules into one file,
+so starting a process that uses hundreds of them costs one open and one mmap
+instead of a stat and a read per module. Modules are only unmarshalled when
+they are imported. A bundle is a snapshot: it isn't checked against the sources.
+
+    python bundle.py DIRECTORY OUTPUT
+
+Layout: MAGIC, the interpreter's pyc magic number, the length of the index,
+the marshalled index {module name: (offset, size, is_package, origin)},
+then the marshalled code objects, at offsets counted from the end of the index.
+"""
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import marshal
+import mmap
+import os
+import sys
+
+import importhack
+from precompile import find_calc_files
+
+MAGIC = b'CALCBNDL'
+HEADER_SIZE = len(MAGIC) + 4 + 4
+
+def module_name(directory, path):
+    """
+    >>> module_name('src', os.path.join('src', 'pkg', 'sub.calc'))
+    'pkg.sub'
+    >>> module_name('src', os.path.join('src', 'pkg', '__init__.calc'))
+    'pkg'
+    """
+    parts = os.path.relpath(path, directory)[:-len('.calc')].split(os.sep)
+    if parts[-1] == '__init__':
+        parts.pop()
+    return '.'.join(parts)
+
+def build_bundle(directory, output):
+    """Compiles every .calc file under directory into a bundle, returns the module names"""
+    blobs = []
+    index = {}
+    offset = 0
+    for path in find_calc_files(directory):
+        with open(path, 'rb') as f:
+            source = f.read().decode('utf-8')
+        name = module_name(directory, path)
+        blob = marshal.dumps(importhack.calc_source_to_code(source, path))
+        is_package = os.path.basename(path) == '__init__.calc'
+        index[name] = (offset, len(blob), is_package, os.path.abspath(path))
+        blobs.append(blob)
+        offset += len(blob)
+
+    index_blob = marshal.dumps(index)
+    with open(output, 'wb') as f:
+        f.write(MAGIC)
+        f.write(importlib.util.MAGIC_NUMBER)
+        f.write(len(index_blob).to_bytes(4, 'little'))
+        f.write(index_blob)
+        for blob in blobs:
+            f.write(blob)
+    return sorted(index)
+
+class BundleFinder(importlib.abc.MetaPathFinder):
+    calc = True  # lets importhack.shim() find and replace us
+
+    def __init__(self, path, lazy=False):
+        self.path = path
+        self.lazy = lazy
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ImportError(f'{path} is not a calc bundle', path=path)
+        if self.data[len(MAGIC):len(MAGIC) + 4] != importlib.util.MAGIC_NUMBER:
+            raise ImportError(f'{path} was built by a different Python version', path=path)
+        index_size = int.from_bytes(self.data[len(MAGIC) + 4:HEADER_SIZE], 'little')
+        self.index = marshal.loads(self.data[HEADER_SIZE:HEADER_SIZE + index_size])
+        self.data_start = HEADER_SIZE + index_size
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in self.index:
+            return None
+        offset, size, is_package, origin = self.index[fullname]
+        loader = BundleLoader(self, fullname)
+        if self.lazy:
+            loader = importlib.util.LazyLoader(loader)
+        spec = importlib.machinery.ModuleSpec(fullname, loader, origin=origin, is_package=is_package)
+        spec.has_location = True
+        if is_package:
+            spec.submodule_search_locations = []
+        return spec
+
+class BundleLoader(importlib.abc.InspectLoader):
+    def __init__(self, finder, fullname):
+        self.finder = finder
+        self.fullname = fullname
+
+    def is_package(self, fullname):
+        return self.finder.index[fullname][2]
+
+    def get_source(self, fullname):
+        return None
+
+    def get_code(self, fullname):
+        offset, size, is_package, origin = self.finder.index[fullname]
+        start = self.finder.data_start + offset
+        return marshal.loads(self.finder.data[start:start + size])
+
+    def exec_module(self, module):
+        exec(self.get_code(module.__name__), module.__dict__)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) == 2:
+        directory, output = args
+        names = build_bundle(directory, output)
+        print(f'bundled {len(names)} modules into {output} ({os.path.getsize(output)} bytes)')
+    else:
+        import doctest
+        doctest.testmod()
@@ -0,0 +1,364 @@
+"""
+Which lines and functions of a calc program the time goes to, interpreted or compiled.
+
+While a Profiler is active it replaces interp.execute, interp.evaluate and
+Closure.execute_checked with versions that count and time each AST node
+and each call of a calc function, and puts the originals back afterwards.
+The interpreter looks all three up each time it uses them, so when nothing
+is being profiled it runs exactly the code it always did.
+
+Profiling isn't free: timing every node makes a program run several times
+slower (three to six times in benchmarks.py profiler), more so the smaller
+its nodes are.
+Times are wall clock, and the time of a node doesn't include the time of
+the nodes in it, so the times of a line add up to the time spent there.
+
+The calls of calc functions can be written out as collapsed stacks, one
+"frame;frame;frame microseconds" line per stack, for flamegraph.pl or
+speedscope. With --compiled the program is compiled to Python bytecode and
+LineProfiler times its lines instead:
+
+    python calcprofile.py FILE.calc [-n LINES] [--flamegraph OUT]
+    python calcprofile.py --compiled FILE.calc [-n LINES]
+"""
+from collections import Counter
+import argparse
+import sys
+import time
+
+from parse import Assignment, Function, Run, BinaryOp, UnaryOp, Call, find_span, parse
+from tokens import Token, tokenize
+from compile import calc_ast_to_python_code_object
+from importhack import calc_source_to_code
+import interp
+
+EXPRESSION_STATEMENTS = (BinaryOp, UnaryOp, Token, Call)  # executed by evaluating them
+
+class Profiler:
+    """
+    >>> with Profiler() as profiler:
+    ...     interp.run_program('a = 0; while a < 10 do a = a + 1; end;')
+    >>> [(lineno, hits) for filename, lineno, hits, seconds in profiler.lines()]
+    [(1, 12)]
+    """
+    def __init__(self, filename='<calc>'):
+        self.filename = filename  # of the program the nodes being run come from
+        self.nodes = {}  # id(node) -> node, which keeps ids from being reused
+        self.files = {}  # id(node) -> filename
+        self.executions = Counter()  # id(statement) -> times executed
+        self.counts = Counter()  # id(node) -> times executed or evaluated
+        self.times = Counter()  # id(node) -> seconds spent in node but not in the nodes in it
+        self.function_names = {}  # id(Function node) -> the name it was assigned to
+        self.calls = Counter()  # id(Function node) -> calls
+        self.function_times = Counter()  # id(Function node) -> seconds in calls, counting recursive ones once
+        self.stacks = Counter()  # ids of the Function nodes being called, outermost first -> seconds in the last
+        self.children = [0.0]  # for each node being run, seconds spent in the nodes in it so far
+        self.frames = []  # ids of the Function nodes being called
+        self.frame_children = [0.0]  # for each call, seconds spent in the calls it made so far
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.originals = interp.execute, interp.evaluate, interp.Closure.execute_checked
+        execute, evaluate, execute_checked = self.originals
+        profiler = self
+
+        def profiled_execute(stmt, variables):
+            profiler.executions[id(stmt)] += 1
+            if isinstance(stmt, EXPRESSION_STATEMENTS):
+                return execute(stmt, variables)  # timed by evaluate
+            if isinstance(stmt, Assignment) and isinstance(stmt.rhs, Function) and isinstance(stmt.lhs, Token):
+                profiler.function_names.setdefault(id(stmt.rhs), stmt.lhs.content)
+            if isinstance(stmt, Run):
+                return profiler.run_node(run_other_program, stmt, variables)
+            return profiler.run_node(execute, stmt, variables)
+
+        def run_other_program(stmt, variables):
+            filename, profiler.filename = profiler.filename, stmt.filename.content + '.calc'
+            try:
+                return execute(stmt, variables)
+            finally:
+                profiler.filename = filename
+
+        def profiled_evaluate(node, variables):
+            return profiler.run_node(evaluate, node, variables)
+
+        def profiled_execute_checked(closure, args):
+            return profiler.call(execute_checked, closure, args)
+
+        interp.execute, interp.evaluate = profiled_execute, profiled_evaluate
+        interp.Closure.execute_checked = profiled_execute_checked
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.t0
+        self.seconds += elapsed
+        self.stacks[()] += elapsed - self.frame_children[0]
+        self.frame_children[0] = 0.0
+        interp.execute, interp.evaluate, interp.Closure.execute_checked = self.originals
+
+    def run_node(self, run, node, variables):
+        key = id(node)
+        if key not in self.nodes:
+            self.nodes[key] = node
+            self.files[key] = self.filename
+        self.children.append(0.0)
+        t0 = time.perf_counter()
+        try:
+            return run(node, variables)
+        finally:
+            elapsed = time.perf_counter() - t0
+            nested = self.children.pop()
+            self.children[-1] += elapsed
+            self.counts[key] += 1
+            self.times[key] += elapsed - nested
+
+    def call(self, execute_checked, closure, args):
+        key = id(closure.function_ast)
+        recursive = key in self.frames
+        filename, self.filename = self.filename, self.files.get(key, self.filename)
+        self.frames.append(key)
+        self.frame_children.append(0.0)
+        t0 = time.perf_counter()
+        try:
+            return execute_checked(closure, args)
+        finally:
+            elapsed = time.perf_counter() - t0
+            nested = self.frame_children.pop()
+            self.frame_children[-1] += elapsed
+            self.stacks[tuple(self.frames)] += elapsed - nested
+            self.frames.pop()
+            self.calls[key] += 1
+            if not recursive:
+                self.function_times[key] += elapsed
+            self.filename = filename
+
+    def lineno(self, key):
+        node = self.nodes[key]
+        if isinstance(node, Function):
+            return node.token.lineno  # the line of its =>, not of its first param
+        span = find_span(node)
+        return span.lineno if span is not None else None
+
+    def lines(self):
+        """(filename, lineno, statements executed, seconds) for each line that ran, in order"""
+        hits, seconds = Counter(), Counter()
+        for key in self.nodes:
+            line = (self.files[key], self.lineno(key))
+            hits[line] += self.executions[key]
+            seconds[line] += self.times[key]
+        return [(filename, lineno, hits[filename, lineno], seconds[filename, lineno])
+                for filename, lineno in sorted(hits, key=lambda line: (line[0], line[1] or 0))]
+
+    def function_name(self, key):
+        return f"{self.function_names.get(key, '<function>')} ({self.files[key]}:{self.lineno(key)})"
+
+    def functions(self):
+        """(name, calls, seconds including the calls it made) for each calc function called, slowest first"""
+        return sorted([(self.function_name(key), self.calls[key], self.function_times[key]) for key in self.calls],
+                      key=lambda function: -function[2])
+
+    def write_collapsed(self, out):
+        """Writes a line for each stack of calc functions: their names separated by semicolons, then microseconds"""
+        for stack, seconds in sorted(self.stacks.items()):
+            microseconds = round(seconds * 1e6)
+            if microseconds > 0:
+                frames = ['<module>'] + [self.function_name(key) for key in stack]
+                out.write(f"{';'.join(frame.replace(';', ',') for frame in frames)} {microseconds}\n")
+
+    def print_report(self, source=None, n_lines=20, out=None):
+        """The slowest lines, with their text if they're from source (the program being profiled), then the functions"""
+        out = out or sys.stdout
+        print_lines(self.lines(), self.seconds, self.filename, source, n_lines, out)
+        out.write(f"\n{'calls':>9} {'ms':>10}  function\n")
+        for name, calls, seconds in self.functions()[:n_lines]:
+            out.write(f'{calls:9} {seconds * 1000:10.2f}  {name}\n')
+
+def print_lines(lines, total_seconds, filename, source, n_lines, out):
+    """The n_lines slowest of lines, showing the text of the ones in filename if its source is given"""
+    source_lines = source.splitlines() if source is not None else []
+    out.write(f'{total_seconds * 1000:.2f}ms, slowest lines:\n')
+    out.write(f"{'file':>16} {'line':>5} {'hits':>9} {'ms':>10}  source\n")
+    for line_filename, lineno, hits, seconds in sorted(lines, key=lambda line: -line[3])[:n_lines]:
+        text = ''
+        if line_filename == filename and lineno is not None and 0 < lineno <= len(source_lines):
+            text = source_lines[lineno - 1].strip()
+        out.write(f'{line_filename:>16} {lineno or "?":>5} {hits:9} {seconds * 1000:10.2f}  {text}\n')
+
+class LineProfiler:
+    """
+    Hits and time for each line of calc code compiled to Python bytecode,
+    which is any code object whose co_filename ends in .calc. compile.py
+    gives code objects line tables mapping their bytecode to calc lines, so
+    the line events Python sends while running them are for calc lines.
+    They come from sys.monitoring on Pythons that have it (3.12 and later),
+    which lets us turn events off for code that isn't calc code, and from a
+    sys.settrace trace function otherwise, which sees every Python call.
+
+    A line's time stops while a calc function it calls runs, so as in
+    Profiler the times of the lines add up to the time spent in calc code,
+    and each closure's lines are timed in their own right. Time spent in
+    Python functions (print, say) counts towards the line that called them.
+    Every line and call runs some Python in the profiler, so code made of
+    small functions runs tens of times slower (see benchmarks.py line_profiler).
+
+        >>> code = calc_ast_to_python_code_object(parse(tokenize('a = 0;\\nwhile a < 3 do\\n  a = a + 1;\\nend;')), 'loop.calc')
+        >>> with LineProfiler() as profiler:
+        ...     exec(code, {})
+        >>> [(lineno, hits) for filename, lineno, hits, seconds in profiler.lines()]
+        [(1, 1), (2, 4), (3, 3)]
+    """
+    def __init__(self):
+        self.hits = Counter()  # (filename, lineno) -> times the line started running
+        self.times = Counter()  # (filename, lineno) -> seconds spent running it
+        self.calls = Counter()  # code object -> calls
+        self.labels = {}  # code object -> what to call it in the report
+        self.running = []  # [code, line, when it started or resumed] of each calc frame running, innermost last
+        self.seconds = 0.0
+
+    @staticmethod
+    def is_calc_code(code):
+        return code.co_filename.endswith('.calc')
+
+    def __enter__(self):
+        if hasattr(sys, 'monitoring'):
+            self.start_monitoring()
+        else:
+            self.orig_trace = sys.gettrace()
+            sys.settrace(self.trace_call)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self.t0
+        if hasattr(sys, 'monitoring'):
+            self.stop_monitoring()
+        else:
+            sys.settrace(self.orig_trace)
+        self.running = []
+
+    def pause(self, entry):
+        code, lineno, started = entry
+        if lineno is not None:
+            self.times[code.co_filename, lineno] += time.perf_counter() - started
+
+    def start(self, code):
+        if self.running:
+            self.pause(self.running[-1])
+        if code not in self.labels:
+            # compiled functions are named after their module, so they're shown by where they start
+            params = ', '.join(code.co_varnames[:code.co_argcount])
+            self.labels[code] = (f'{code.co_filename}:{code.co_firstlineno} ({params})' if self.running else
+                                 f'{code.co_filename} (module)')
+        self.calls[code] += 1
+        self.running.append([code, None, 0.0])
+
+    def line(self, code, lineno):
+        entry = self.running[-1]
+        self.pause(entry)
+        self.hits[code.co_filename, lineno] += 1
+        entry[1], entry[2] = lineno, time.perf_counter()
+
+    def finish(self):
+        self.pause(self.running.pop())
+        if self.running:
+            self.running[-1][2] = time.perf_counter()
+
+    def trace_call(self, frame, event, arg):
+        if event != 'call' or not self.is_calc_code(frame.f_code):
+            return None
+        self.start(frame.f_code)
+        return self.trace_line
+
+    def trace_line(self, frame, event, arg):
+        # the frame's own events, so it's the innermost one running
+        if event == 'line':
+            self.line(frame.f_code, frame.f_lineno)
+        elif event == 'return':  # also sent when an exception leaves the frame
+            self.finish()
+        return self.trace_line
+
+    def start_monitoring(self):
+        monitoring = sys.monitoring
+        events = monitoring.events
+        monitoring.use_tool_id(monitoring.PROFILER_ID, 'calcprofile')
+        for event, callback in [(events.PY_START, self.on_start), (events.LINE, self.on_line),
+                                (events.PY_RETURN, self.on_return), (events.PY_UNWIND, self.on_unwind)]:
+            monitoring.register_callback(monitoring.PROFILER_ID, event, callback)
+        monitoring.set_events(monitoring.PROFILER_ID, events.PY_START | events.LINE | events.PY_RETURN | events.PY_UNWIND)
+
+    def stop_monitoring(self):
+        monitoring = sys.monitoring
+        monitoring.set_events(monitoring.PROFILER_ID, 0)
+        monitoring.free_tool_id(monitoring.PROFILER_ID)
+        monitoring.restart_events()  # the events we turned off for code that isn't calc code
+
+    def on_start(self, code, offset):
+        if not self.is_calc_code(code):
+            return sys.monitoring.DISABLE
+        self.start(code)
+
+    def on_line(self, code, lineno):
+        if not self.is_calc_code(code):
+            return sys.monitoring.DISABLE
+        if self.running and self.running[-1][0] is code:  # not a frame that started before we did
+            self.line(code, lineno)
+
+    def on_return(self, code, offset, value):
+        if not self.is_calc_code(code):
+            return sys.monitoring.DISABLE
+        if self.running and self.running[-1][0] is code:
+            self.finish()
+
+    def on_unwind(self, code, offset, exception):
+        # can't be turned off for a code object, so this is called for every exception leaving a function
+        if self.running and self.running[-1][0] is code:
+            self.finish()
+
+    def lines(self):
+        """(filename, lineno, hits, seconds) for each line that ran, in order"""
+        return [(filename, lineno, self.hits[filename, lineno], self.times[filename, lineno])
+                for filename, lineno in sorted(self.hits)]
+
+    def print_report(self, filename=None, source=None, n_lines=20, out=None):
+        """The slowest lines, with their text if they're from filename and its source is given, then the functions"""
+        out = out or sys.stdout
+        print_lines(self.lines(), self.seconds, filename, source, n_lines, out)
+        out.write(f"\n{'calls':>9}  function\n")
+        for code, calls in self.calls.most_common(n_lines):
+            out.write(f'{calls:9}  {self.labels[code]}\n')
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run a calc program and show where the time went')
+    parser.add_argument('filename')
+    parser.add_argument('-n', '--lines', type=int, default=20, help='how many lines and functions to show')
+    parser.add_argument('--compiled', action='store_true',
+                        help='compile the program to Python bytecode and profile that instead of the interpreter')
+    parser.add_argument('--flamegraph', metavar='OUT', help='write collapsed stacks of calc function calls to OUT')
+    args = parser.parse_args(argv)
+    if args.compiled and args.flamegraph:
+        parser.error("--flamegraph needs the interpreter's profiler, it can't be used with --compiled")
+
+    with open(args.filename) as f:
+        source = f.read()
+    if args.compiled:
+        code = calc_source_to_code(source, args.filename)
+        module = {'__name__': '__main__', '__file__': args.filename}
+        with LineProfiler() as profiler:
+            exec(code, module)
+        profiler.print_report(args.filename, source, args.lines)
+        return
+    with Profiler(args.filename) as profiler:
+        interp.run_program(source)
+    profiler.print_report(source, args.lines)
+    if args.flamegraph:
+        with open(args.flamegraph, 'w') as f:
+            profiler.write_collapsed(f)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        main(sys.argv[1:])
+    else:
+        import doctest
+        doctest.testmod()
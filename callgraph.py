@@ -0,0 +1,96 @@
+"""
+Which of a module's functions can ever be called.
+
+The call graph's nodes are the names bound to functions by module-level
+statements. A function's edges go to every name it (or anything nested in
+it) looks up, since looking a function up is the only way to call it or
+pass it on. The roots are the names looked up by the module's other
+statements. Functions not reachable from the roots are dead: nothing in
+the module can call them, so compile_module can leave them out when asked.
+Code importing the module could still have used them, so names it needs
+can be kept.
+
+    python callgraph.py FILE.calc [KEEP ...]
+"""
+from collections import namedtuple
+import marshal
+import sys
+
+from parse import parse, Assignment, Function, Run, Compile
+from tokens import Token, tokenize
+from scope_analysis import find_all_variable_lookups, find_all_nested_scopes
+
+CallGraph = namedtuple('CallGraph', ['roots', 'edges'])
+
+def find_all_names_used(node):
+    """Variables looked up anywhere in node, including in the functions and classes nested in it"""
+    names = {lookup.content for lookup in find_all_variable_lookups(node)}
+    for nested_scope in find_all_nested_scopes(node):
+        for stmt in nested_scope.body:
+            names |= find_all_names_used(stmt)
+    return names
+
+def is_function_binding(stmt):
+    return (isinstance(stmt, Assignment) and isinstance(stmt.lhs, Token) and
+            isinstance(stmt.rhs, Function))
+
+def build_call_graph(stmts):
+    """
+    >>> build_call_graph(parse(tokenize('f = () => return g(); end; g = () => return 1; end; f();')))
+    CallGraph(roots={'f'}, edges={'f': {'g'}, 'g': set()})
+    """
+    roots = set()
+    edges = {}
+    for stmt in stmts:
+        if is_function_binding(stmt):
+            edges.setdefault(stmt.lhs.content, set()).update(find_all_names_used(stmt.rhs))
+        else:
+            roots |= find_all_names_used(stmt)
+    return CallGraph(roots, edges)
+
+def find_dead_functions(stmts, keep=()):
+    """Names bound to functions by module-level statements that can never be called"""
+    if any(isinstance(stmt, (Run, Compile)) for stmt in stmts):
+        return set()  # the program run could use anything
+    graph = build_call_graph(stmts)
+    reachable = set()
+    todo = list(graph.roots | set(keep))
+    while todo:
+        name = todo.pop()
+        if name not in reachable:
+            reachable.add(name)
+            todo.extend(graph.edges.get(name, ()))
+    return set(graph.edges) - reachable
+
+def drop_dead_functions(stmts, keep=()):
+    """Returns the statements that bind live functions or aren't function bindings, and the others"""
+    dead = find_dead_functions(stmts, keep)
+    kept = [stmt for stmt in stmts if not (is_function_binding(stmt) and stmt.lhs.content in dead)]
+    dropped = [stmt for stmt in stmts if is_function_binding(stmt) and stmt.lhs.content in dead]
+    return kept, dropped
+
+def code_size(stmts):
+    """Bytes of marshalled code a module made of stmts compiles to, as written to a pyc"""
+    from compile import calc_ast_to_python_code_object  # compile.py imports this module
+    return len(marshal.dumps(calc_ast_to_python_code_object(stmts)))
+
+def main(argv):
+    filename, *keep = argv
+    with open(filename) as f:
+        stmts = parse(tokenize(f.read()))
+    graph = build_call_graph(stmts)
+    kept, dropped = drop_dead_functions(stmts, keep)
+    before, after = code_size(stmts), code_size(kept)
+    print(f'{len(graph.edges)} functions, called from the module: {", ".join(sorted(graph.roots & set(graph.edges)))}')
+    for name in sorted(graph.edges):
+        print(f'  {name} -> {", ".join(sorted(graph.edges[name] & set(graph.edges)))}')
+    print(f'dead: {", ".join(sorted(stmt.lhs.content for stmt in dropped)) or "none"}')
+    print(f'code size: {before} bytes, {after} without dead functions (saved {before - after})')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        main(sys.argv[1:])
+    else:
+        import doctest
+        doctest.testmod()
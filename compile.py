@@ -2,6 +2,10 @@ from tokens import Token, tokenize
 from parse import BinaryOp, UnaryOp, pprint_tree, parse, Assignment, If, While, Call, Return, Function, Run, PropAccess, Class, Compile, parse_expression
 from scope_analysis import ScopeAnalyzer
 from mutablecode import MutableCode
+from inline import inline_functions
+from memoize import find_pure_functions
+from callgraph import drop_dead_functions
+from instrument import phase
 
 import sys
 import opcode
@@ -17,6 +21,16 @@ TOKEN_TO_BINOP = {
     '>': ('COMPARE_OP', opcode.cmp_op.index('>')),
     '==': ('COMPARE_OP', opcode.cmp_op.index('==')),
 }
+TOKEN_TO_UNARYOP = {
+    '+': 'UNARY_POSITIVE',
+    '-': 'UNARY_NEGATIVE',
+}
+
+# Since 3.7, LOAD_METHOD/CALL_METHOD call methods without creating bound method objects
+METHOD_CALL_OPS = 'LOAD_METHOD' in opcode.opmap
+
+INLINING = True  # set to False to compile every call as a call
+MEMOIZATION = True  # set to False to never memoize pure functions
 
 def compile_expression(node, code):
     if isinstance(node, Token):
@@ -33,13 +47,30 @@ def compile_expression(node, code):
             return code
 
     elif isinstance(node, BinaryOp):
-        raise ValueError("can't compile binaryop")
+        compile_expression(node.left, code)
+        compile_expression(node.right, code)
+        code.add_op(TOKEN_TO_BINOP[node.op.content], node.op.lineno)
+        return code
     elif isinstance(node, UnaryOp):
-        raise ValueError("can't compile unaryop")
+        compile_expression(node.right, code)
+        code.add_op(TOKEN_TO_UNARYOP[node.op.content], node.op.lineno)
+        return code
     elif isinstance(node, Function):
         compile_function(node, code)
         return code
+    elif isinstance(node, PropAccess):
+        compile_expression(node.left, code)
+        code.add_op(('LOAD_ATTR', code.register_name(node.prop.content)), node.prop.lineno)
+        return code
     elif isinstance(node, Call):
+        if isinstance(node.callable, PropAccess) and METHOD_CALL_OPS:
+            compile_expression(node.callable.left, code)
+            prop = node.callable.prop
+            code.add_op(('LOAD_METHOD', code.register_name(prop.content)), prop.lineno)
+            for arg in node.arguments:
+                compile_expression(arg, code)
+            code.add_op(('CALL_METHOD', len(node.arguments)), None)
+            return code
         compile_expression(node.callable, code)
         for arg in node.arguments:
             compile_expression(arg, code)
@@ -48,24 +79,53 @@ def compile_expression(node, code):
     raise ValueError(f"Don't know what this is: {node}")
 
 def compile_statement(stmt, code):
-    if isinstance(stmt, (BinaryOp, UnaryOp, Token, Call)):
+    if isinstance(stmt, (BinaryOp, UnaryOp, Token, Call, PropAccess)):
         code = compile_expression(stmt, code)
         code.add_op('POP_TOP', None)
         return code
     elif isinstance(stmt, Assignment):
         code = compile_expression(stmt.rhs, code)
+        if isinstance(stmt.lhs, PropAccess):
+            compile_expression(stmt.lhs.left, code)
+            prop = stmt.lhs.prop
+            code.add_op(('STORE_ATTR', code.register_name(prop.content)), prop.lineno)
+            return code
         assert stmt.lhs.kind == 'Variable', stmt.lhs
         code.add_store_var_op(stmt.lhs.content, stmt.lhs.lineno)
         return code
     elif isinstance(stmt, If):
-        raise ValueError(f"don't know how to compile stmt of type {type(stmt)}")
+        else_label = code.make_label('else')
+        end_label = code.make_label('endif')
+        compile_expression(stmt.condition, code)
+        code.add_op(('POP_JUMP_IF_FALSE', else_label), None)
+        for s in stmt.body:
+            compile_statement(s, code)
+        if stmt.else_body:
+            code.add_op(('JUMP_ABSOLUTE', end_label), None)
+        code.set_target(else_label)
+        for s in stmt.else_body:
+            compile_statement(s, code)
+        code.set_target(end_label)
+        return code
     elif isinstance(stmt, While):
-        raise ValueError(f"don't know how to compile stmt of type {type(stmt)}")
+        start_label = code.make_label('while')
+        end_label = code.make_label('endwhile')
+        code.set_target(start_label)
+        compile_expression(stmt.condition, code)
+        code.add_op(('POP_JUMP_IF_FALSE', end_label), None)
+        for s in stmt.body:
+            compile_statement(s, code)
+        code.add_op(('JUMP_ABSOLUTE', start_label), None)
+        code.set_target(end_label)
+        return code
     elif isinstance(stmt, Run):
         raise ValueError(f"don't know how to compile stmt of type {type(stmt)}")
     elif isinstance(stmt, Return):
         code = compile_expression(stmt.expression, code)
         code.add_op('RETURN_VALUE', None)
+    elif isinstance(stmt, Class):
+        compile_class(stmt, code)
+        return code
     else:
         raise ValueError(f"don't know how to compile stmt of type {type(stmt)}")
 
@@ -81,31 +141,109 @@ def compile_function(node, code):
     n = func_code.register_const(None)
     func_code.add_op(('LOAD_CONST', n), None)
     func_code.add_op('RETURN_VALUE', None)
+    add_make_function_ops(func_code, code, node.token.lineno)
+    return code
+
+def add_make_function_ops(func_code, code, lineno):
+    """Adds ops to code that make a function (with a closure if needed) out of func_code"""
     func_code_obj = func_code.to_code_object()
 
     if func_code.freevars:
         for inner_freevar in func_code.freevars:
             n = code.cellvar_or_freevar_offset(inner_freevar)
-            code.add_op(('LOAD_CLOSURE', n), node.token.lineno)
-        code.add_op(('BUILD_TUPLE', len(func_code.freevars)), node.token.lineno)
+            code.add_op(('LOAD_CLOSURE', n), lineno)
+        code.add_op(('BUILD_TUPLE', len(func_code.freevars)), lineno)
 
     n = code.register_const(func_code_obj)
-    code.add_op(('LOAD_CONST', n), node.token.lineno)
+    code.add_op(('LOAD_CONST', n), lineno)
     n = code.register_const(func_code.name)
-    code.add_op(('LOAD_CONST', n), node.token.lineno)
+    code.add_op(('LOAD_CONST', n), lineno)
     if func_code.freevars:
-        code.add_op(('MAKE_FUNCTION', 0x08), node.token.lineno)
+        code.add_op(('MAKE_FUNCTION', 0x08), lineno)
     else:
-        code.add_op(('MAKE_FUNCTION', 0x00), node.token.lineno)
+        code.add_op(('MAKE_FUNCTION', 0x00), lineno)
+
+def compile_class(node, code):
+    """
+    Compiles to the same ops as a Python class statement. Props that methods
+    assign on this become __slots__, so instances have no __dict__ unless a
+    prop shares its name with something in the class body, or the module
+    assigns props of something other than this (p.x = 1), which could be an
+    instance of any class.
+    """
+    name = node.name.content
+    lineno = node.name.lineno
+    st = code.scope_analyzer[node]
+    class_code = MutableCode(symbol_table=st, params=(), scope_analyzer=code.scope_analyzer,
+                             filename=code.filename, name=name, firstlineno=lineno)
+
+    class_code.add_op(('LOAD_NAME', class_code.register_name('__name__')), lineno)
+    class_code.add_op(('STORE_NAME', class_code.register_name('__module__')), lineno)
+    class_code.add_op(('LOAD_CONST', class_code.register_const(name)), lineno)
+    class_code.add_op(('STORE_NAME', class_code.register_name('__qualname__')), lineno)
+    slots = sorted(st.instance_vars - st.local_vars)
+    if st.instance_vars & st.local_vars or code.scope_analyzer.other_prop_assignments:
+        slots.append('__dict__')
+    class_code.add_op(('LOAD_CONST', class_code.register_const(tuple(slots))), lineno)
+    class_code.add_op(('STORE_NAME', class_code.register_name('__slots__')), lineno)
+
+    for stmt in node.body:
+        compile_statement(stmt, class_code)
+
+    n = class_code.register_const(None)
+    class_code.add_op(('LOAD_CONST', n), None)
+    class_code.add_op('RETURN_VALUE', None)
+
+    code.add_op('LOAD_BUILD_CLASS', lineno)
+    add_make_function_ops(class_code, code, lineno)
+    code.add_op(('LOAD_CONST', code.register_const(name)), lineno)
+    if node.extends:
+        compile_expression(node.extends, code)
+        code.add_op(('CALL_FUNCTION', 3), lineno)
+    else:
+        code.add_op(('CALL_FUNCTION', 2), lineno)
+    code.add_store_var_op(name, lineno)
+    return code
+
+def compile_memoized_function(stmt, code):
+    """Compiles `name = function` as `name = memoize.MemoCache(function)`"""
+    lineno = stmt.lhs.lineno
+    code.add_op(('LOAD_CONST', code.register_const(0)), lineno)
+    code.add_op(('LOAD_CONST', code.register_const(None)), lineno)
+    code.add_op(('IMPORT_NAME', code.register_name('memoize')), lineno)
+    code.add_op(('LOAD_ATTR', code.register_name('MemoCache')), lineno)
+    compile_function(stmt.rhs, code)
+    code.add_op(('CALL_FUNCTION', 1), lineno)
+    code.add_store_var_op(stmt.lhs.content, lineno)
     return code
 
-def compile_module(stmts, source_filename, name):
+@phase('codegen', 'statements', lambda stmts, *args, **kwargs: len(stmts))
+def compile_module(stmts, source_filename, name, drop_dead=False, keep=(), whole_program=True):
+    """
+    With drop_dead, functions bound at module level that the module can never
+    call are left out (see callgraph.py), along with the ones only inlined
+    calls used. Code importing the module can't use them either, unless
+    they're named in keep.
+
+    Pass whole_program=False if other code can rebind the module's globals,
+    like the statements that come after this one in a REPL: inlining and
+    memoization rely on it, as in interp.execute_program.
+    """
+    if INLINING and whole_program:
+        stmts = inline_functions(stmts)
+    if drop_dead:
+        stmts, _ = drop_dead_functions(stmts, keep)
     scope_analyzer = ScopeAnalyzer()
     scope_analyzer.discover_symbols(stmts)
 
+    pure = {id(stmt) for stmt in find_pure_functions(stmts)} if MEMOIZATION and whole_program else set()
+
     code = MutableCode(scope_analyzer.global_symbol_table, (), scope_analyzer, source_filename, name)
     for stmt in stmts:
-        compile_statement(stmt, code)
+        if id(stmt) in pure:
+            compile_memoized_function(stmt, code)
+        else:
+            compile_statement(stmt, code)
 
     # modules always end with an implicit return None
     n = code.register_const(None)
@@ -113,8 +251,9 @@ def compile_module(stmts, source_filename, name):
     code.add_op('RETURN_VALUE', None)
     return code
 
-def calc_ast_to_python_code_object(stmts, source_filename='fakefile.calc', name='calc_code'):
-    return compile_module(stmts, source_filename, name).to_code_object()
+def calc_ast_to_python_code_object(stmts, source_filename='fakefile.calc', name='calc_code', drop_dead=False,
+                                   whole_program=True):
+    return compile_module(stmts, source_filename, name, drop_dead, whole_program=whole_program).to_code_object()
 
 def calc_ast_to_python_func(stmts):
     codeobj = calc_ast_to_python_code_object(stmts, 'fakefile.calc', 'calc_function')
@@ -180,7 +319,9 @@ if __name__ == '__main__':
     if len(args) > 0:
         filename, = args
         assert filename.endswith('.calc')
-        compile_calc_file(args)
+        from precompile import compile_file
+        path, status, seconds, error = compile_file(filename, force=True)
+        print(error or f'{status} {path}')
     else:
         import doctest
         doctest.testmod()
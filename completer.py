@@ -1,8 +1,91 @@
+"""
+Tab completion for the REPL: keywords, the modules (.calc files) that can
+be run from the current directory and the variables of the REPL's scope.
+
+readline calls a completer with state 0, 1, 2... for each TAB press until
+it returns None, so the candidates are kept sorted, the matches for a
+prefix are found once with a binary search, and the candidates are only
+rebuilt when the directory or the scope got new names.
+"""
+from bisect import bisect_left
 import glob
-words = ['if', 'then', 'else', 'while', 'do', 'run', 'return', 'end;']
+import os
+
+words = ['if', 'then', 'else', 'while', 'do', 'run', 'compile', 'return', 'class', 'extends', 'end;']
+
+def is_calc_name(name):
+    """
+    Whether calc code can use a variable called name, which leaves out the
+    __builtins__ compiled code needs in the REPL's scope (see debugrepl.py)
+
+    >>> is_calc_name('abc1'), is_calc_name('__builtins__')
+    (True, False)
+    """
+    return name[:1].isalpha() and name.isalnum()
+
+def prefix_matches(candidates, prefix):
+    """
+    >>> prefix_matches(['do', 'else', 'end;', 'extends', 'if'], 'e')
+    ['else', 'end;', 'extends']
+    """
+    matches = []
+    for i in range(bisect_left(candidates, prefix), len(candidates)):
+        if not candidates[i].startswith(prefix):
+            break
+        matches.append(candidates[i])
+    return matches
+
+class Completer:
+    def __init__(self, scope=None, directory='.'):
+        self.scope = scope
+        self.directory = directory
+        self.modules = []
+        self.modules_mtime = None
+        self.scope_sizes = None
+        self.candidates = sorted(words)
+        self.prefix = None
+        self.matches = []
+
+    def __call__(self, text, state):
+        if state == 0 or text != self.prefix:
+            self.refresh()
+            self.prefix = text
+            self.matches = prefix_matches(self.candidates, text)
+        return self.matches[state] if state < len(self.matches) else None
+
+    def scope_chain(self):
+        scope = self.scope
+        while scope is not None and hasattr(scope, 'bindings'):
+            yield scope
+            scope = scope.parent
+
+    def refresh(self):
+        """Rebuilds the candidates if there are new modules or variables"""
+        changed = False
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self.modules_mtime:
+            self.modules_mtime = mtime
+            self.modules = [os.path.basename(filename)[:-5]
+                            for filename in glob.glob(os.path.join(self.directory, '*.calc'))]
+            changed = True
+
+        # the interpreter only ever adds bindings, so scopes with as many as
+        # last time have the same names
+        scopes = list(self.scope_chain())
+        scope_sizes = [len(scope.bindings) for scope in scopes]
+        if scope_sizes != self.scope_sizes:
+            self.scope_sizes = scope_sizes
+            changed = True
+
+        if changed:
+            names = {name for scope in scopes for name in scope.bindings if is_calc_name(name)}
+            self.candidates = sorted(set(words) | set(self.modules) | names)
+
+completer = Completer()
 
-def completer(text, state):
-   modules = [filename[:-5] for filename in glob.glob('*.calc')]
-   candidates = words + modules
-   return [word for word in candidates
-           if word.startswith(text)][state]
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import builtins as python_builtins
 from collections import namedtuple
 import sys
 import time
@@ -7,11 +8,18 @@ from tokens import Token, tokenize
 from parse import BinaryOp, UnaryOp, pprint_tree, parse, Assignment, If, While, Call, Return, Function, Run, PropAccess, Class
 from typeinfer import type_infer_program
 from linter import lint_program
-from completer import completer
+from completer import Completer
+from incremental import OPENING_KINDS, split_statements
+from compile import calc_ast_to_python_code_object
 from interp import Scope, builtin_funcs, execute_program, CantFindVariable, run_program
 import interp
+import instrument
 
-def debug_repl():
+AST_MAX_DEPTH = 30  # the ASTs shown for each statement are cut short after this many levels
+AST_MAX_SIZE = 20000  # or characters
+
+def debug_repl(compiled=False):
+    """With compiled, statements are compiled to Python bytecode instead of interpreted"""
     interp.DEBUG = False
     import readline, os
     histfile = os.path.join(os.path.expanduser("~"), ".calchist")
@@ -23,63 +31,147 @@ def debug_repl():
     import atexit
     atexit.register(readline.write_history_file, histfile)
 
-    readline.parse_and_bind("tab: complete")
-    readline.set_completer(completer)
     builtin_scope = Scope()
     for name in builtin_funcs:
         builtin_scope.set(name, builtin_funcs[name])
     variables = builtin_scope.create_child_scope()
+    readline.parse_and_bind("tab: complete")
+    readline.set_completer(Completer(variables))
+    compiled = CompiledStatements(variables) if compiled else None
     interp.DEBUG = True
-    tokens = []
-    prompt = '>'
+    pending = PendingInput()
     while True:
         try:
-            s = input(prompt + ' ')
+            s = input(('...' if pending.tokens else '>') + ' ')
         except KeyboardInterrupt as e:
-            if tokens:
-                tokens, prompt = [], '>'
+            if pending.tokens:
+                pending = PendingInput()
                 print('input cleared')
                 continue
             else:
                 raise e
 
-        if s == '' and tokens:
-            debug_exec(tokens, variables)
-            tokens, prompt = [], '>'
-        elif s and not tokens:
-            tokens = tokenize(s)
+        if s == '' and pending.tokens:
+            # a blank line runs what there is, to show what's wrong with it
+            debug_exec(pending.tokens, variables, compiled)
+            pending = PendingInput()
+        elif s:
             try:
-                parse(tokens)
-            except:
-                prompt = '...'
-            else:
-                debug_exec(tokens, variables)
-                tokens, prompt = [], '>'
-        elif s and tokens:
-            tokens += tokenize(s)
+                pending.add(tokenize(s))
+            except ValueError as e:
+                print(e)
+                pending = PendingInput()
+                continue
+            if pending.complete:
+                debug_exec(pending.tokens, variables, compiled)
+                pending = PendingInput()
+
+class PendingInput:
+    """
+    The tokens of the lines typed so far, and how deeply nested in
+    functions, ifs, whiles and classes the end of them is, kept up to date
+    a line at a time so we can tell when they're complete statements
+    without parsing them again after every line.
+    """
+    def __init__(self):
+        self.tokens = []
+        self.depth = 0
+
+    def add(self, tokens):
+        previous = self.tokens[-1] if self.tokens else None
+        for token in tokens:
+            if (token.kind in OPENING_KINDS or
+                    token.kind == 'Greater' and previous is not None and previous.kind == 'Equals'):
+                self.depth += 1
+            elif token.kind == 'End':
+                self.depth -= 1
+            previous = token
+        self.tokens.extend(tokens)
 
-def debug_exec(tokens, variables):
+    @property
+    def complete(self):
+        return bool(self.tokens) and self.depth <= 0 and self.tokens[-1].kind == 'Semi'
+
+def debug_exec(tokens, variables, compiled=None):
     import traceback
     try:
         print('tokens:', ' '.join(str(tok.content) for tok in tokens))
-        stmts = parse(tokens)
+        # parsing statements one at a time takes linear time, parse() quadratic
+        statements, rest = split_statements(tokens)
+        if compiled is not None:
+            for stmt_tokens in statements + [rest] if rest else statements:
+                stmts, code = compiled.compile(stmt_tokens)
+                print('AST of each statement:')
+                for stmt in stmts:
+                    pprint_tree(stmt, AST_MAX_DEPTH, AST_MAX_SIZE)
+                compiled.run(stmts, code)
+            return
+        stmts = [stmt for stmt_tokens in statements + [rest] for stmt in parse(stmt_tokens)]
         print('AST of each statement:')
         for stmt in stmts:
-            pprint_tree(stmt)
+            pprint_tree(stmt, AST_MAX_DEPTH, AST_MAX_SIZE)
         execute_program(stmts, variables)
     except ValueError as e:
         print(e)
-    except AssertionError as e:
+    except (AssertionError, IndexError) as e:  # what parse() raises for unfinished statements
         traceback.print_exc()
     except CantFindVariable as e:
         print(e)
+    except Exception as e:  # compiled code raises whatever Python would
+        traceback.print_exc()
+
+class CompiledStatements:
+    """
+    Runs statements typed at the REPL as compiled code. Their globals are
+    the bindings of the REPL's scope, so the interpreter can run the ones
+    that don't compile and both see the same variables. (Compiled code
+    stores globals straight into that dict, so it has to be the same one,
+    __builtins__ and all. Calc names can't start with an underscore, so
+    only the completer needs to leave it out.) Code objects are
+    cached by the tokens of the statement, so running one again (say, from
+    the history) doesn't compile it again.
+    """
+    def __init__(self, variables):
+        self.variables = variables
+        self.globals = variables.bindings
+        builtins = dict(vars(python_builtins))  # compiled code imports things, for one
+        scope = variables.parent
+        while scope is not None:
+            builtins.update(scope.bindings)
+            scope = scope.parent
+        self.globals['__builtins__'] = builtins
+        self.cache = {}  # statement tokens -> statements, code object or None if it didn't compile
+
+    def compile(self, tokens):
+        key = tuple((token.kind, token.content) for token in tokens)
+        if key not in self.cache:
+            stmts = parse(tokens)
+            try:
+                code = calc_ast_to_python_code_object(stmts, '<repl>', '<module>', whole_program=False)
+            except (ValueError, AssertionError, KeyError) as e:
+                print(f"can't compile this, interpreting it instead: {e}")
+                code = None
+            self.cache[key] = stmts, code
+        return self.cache[key]
+
+    def run(self, stmts, code):
+        if code is None:
+            execute_program(stmts, self.variables)
+        else:
+            exec(code, self.globals)
 
 if __name__ == "__main__":
     #import doctest
     #doctest.testmod()
 
     args = sys.argv[1:]
-    if len(args) == 1:
+    if '--instrument' in args:
+        i = args.index('--instrument')
+        instrument.enable(args[i + 1])
+        del args[i:i + 2]
+    if args == ['--compiled']:
+        debug_repl(compiled=True)
+    elif len(args) == 1:
         run_program(open(args[0]).read())
     else:
         debug_repl()
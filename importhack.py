@@ -1,51 +1,185 @@
 import sys
-import opcode
-import importlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import marshal
 import os
 
 from compile import calc_ast_to_python_code_object
 from parse import parse
 from tokens import tokenize
+from instrument import phase
 
-class CalcImporter(object):
-    def __init__(self):
-        pass
-
-    def find_module(self, fullname, path=None):
-        if (fullname + '.calc') in os.listdir('.'):
-            # let's compile it right now!
-            source = open(fullname + '.calc').read()
-            print('bytecode-compiling ' + fullname + '.calc...')
-            data = calc_code_to_pyc_contents(source, fullname + '.calc')
-            with open(fullname + '.pyc', 'wb') as f:
-                f.write(data)
-            return None
+# pyc flags from PEP 552: bit 0 means hash-based, bit 1 means check the hash against the source
+HASH_BASED = 0b01
+CHECK_SOURCE = 0b10
+# and one of ours: the module was compiled without the functions it never calls itself
+DROP_DEAD = 0b100
+
+class CalcFileFinder(importlib.machinery.FileFinder):
+    """
+    A FileFinder that knows about .calc files as well as the usual Python ones.
+
+    Installed as a path hook it replaces the default FileFinder for directories on
+    sys.path, so .calc modules and packages are found with the same cached
+    directory listings (refreshed when the directory's mtime changes) that every
+    other import already uses, instead of with an extra scan per import.
+    """
+
+    def find_spec(self, fullname, target=None):
+        spec = super().find_spec(fullname, target)
+        if spec is not None and spec.origin and spec.origin.endswith('.calc'):
+            loader = getattr(spec.loader, 'loader', spec.loader)  # unwrap a LazyLoader
+            spec.cached = cache_from_source(spec.origin, loader.drop_dead)
+        return spec
+
+class CalcLoader(importlib.abc.FileLoader):
+    """Compiles .calc files, reusing __pycache__ pycs while the source hash still matches"""
+    drop_dead = False
+
+    def is_package(self, fullname):
+        return os.path.splitext(os.path.basename(self.path))[0] == '__init__'
+
+    @phase('execute compiled', 'modules', lambda self, module: 1)
+    def exec_module(self, module):
+        super().exec_module(module)
+
+    def get_source(self, fullname):
+        return self.get_data(self.path).decode('utf-8')
+
+    def get_code(self, fullname):
+        source_bytes = self.get_data(self.path)
+        source_hash = importlib.util.source_hash(source_bytes)
+        bytecode_path = cache_from_source(self.path, self.drop_dead)
+        try:
+            data = self.get_data(bytecode_path)
+        except OSError:
+            pass
+        else:
+            code = code_from_hash_pyc(data, source_hash, self.drop_dead)
+            if code is not None:
+                return code
+
+        code = calc_source_to_code(source_bytes.decode('utf-8'), self.path, self.drop_dead)
+        if not sys.dont_write_bytecode:
+            try:
+                write_atomic(bytecode_path, code_to_hash_pyc(code, source_hash, self.drop_dead))
+            except OSError:
+                pass  # caching is only an optimization, e.g. the directory may be read-only
+        return code
+
+class DropDeadCalcLoader(CalcLoader):
+    """
+    A CalcLoader for programs that never call a function of an imported calc
+    module that the module doesn't call itself, see shim(drop_dead=True).
+    Its pycs (see precompile.py -d) have their own names, so they're never
+    loaded for an import that might want the functions left out of them.
+    """
+    drop_dead = True
+
+def cache_from_source(path, drop_dead=False):
+    """
+    Where the pyc for a .calc file lives. The .calc suffix is kept in the
+    name so it can't collide with the pyc of a .py module of the same name.
+
+    >>> cache_from_source('/src/foo.calc') == f'/src/__pycache__/foo.calc.{sys.implementation.cache_tag}.pyc'
+    True
+    >>> cache_from_source('/src/foo.calc', drop_dead=True) == f'/src/__pycache__/foo.calc.dd.{sys.implementation.cache_tag}.pyc'
+    True
+    """
+    head, tail = os.path.split(path)
+    kind = '.dd' if drop_dead else ''
+    return os.path.join(head, '__pycache__', f'{tail}{kind}.{sys.implementation.cache_tag}.pyc')
+
+def code_to_hash_pyc(code, source_hash, drop_dead=False):
+    data = bytearray(importlib.util.MAGIC_NUMBER)
+    data += (HASH_BASED | CHECK_SOURCE | (DROP_DEAD if drop_dead else 0)).to_bytes(4, 'little')
+    data += source_hash
+    data += marshal.dumps(code)
+    return bytes(data)
+
+def pyc_matches_source(data, source_hash, drop_dead=False):
+    """Checks the 16 byte header of a pyc against the hash of the current source, and how it was compiled"""
+    if data[:4] != importlib.util.MAGIC_NUMBER:
+        return False
+    flags = int.from_bytes(data[4:8], 'little')
+    return (bool(flags & HASH_BASED) and bool(flags & DROP_DEAD) == drop_dead and
+            data[8:16] == source_hash)
+
+def code_from_hash_pyc(data, source_hash, drop_dead=False):
+    """Returns the code object in a pyc, or None if it is stale, compiled differently or not one of ours"""
+    if not pyc_matches_source(data, source_hash, drop_dead):
+        return None
+    try:
+        return marshal.loads(data[16:])
+    except (EOFError, ValueError, TypeError):
         return None
 
-code_to_pyc = None
-import importlib
-if hasattr(importlib._bootstrap_external, '_code_to_timestamp_pyc'):
-    code_to_pyc = importlib._bootstrap_external._code_to_timestamp_pyc
-elif hasattr(importlib._bootstrap_external, '_code_to_bytecode'):
-    code_to_pyc = importlib._bootstrap_external._code_to_bytecode
+def write_atomic(path, data):
+    """Writes to a temporary file and renames it, so readers never see half a pyc"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def calc_source_to_code(source, filename, drop_dead=False):
+    tokens = tokenize(source)
+    statements = parse(tokens)
+    return calc_ast_to_python_code_object(statements, filename, '<module>', drop_dead)
 
 # just for testing
 def python_code_to_pyc_contents(source, filename):
     code = compile(source, filename, 'exec')
-    return code_to_pyc(code, mtime=0, source_size=0)
+    return code_to_hash_pyc(code, importlib.util.source_hash(source.encode('utf-8')))
 
 def calc_code_to_pyc_contents(source, filename):
-    tokens = tokenize(source)
-    statements = parse(tokens)
-    code = calc_ast_to_python_code_object(statements, filename)
-    return code_to_pyc(code, mtime=0, source_size=0)
+    code = calc_source_to_code(source, filename)
+    return code_to_hash_pyc(code, importlib.util.source_hash(source.encode('utf-8')))
+
+def loader_details(lazy=False, drop_dead=False):
+    """
+    Loaders for FileFinder to try, in order. With lazy=True calc modules are
+    wrapped in LazyLoader: importing one creates the module object right away
+    but compiling (or unmarshalling) and running it waits for the first attribute access.
+    """
+    calc_loader = DropDeadCalcLoader if drop_dead else CalcLoader
+    if lazy:
+        calc_loader = importlib.util.LazyLoader.factory(calc_loader)
+    return [
+        (importlib.machinery.ExtensionFileLoader, importlib.machinery.EXTENSION_SUFFIXES),
+        (importlib.machinery.SourceFileLoader, importlib.machinery.SOURCE_SUFFIXES),
+        (importlib.machinery.SourcelessFileLoader, importlib.machinery.BYTECODE_SUFFIXES),
+        (calc_loader, ['.calc']),
+    ]
 
-def shim():
-    # remove any previously-added CalcImporter (to avoid multiple print messages)
-    sys.meta_path = [loader for loader in sys.meta_path
-                     if str(type(loader)) != str(type(CalcImporter()))]
-    sys.meta_path.insert(0, CalcImporter())
+def shim(lazy=False, bundles=(), drop_dead=False):
+    """
+    Makes .calc files importable. Modules found in any of the bundles (see bundle.py)
+    are loaded from there in preference to any .calc files on sys.path. With
+    drop_dead=True calc modules are compiled without the functions they never
+    call themselves, which is only safe if importers don't call them either.
+    """
+    # remove any previously-added calc path hook or bundle (e.g. if this module was reloaded)
+    sys.path_hooks = [hook for hook in sys.path_hooks if not getattr(hook, 'calc', False)]
+    sys.meta_path = [finder for finder in sys.meta_path if not getattr(finder, 'calc', False)]
+    hook = CalcFileFinder.path_hook(*loader_details(lazy, drop_dead))
+    hook.calc = True
+    sys.path_hooks.insert(0, hook)
+    # finders already created for sys.path entries don't know about .calc files
+    sys.path_importer_cache.clear()
 
+    if bundles:
+        from bundle import BundleFinder  # bundle.py imports this module
+        for path in reversed(bundles):
+            sys.meta_path.insert(0, BundleFinder(path, lazy=lazy))
 
 if __name__ == '__main__':
     import doctest
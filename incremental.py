@@ -0,0 +1,319 @@
+"""
+Incremental re-analysis of a module that's being edited.
+
+Running tokenize, parse and scope analysis over a whole file after every
+keystroke gets slower the bigger the file gets. IncrementalProgram keeps
+the source split into Chunks, one per module-level statement, each holding
+the text it was parsed from, its AST and (in the ScopeAnalyzer) the scopes
+nested in it. An edit re-lexes and re-parses only the chunks whose text it
+touched, growing that region when the edit moved where statements end (by
+adding or deleting an `end`, a semicolon or a quote), and reuses the rest.
+A missing `end` makes the rest of the file a single chunk with an error,
+which each edit re-lexes until the `end` is back.
+
+The scopes nested in a module-level statement don't depend on the other
+statements, so only the chunks that were re-parsed get new symbol tables.
+What does depend on other statements is anything computed from the values
+of the globals a chunk uses, so each chunk has a `derived` dict for things
+like inferred types or lint messages, which is cleared when a name the
+chunk looks up is bound by a changed statement.
+
+Tokens of chunks after an edit keep the positions they were lexed at.
+Compiling is whole-module (inlining, memoization and dead function
+elimination look at all of it), so it only happens when code() is called,
+and it re-lexes the chunks that moved so the code gets the right line
+numbers.
+
+    >>> program = IncrementalProgram('a = 1;\\nb = a + 1;\\nc = 3;\\n')
+    >>> change = program.edit(4, 5, '2')
+    >>> change.added
+    [Assignment(lhs=Token(kind='Variable', content='a'), rhs=Token(kind='Number', content=2))]
+    >>> change.rebound, [chunk.stmt.lhs.content for chunk in change.stale]
+    ({'a'}, ['b'])
+"""
+from bisect import bisect_right
+from collections import namedtuple
+
+from tokens import tokenize
+from parse import parse
+from scope_analysis import ScopeAnalyzer, ScopeContents
+from callgraph import find_all_names_used
+from compile import calc_ast_to_python_code_object
+
+Change = namedtuple('Change', ['removed', 'added', 'rebound', 'stale'])
+
+OPENING_KINDS = {'If', 'While', 'Class'}  # and the > of a function's =>
+
+class Chunk:
+    """A module-level statement and its text, which starts with the whitespace before it"""
+    def __init__(self, text, offset, lineno):
+        self.text = text
+        self.offset = offset  # where text starts in the source now
+        self.lineno = lineno  # the line offset is on
+        self.lexed_at = (offset, lineno)  # where its tokens think it starts
+        self.stmt = None  # None if it's whitespace at the end or it didn't parse
+        self.error = None
+        self.binds = set()
+        self.uses = set()
+        self.derived = {}
+
+    def __repr__(self):
+        return f'Chunk({self.text!r}, offset={self.offset}, lineno={self.lineno})'
+
+def lex(text, offset, lineno):
+    """Tokens of text, positioned as if it started at offset on line lineno of a file"""
+    return [token._replace(start=token.start + offset, end=token.end + offset,
+                           lineno=token.lineno + lineno - 1)
+            for token in tokenize(text)]
+
+def split_statements(tokens):
+    """
+    The tokens of each module-level statement, and those left after the last.
+
+    >>> statements, rest = split_statements(tokenize('f = () => if a then b; end; end; c = 1; d'))
+    >>> [len(stmt) for stmt in statements], rest
+    ([15, 4], [Token(kind='Variable', content='d')])
+    """
+    statements = []
+    depth = 0
+    start = 0
+    for i, token in enumerate(tokens):
+        if token.kind in OPENING_KINDS or token.kind == 'Greater' and i and tokens[i - 1].kind == 'Equals':
+            depth += 1
+        elif token.kind == 'End':
+            depth -= 1
+        elif token.kind == 'Semi' and depth <= 0:
+            statements.append(tokens[start:i + 1])
+            start = i + 1
+            depth = 0
+    return statements, tokens[start:]
+
+def parse_chunk(chunk, tokens):
+    try:
+        stmt, = parse(tokens)
+    except Exception as e:
+        chunk.error = e
+        return
+    chunk.stmt = stmt
+    chunk.binds = set(ScopeContents([stmt]).assigned_names)
+    chunk.uses = find_all_names_used(stmt)
+
+def split_at_semicolons(text):
+    """text cut after each semicolon that isn't in a string"""
+    pieces = []
+    in_string = False
+    start = 0
+    for i, c in enumerate(text):
+        if c == '"':
+            in_string = not in_string
+        elif c == ';' and not in_string:
+            pieces.append(text[start:i + 1])
+            start = i + 1
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+def make_chunks(text, offset, lineno, statements):
+    """Chunks for the statements at the start of text, and where they end"""
+    chunks = []
+    start, start_lineno = offset, lineno
+    for stmt_tokens in statements:
+        end = stmt_tokens[-1].end
+        chunk = Chunk(text[start - offset:end - offset], start, start_lineno)
+        parse_chunk(chunk, stmt_tokens)
+        chunks.append(chunk)
+        start, start_lineno = end, start_lineno + chunk.text.count('\n')
+    return chunks, start, start_lineno
+
+def chunk_region(text, offset, lineno, at_end):
+    """
+    Chunks for text, which starts at a statement boundary, or None if it
+    doesn't end at one and we need to look further. Unless at_end, in which
+    case whatever's left becomes a chunk of its own.
+    """
+    if text.count('"') % 2 and not at_end:
+        return None  # a string that doesn't end here
+    try:
+        tokens = lex(text, offset, lineno)
+    except ValueError:
+        return chunk_around_lex_error(text, offset, lineno, at_end)
+
+    statements, rest = split_statements(tokens)
+    if not at_end and (rest or not statements or statements[-1][-1].end != offset + len(text)):
+        return None
+
+    chunks, start, start_lineno = make_chunks(text, offset, lineno, statements)
+    if start < offset + len(text):
+        chunk = Chunk(text[start - offset:], start, start_lineno)
+        if rest:
+            # statements end with a semicolon outside any function, if, while or class,
+            # so this can't parse (and parsing the rest of a file takes a while)
+            chunk.error = ValueError(f"Expected end or semicolon after statement starting on line {rest[0].lineno}")
+        chunks.append(chunk)
+    return chunks
+
+def chunk_around_lex_error(text, offset, lineno, at_end):
+    """
+    Chunks for text that doesn't lex: the statements before the bad token as
+    usual, then a chunk with the error that ends at the next semicolon, then
+    the rest as usual, so one typo doesn't make the rest of the file a chunk.
+    """
+    good = ''
+    for piece in split_at_semicolons(text):
+        try:
+            lex(piece, 0, 1)
+        except ValueError as e:
+            error = e
+            break
+        good += piece
+    if not (at_end or piece.endswith(';')):
+        return None
+
+    statements, _ = split_statements(lex(good, offset, lineno))
+    chunks, start, start_lineno = make_chunks(text, offset, lineno, statements)
+    error_end = offset + len(good) + len(piece)
+    chunk = Chunk(text[start - offset:error_end - offset], start, start_lineno)
+    chunk.error = error
+    chunks.append(chunk)
+
+    rest = text[error_end - offset:]
+    if rest:
+        rest_chunks = chunk_region(rest, error_end, start_lineno + chunk.text.count('\n'), at_end)
+        if rest_chunks is None:
+            return None
+        chunks.extend(rest_chunks)
+    return chunks
+
+def common_prefix_length(a, b):
+    """
+    >>> common_prefix_length('abcd', 'abxd')
+    2
+    """
+    # comparing slices is much faster than comparing characters one by one
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+class IncrementalProgram:
+    def __init__(self, source='', filename='<calc>', assignments_rebind_outer=False):
+        self.source = ''
+        self.filename = filename
+        self.chunks = []
+        self.offsets = []  # of the chunks, to find the ones an edit touches
+        self.users = {}  # name -> chunks that look it up
+        self.analyzer = ScopeAnalyzer(assignments_rebind_outer)
+        self.analyzer.done = True
+        self.compiled = None
+        self.edit(0, 0, source)
+
+    @property
+    def statements(self):
+        return [chunk.stmt for chunk in self.chunks if chunk.stmt is not None]
+
+    @property
+    def errors(self):
+        """The line each statement that doesn't lex or parse starts on, and why"""
+        return [(chunk.lineno + chunk.text[:len(chunk.text) - len(chunk.text.lstrip())].count('\n'), chunk.error)
+                for chunk in self.chunks if chunk.error is not None]
+
+    def update(self, source):
+        """Changes the source to source, re-analysing the part between what's the same at the start and end"""
+        start = common_prefix_length(source, self.source)
+        end = min(common_prefix_length(source[::-1], self.source[::-1]),
+                  min(len(source), len(self.source)) - start)
+        return self.edit(start, len(self.source) - end, source[start:len(source) - end])
+
+    def edit(self, start, end, text):
+        """Replaces source[start:end] with text"""
+        if not 0 <= start <= end <= len(self.source):
+            raise ValueError(f"Can't replace {start}:{end} of a source {len(self.source)} characters long")
+        delta = len(text) - (end - start)
+        line_delta = text.count('\n') - self.source.count('\n', start, end)
+        self.source = self.source[:start] + text + self.source[end:]
+        self.compiled = None
+
+        # the chunks the edit touches
+        if self.chunks:
+            first = max(bisect_right(self.offsets, start) - 1, 0)
+            stop = max(bisect_right(self.offsets, max(end - 1, start)), first + 1)
+        else:
+            first = stop = 0
+        region_start = self.chunks[first].offset if self.chunks else 0
+        region_lineno = self.chunks[first].lineno if self.chunks else 1
+        region_end = self.chunks[stop - 1].offset + len(self.chunks[stop - 1].text) if self.chunks else 0
+
+        # which grow until the new text ends at a statement boundary, twice as
+        # many chunks at a time so finding a far away one takes linear time
+        grow = 1
+        while True:
+            new_chunks = chunk_region(self.source[region_start:region_end + delta],
+                                      region_start, region_lineno, stop == len(self.chunks))
+            if new_chunks is not None:
+                break
+            for chunk in self.chunks[stop:stop + grow]:
+                region_end += len(chunk.text)
+            stop = min(stop + grow, len(self.chunks))
+            grow *= 2
+
+        old_chunks = self.chunks[first:stop]
+        for chunk in self.chunks[stop:]:
+            chunk.offset += delta
+            chunk.lineno += line_delta
+        self.chunks[first:stop] = new_chunks
+        self.offsets[first:stop] = [chunk.offset for chunk in new_chunks]
+        for i in range(first + len(new_chunks), len(self.chunks)):
+            self.offsets[i] += delta
+
+        rebound = set()
+        for chunk in old_chunks:
+            if chunk.stmt is not None:
+                self.analyzer.remove_statement(chunk.stmt)
+            for name in chunk.uses:
+                self.users[name].discard(chunk)
+            rebound |= chunk.binds
+        for chunk in new_chunks:
+            if chunk.stmt is not None:
+                self.analyzer.add_statement(chunk.stmt)
+            for name in chunk.uses:
+                self.users.setdefault(name, set()).add(chunk)
+            rebound |= chunk.binds
+
+        stale = set()
+        for name in rebound:
+            stale |= self.users.get(name, set())
+        stale -= set(new_chunks)
+        for chunk in stale:
+            chunk.derived.clear()
+
+        return Change([chunk.stmt for chunk in old_chunks if chunk.stmt is not None],
+                      [chunk.stmt for chunk in new_chunks if chunk.stmt is not None],
+                      rebound, sorted(stale, key=lambda chunk: chunk.offset))
+
+    def positioned_statements(self):
+        """The statements, re-lexing the ones that moved so their tokens have the right positions"""
+        stmts = []
+        for chunk in self.chunks:
+            if chunk.error is not None:
+                raise chunk.error
+            if chunk.stmt is None:
+                continue
+            if chunk.lexed_at == (chunk.offset, chunk.lineno):
+                stmts.append(chunk.stmt)
+            else:
+                stmts.extend(parse(lex(chunk.text, chunk.offset, chunk.lineno)))
+        return stmts
+
+    def code(self):
+        """The module's code object, compiled the first time it's asked for after an edit"""
+        if self.compiled is None:
+            self.compiled = calc_ast_to_python_code_object(self.positioned_statements(), self.filename, '<module>')
+        return self.compiled
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,309 @@
+"""
+Inlining: replacing calls to small functions with their bodies.
+
+A function is inlined only where a call to it by name must call that
+function: it's assigned once, by a module-level statement, and nothing else
+anywhere assigns to (or binds a param of) the same name. Call sites are
+only rewritten after that statement, and the program can't contain run or
+compile statements, which could rebind globals behind our back.
+
+Functions whose body is `return expr;` are inlined as that expression
+wherever they're called, with the args substituted for the params when
+that can't change what gets evaluated or in which order: every arg that
+isn't a literal is evaluated exactly as often as before (once, or at least
+once for a variable), in the same order, before anything that could fail.
+Other functions (and those when their args aren't simple enough) are
+inlined at call sites in functions that are statements of their own
+(`x = f(a);`, `f(a);`, `return f(a);`): their params and locals get new
+names, which can't clash with anything because they contain dots, and the
+call becomes assignments of the args, the body, then the use of the
+returned value. At module level those names would be globals, so calls
+there are only inlined as expressions.
+"""
+from collections import Counter
+
+from parse import BinaryOp, UnaryOp, Assignment, If, While, Call, Return, Function, Run, PropAccess, Class, Compile
+from tokens import Token
+from scope_analysis import ScopeAnalyzer, find_all_assigned_names, find_all_variable_lookups
+
+MAX_INLINE_SIZE = 40  # the most nodes a function's body can have to be inlined
+
+def walk(node):
+    """Every node in the tree under node, including node, Tokens and the bodies of functions"""
+    yield node
+    if isinstance(node, Token):
+        return
+    for value in node:
+        if isinstance(value, list):
+            for child in value:
+                yield from walk(child)
+        elif isinstance(value, tuple):
+            yield from walk(value)
+
+def rename(node, names):
+    """A copy of node with variables in names (name -> node) replaced. Doesn't look inside functions."""
+    if isinstance(node, Token):
+        return names.get(node.content, node) if node.kind == 'Variable' else node
+    elif isinstance(node, PropAccess):
+        return node._replace(left=rename(node.left, names))  # the prop isn't a variable
+    elif isinstance(node, Function):
+        return node
+    return type(node)(*[
+        [rename(child, names) for child in value] if isinstance(value, list) else
+        rename(value, names) if isinstance(value, tuple) else value
+        for value in node])
+
+def has_side_effects(node):
+    return any(isinstance(n, (Call, PropAccess, Function)) for n in walk(node))
+
+def evaluation_order(node):
+    """The Variable tokens and the operations in an expression, in the order they're evaluated"""
+    if isinstance(node, Token):
+        return [node] if node.kind == 'Variable' else []
+    elif isinstance(node, BinaryOp):
+        return evaluation_order(node.left) + evaluation_order(node.right) + [node]
+    elif isinstance(node, UnaryOp):
+        return evaluation_order(node.right) + [node]
+    elif isinstance(node, PropAccess):
+        return evaluation_order(node.left) + [node]
+    elif isinstance(node, Call):
+        return (evaluation_order(node.callable) +
+                [n for arg in node.arguments for n in evaluation_order(arg)] + [node])
+    return [node]
+
+def locals_assigned_before_use(stmts, local_names):
+    """
+    Whether on every path through stmts, each read of a name in local_names
+    comes after an assignment to it. Inlined, a local that isn't becomes a
+    variable of the caller that can still hold what it was set to last time
+    (say, in the previous iteration of a loop) where the call would have raised.
+    """
+    def reads_ok(node, assigned):
+        return all(lookup.content in assigned or lookup.content not in local_names
+                   for lookup in find_all_variable_lookups(node))
+
+    def check(stmts, assigned):
+        """The names assigned after stmts on every path, or None if one is read before that"""
+        for stmt in stmts:
+            if isinstance(stmt, If):
+                if not reads_ok(stmt.condition, assigned):
+                    return None
+                body, else_body = check(stmt.body, assigned), check(stmt.else_body, assigned)
+                if body is None or else_body is None:
+                    return None
+                assigned = body & else_body
+            elif isinstance(stmt, While):
+                # later iterations start with at least what the first one did
+                if not reads_ok(stmt.condition, assigned) or check(stmt.body, assigned) is None:
+                    return None
+            elif isinstance(stmt, Assignment):
+                if not reads_ok(stmt.rhs, assigned):
+                    return None
+                if isinstance(stmt.lhs, PropAccess) and not reads_ok(stmt.lhs.left, assigned):
+                    return None
+                if isinstance(stmt.lhs, Token):
+                    assigned = assigned | {stmt.lhs.content}
+            elif isinstance(stmt, Return):
+                if stmt.expression is not None and not reads_ok(stmt.expression, assigned):
+                    return None
+            elif not reads_ok(stmt, assigned):
+                return None
+        return assigned
+
+    return check(stmts, frozenset()) is not None
+
+def count_bindings(stmts):
+    """
+    How many times each name is bound (assigned, or a param, or a class)
+    anywhere in a module, and the names assigned by the module itself.
+    """
+    bindings = Counter()
+    module_globals = set()
+    for stmt in stmts:
+        module_globals.update(find_all_assigned_names(stmt))
+        for node in walk(stmt):
+            if isinstance(node, Assignment) and isinstance(node.lhs, Token):
+                bindings[node.lhs.content] += 1
+            elif isinstance(node, Function):
+                bindings.update(param.content for param in node.params)
+            elif isinstance(node, Class):
+                bindings[node.name.content] += 1
+    return bindings, module_globals
+
+class Inlinable:
+    def __init__(self, name, function, module_globals):
+        self.name = name
+        self.function = function
+        self.params = [param.content for param in function.params]
+        self.locals = set()
+        for stmt in function.body:
+            self.locals.update(find_all_assigned_names(stmt))
+        self.locals -= set(self.params)
+        lookups = {lookup.content for stmt in function.body for lookup in find_all_variable_lookups(stmt)}
+        self.free = lookups - self.locals - set(self.params)
+        self.size = sum(1 for stmt in function.body for _ in walk(stmt))
+
+        body = function.body
+        returns = [n for stmt in body for n in walk(stmt) if isinstance(n, Return)]
+        self.ok = (
+            name not in lookups and  # recursive
+            not any(isinstance(n, (Function, Class, Run, Compile)) for stmt in body for n in walk(stmt)) and
+            # a return anywhere but at the end would need a jump
+            all(r is body[-1] for r in returns) and
+            # in the interpreter, assigning to a name that's also a global assigns to the global
+            not self.locals & module_globals and
+            locals_assigned_before_use(body, self.locals))
+        self.expression = (body[0].expression if len(body) == 1 and isinstance(body[0], Return)
+                           else None)
+
+class Inliner:
+    def __init__(self, stmts, max_size=MAX_INLINE_SIZE):
+        self.max_size = max_size
+        self.analyzer = ScopeAnalyzer()
+        self.analyzer.discover_symbols(stmts)
+        self.inlinable = {}
+        self.renames = 0
+        self.inlined = 0
+
+        self.bindings, self.module_globals = count_bindings(stmts)
+
+    def inline_module(self, stmts):
+        if any(isinstance(n, (Run, Compile)) for stmt in stmts for n in walk(stmt)):
+            return stmts
+        new_stmts = []
+        for stmt in stmts:
+            new_stmts.extend(self.inline_stmt(stmt, frozenset(), in_function=False))
+            if (isinstance(stmt, Assignment) and isinstance(stmt.lhs, Token) and
+                    isinstance(stmt.rhs, Function) and self.bindings[stmt.lhs.content] == 1):
+                name = stmt.lhs.content
+                inlinable = Inlinable(name, new_stmts[-1].rhs, self.module_globals)
+                if inlinable.ok and inlinable.size <= self.max_size:
+                    self.inlinable[name] = inlinable
+        return new_stmts
+
+    def target(self, call, bound):
+        """The Inlinable a call calls, if it can be inlined in a scope that binds the names in bound"""
+        if not (isinstance(call, Call) and isinstance(call.callable, Token) and
+                call.callable.kind == 'Variable'):
+            return None
+        inlinable = self.inlinable.get(call.callable.content)
+        if (inlinable is None or len(call.arguments) != len(inlinable.params) or
+                call.callable.content in bound or inlinable.free & bound):
+            return None
+        return inlinable
+
+    # statements
+
+    def inline_body(self, stmts, bound, in_function):
+        return [new for stmt in stmts for new in self.inline_stmt(stmt, bound, in_function)]
+
+    def inline_stmt(self, stmt, bound, in_function):
+        """Returns the statements to replace stmt with"""
+        if isinstance(stmt, Assignment):
+            rhs = self.inline_expr(stmt.rhs, bound)
+            lhs = stmt.lhs
+            if isinstance(lhs, PropAccess):
+                lhs = lhs._replace(left=self.inline_expr(lhs.left, bound))
+            return self.inline_call_stmt(rhs, bound, in_function, lambda result: Assignment(lhs, result))
+        elif isinstance(stmt, Return):
+            expression = self.inline_expr(stmt.expression, bound)
+            return self.inline_call_stmt(expression, bound, in_function, Return)
+        elif isinstance(stmt, If):
+            return [If(self.inline_expr(stmt.condition, bound),
+                       self.inline_body(stmt.body, bound, in_function),
+                       self.inline_body(stmt.else_body, bound, in_function))]
+        elif isinstance(stmt, While):
+            return [While(self.inline_expr(stmt.condition, bound),
+                          self.inline_body(stmt.body, bound, in_function))]
+        elif isinstance(stmt, (Class, Run, Compile)):
+            return [stmt]
+        else:
+            expression = self.inline_expr(stmt, bound)
+            return self.inline_call_stmt(expression, bound, in_function, lambda result: result,
+                                         result_needed=False)
+
+    def inline_call_stmt(self, expression, bound, in_function, make_stmt, result_needed=True):
+        # at module level the renamed params and locals would be globals, which would
+        # show up in the module and keep the args alive as long as it's around
+        inlinable = self.target(expression, bound) if in_function else None
+        if inlinable is None:
+            return [make_stmt(expression)]
+        body = inlinable.function.body
+        has_result = bool(body) and isinstance(body[-1], Return)
+        if result_needed and not has_result:
+            return [make_stmt(expression)]  # we'd need a None to assign or return
+
+        self.renames += 1
+        # the new variables get the position of the call
+        names = {name: expression.callable._replace(content=f'{inlinable.name}.{name}.{self.renames}')
+                 for name in inlinable.params + sorted(inlinable.locals)}
+        stmts = [Assignment(names[param], arg) for param, arg in zip(inlinable.params, expression.arguments)]
+        stmts.extend(rename(stmt, names) for stmt in (body[:-1] if has_result else body))
+        if has_result:
+            result = rename(body[-1].expression, names)
+            if result_needed or has_side_effects(result):
+                stmts.append(make_stmt(result))
+        self.inlined += 1
+        return stmts
+
+    # expressions
+
+    def inline_expr(self, node, bound):
+        if isinstance(node, BinaryOp):
+            return node._replace(left=self.inline_expr(node.left, bound),
+                                 right=self.inline_expr(node.right, bound))
+        elif isinstance(node, UnaryOp):
+            return node._replace(right=self.inline_expr(node.right, bound))
+        elif isinstance(node, PropAccess):
+            return node._replace(left=self.inline_expr(node.left, bound))
+        elif isinstance(node, Function):
+            table = self.analyzer[node]
+            inner_bound = (table.local_vars | table.cell_vars | set(table.free_vars) |
+                           {param.content for param in node.params})
+            return node._replace(body=self.inline_body(node.body, frozenset(inner_bound), in_function=True))
+        elif isinstance(node, Call):
+            node = node._replace(callable=self.inline_expr(node.callable, bound),
+                                 arguments=[self.inline_expr(arg, bound) for arg in node.arguments])
+            inlined = self.inline_call_expr(node, bound)
+            return node if inlined is None else inlined
+        return node
+
+    def inline_call_expr(self, call, bound):
+        inlinable = self.target(call, bound)
+        if inlinable is None or inlinable.expression is None:
+            return None
+        expression = inlinable.expression
+        order = evaluation_order(expression)
+        calls_in_body = any(isinstance(n, (Call, PropAccess)) for n in order)
+        uses = [n.content for n in order if isinstance(n, Token) and n.content in inlinable.params]
+        # args other than literals can fail (1 / z, an undefined variable), so they have to
+        # be evaluated in the same order as before, before anything else that could fail
+        evaluated = []
+        for param, arg in zip(inlinable.params, call.arguments):
+            if isinstance(arg, Token) and arg.kind in ('Number', 'String'):
+                continue
+            if calls_in_body or has_side_effects(arg):
+                return None
+            if not isinstance(arg, Token) and uses.count(param) > 1:
+                return None  # it would be evaluated twice
+            evaluated.append(param)
+        if evaluated:
+            if list(dict.fromkeys(param for param in uses if param in evaluated)) != evaluated:
+                return None  # an arg wouldn't be evaluated at all, or out of order
+            last = next(i for i, n in enumerate(order) if isinstance(n, Token) and n.content == evaluated[-1])
+            if any(not isinstance(n, Token) or n.content not in inlinable.params for n in order[:last]):
+                return None  # an operation or a global lookup would come first
+        self.inlined += 1
+        return rename(expression, dict(zip(inlinable.params, call.arguments)))
+
+def inline_functions(stmts, max_size=MAX_INLINE_SIZE):
+    """
+    Returns the statements with calls to small functions replaced by their bodies.
+
+    >>> from parse import parse
+    >>> from tokens import tokenize
+    >>> stmts = inline_functions(parse(tokenize('sq = (x) => return x * x; end; a = sq(3) + 1;')))
+    >>> stmts[1].rhs.left
+    BinaryOp(left=Token(kind='Number', content=3), op=Token(kind='Star'), right=Token(kind='Number', content=3))
+    """
+    return Inliner(stmts, max_size).inline_module(stmts)
@@ -0,0 +1,115 @@
+"""
+Wall time, call counts and sizes of the phases of the pipeline: tokenize,
+parse, scope analysis, codegen, assembling code objects and execution.
+
+Functions that do a phase are decorated with @phase. While instrumentation
+is off (the default) the decorator's wrapper only checks a flag before
+calling the function, and phases are whole-source or whole-program steps,
+so that's around a microsecond (see benchmarks.py instrumentation) on work
+taking a lot longer than that.
+
+Turn it on by setting CALC_INSTRUMENT to the file the JSON report should be
+written to when the process exits ('-' for stderr), by passing --instrument
+FILE to debugrepl.py, or by calling enable(). A phase's time includes any
+phases it does on the way, like the tokenizing and parsing of a program
+started by a run statement, which counts towards both tokenize and the
+execute of the program with the run statement in it. Work done in other
+processes (precompile.py and linter.py's workers) isn't counted.
+
+    >>> enable()
+    >>> reset()
+    >>> from tokens import tokenize
+    >>> tokens = tokenize('a = 1;')
+    >>> phases['tokenize'].calls, phases['tokenize'].size
+    (1, 6)
+    >>> disable()
+"""
+import atexit
+import functools
+import json
+import os
+import sys
+import time
+
+enabled = False
+phases = {}  # name -> Phase, in the order the phases were declared
+enabled_at = None
+
+class Phase:
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit  # of size
+        self.calls = 0
+        self.seconds = 0.0
+        self.size = 0  # of the input of all the calls
+        self.depth = 0  # calls of this phase in progress, only the outermost is timed
+
+    def as_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds, 'size': self.size, 'unit': self.unit}
+
+def phase(name, unit, size):
+    """
+    Decorator recording calls of a function as the phase name. size is
+    called with the same arguments and says how much work a call is, in unit.
+    """
+    p = phases.setdefault(name, Phase(name, unit))
+    def decorate(f):
+        @functools.wraps(f)
+        def instrumented(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            p.calls += 1
+            p.size += size(*args, **kwargs)
+            if p.depth:
+                return f(*args, **kwargs)
+            p.depth += 1
+            t0 = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                p.seconds += time.perf_counter() - t0
+                p.depth -= 1
+        return instrumented
+    return decorate
+
+def enable(report_path=None):
+    """Starts recording, and writes the report to report_path when the process exits if given"""
+    global enabled, enabled_at
+    enabled = True
+    if enabled_at is None:
+        enabled_at = time.perf_counter()
+    if report_path is not None:
+        atexit.register(write_report, report_path)
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    global enabled_at
+    enabled_at = time.perf_counter() if enabled else None
+    for p in phases.values():
+        p.calls, p.seconds, p.size = 0, 0.0, 0
+
+def report():
+    return {
+        'argv': sys.argv,
+        'pid': os.getpid(),
+        'seconds': time.perf_counter() - enabled_at if enabled_at is not None else 0.0,
+        'phases': {name: p.as_dict() for name, p in phases.items()},
+    }
+
+def write_report(path):
+    if path == '-':
+        json.dump(report(), sys.stderr, indent=2)
+        sys.stderr.write('\n')
+    else:
+        with open(path, 'w') as f:
+            json.dump(report(), f, indent=2)
+
+if os.environ.get('CALC_INSTRUMENT'):
+    enable(os.environ['CALC_INSTRUMENT'])
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
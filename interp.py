@@ -1,5 +1,11 @@
 from parse import BinaryOp, UnaryOp, pprint_tree, parse, Assignment, If, While, Call, Return, Function, Run, PropAccess, Class, Compile
 from tokens import Token, tokenize
+from scope_analysis import ScopeAnalyzer
+from typeinfer import infer_types, FunctionType
+from inline import inline_functions
+from memoize import MemoCache, find_pure_functions
+from instrument import phase
+import operator
 import time
 
 def num2words(n):
@@ -9,18 +15,18 @@ def num2words(n):
 DEBUG = False
 
 binary_op_funcs = {
-    'Plus': lambda x, y: x+y,
-    'Minus': lambda x, y: x-y,
-    'Star': lambda x, y: x*y,
-    'Slash': lambda x, y: x/y,
-    'Percent': lambda x, y: x%y,
-    'Greater': lambda x, y: x > y,
-    'Less': lambda x, y: x < y,
-    'Equals Equals': lambda x, y: x == y,
+    'Plus': operator.add,
+    'Minus': operator.sub,
+    'Star': operator.mul,
+    'Slash': operator.truediv,
+    'Percent': operator.mod,
+    'Greater': operator.gt,
+    'Less': operator.lt,
+    'Equals Equals': operator.eq,
 }
 unary_op_funcs = {
-    'plus': lambda x: x,
-    'minus': lambda x: -x,
+    'Plus': lambda x: x,
+    'Minus': lambda x: -x,
 }
 builtin_funcs = {
     'print': lambda x: (print(x), x)[1],
@@ -35,24 +41,41 @@ class CalcReturnException(Exception):
 class CantFindVariable(KeyError): pass
 
 class Scope:
+    """Variables of the module (or REPL session), of builtins, and of class bodies"""
     def create_child_scope(self):
         return Scope(parent=self)
 
     def __init__(self, parent=None):
         self.bindings = {}
         self.parent = parent
+        # the Program the code run here is from, and where its globals live
+        self.program = parent.program if parent is not None else None
+        self.global_scope = parent.global_scope if parent is not None else None
 
     def get(self, name):
         cur = self
-        while cur is not None:
+        while isinstance(cur, Scope):
             if name in cur.bindings:
                 return cur.bindings[name]
             cur = cur.parent
+        if cur is not None:
+            return cur.get(name)  # a class body in a function, continue in the Frame
         raise CantFindVariable(f"Name '{name}' not found in scopes")
 
+    def find(self, name):
+        """The scope in this chain that binds name, or None"""
+        cur = self
+        while isinstance(cur, Scope):
+            if name in cur.bindings:
+                return cur
+            cur = cur.parent
+        if cur is not None and cur.defines(name):
+            return cur
+        return None
+
     def set(self, name, value):
         cur, i = self, 0
-        while cur is not None:
+        while isinstance(cur, Scope):
             if name in cur.bindings:
                 if DEBUG:
                     if i == 0: scope = 'local scope'
@@ -62,32 +85,137 @@ class Scope:
                 cur.bindings[name] = value
                 return
             cur, i = cur.parent, i + 1
+        if cur is not None and cur.defines(name):
+            cur.set(name, value)
+            return
 
         # create new variable if none found
         if DEBUG:
             print('creating new variable', name, 'in local scope and setting to', value)
         self.bindings[name] = value
 
+    def cell_for(self, name):
+        return self.parent.cell_for(name)
+
     def __repr__(self):
         if self.parent is None:
             return f"Scope({repr(self.bindings)})"
         else:
             return f"Scope({repr(self.bindings)}, parent=\n{repr(self.parent)})"
 
+class Cell:
+    """A variable shared between a Frame and the closures created in it"""
+    __slots__ = ('contents',)
+
+class Frame:
+    """
+    The variables of one call of a Closure.
+
+    Variables that no nested function uses live in a plain dict, the ones
+    that are used by nested functions live in Cells shared with their
+    closures, and everything else is looked up in the global scope.
+    Closures only keep the cells they need, not the Frame, so a Frame can be
+    collected as soon as its call returns.
+    """
+    def __init__(self, closure):
+        self.symbol_table = closure.symbol_table
+        self.program = closure.program
+        self.global_scope = closure.global_scope
+        self.locals = {}
+        self.cells = dict(closure.cells)
+        for name in self.symbol_table.cell_vars:
+            self.cells[name] = Cell()
+
+    def get(self, name):
+        if name in self.locals:
+            return self.locals[name]
+        if name in self.cells:
+            try:
+                return self.cells[name].contents
+            except AttributeError:
+                raise CantFindVariable(f"Name '{name}' used before it was set")
+        return self.global_scope.get(name)
+
+    def defines(self, name):
+        return (name in self.locals or name in self.cells or
+                self.global_scope.find(name) is not None)
+
+    def declare(self, name, value):
+        """Sets a param, which is always a local (or cell) variable"""
+        if name in self.cells:
+            self.cells[name].contents = value
+        else:
+            self.locals[name] = value
+
+    def set(self, name, value):
+        # As in Scope.set, assigning to a variable that already exists in the
+        # global scope changes that variable rather than creating a local one.
+        if name in self.cells:
+            self.cells[name].contents = value
+        elif name not in self.locals and self.global_scope.find(name) is not None:
+            self.global_scope.set(name, value)
+        else:
+            self.locals[name] = value
+
+    def cell_for(self, name):
+        return self.cells[name]
+
+    def create_child_scope(self):
+        return Scope(parent=self)
+
+    def __repr__(self):
+        cells = {name: getattr(cell, 'contents', '<unset>') for name, cell in self.cells.items()}
+        return f"Frame(locals={self.locals!r}, cells={cells!r})"
+
+class Program:
+    """
+    The statements one call of execute_program runs: their symbol tables, and
+    the side tables the interpreter keeps about their nodes. Scopes, Frames and
+    Closures point to the Program their code is from, so the side tables are
+    freed along with the last closure that could still use them.
+    """
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        self.prop_caches = {}  # id(PropAccess node) -> PropCache
+        self.specialized_calls = {}  # id(Call node) -> (node, the Function node it always calls)
+        self.pure_functions = {}  # id(Function node) -> node, for functions whose closures memoize their results
+
 class Closure:
     """Code and state, living happily together."""
-    def __init__(self, function_ast, parent_scope):
+    def __init__(self, function_ast, variables):
         self.function_ast = function_ast
-        self.parent_scope = parent_scope
+        self.program = variables.program
+        self.symbol_table = variables.program.analyzer[function_ast]
+        self.global_scope = variables.global_scope
+        # only the variables we use from enclosing functions, not their whole Frames
+        self.cells = {name: variables.cell_for(name) for name in self.symbol_table.free_vars}
+        # each Python frame a call goes through (and each call with *args) is one less
+        # level of calc recursion, so memoized calls only add the MemoCache's
+        self.memo = (MemoCache(self.execute_checked, tuple_args=True)
+                     if id(function_ast) in self.program.pure_functions else None)
+
+    def __call__(self, *args):
+        """For compiled code, which calls functions the interpreter made like Python functions"""
+        return self.execute(args)
 
     def execute(self, args):
+        """Returns what the function returns"""
         if len(args) != len(self.function_ast.params):
             raise ValueError("bad arity")
-        new_scope = self.parent_scope.create_child_scope()
+        if self.memo is not None:
+            return self.memo(*args)
+        return self.execute_checked(args)
+
+    def execute_checked(self, args):
+        """Runs the body and returns what it returns, for callers that already know the number of args is right"""
+        frame = Frame(self)
         for param, arg in zip(self.function_ast.params, args):
-            new_scope.set(param.content, arg)
-        for stmt in self.function_ast.body:
-            execute(stmt, new_scope)
+            frame.declare(param.content, arg)
+        try:
+            for stmt in self.function_ast.body:
+                execute(stmt, frame)
+        except CalcReturnException as e:
+            return e.value
         return None
 
 class MethodWrapper:
@@ -100,30 +228,216 @@ class MethodWrapper:
         return self.func.execute(all_args)
 
 
+class Shape:
+    """
+    A hidden class: which index of an instance's values holds each prop.
+
+    Instances that were given the same props in the same order share a shape,
+    so the per-node PropCaches below can remember where a prop lives for every
+    instance with that shape, and instances don't each need a dict.
+    """
+    __slots__ = ('slots', 'transitions')
+
+    def __init__(self, slots):
+        self.slots = slots  # prop name -> index into Instance.values
+        self.transitions = {}  # prop name -> shape with that prop added
+
+    def with_prop(self, name):
+        if name not in self.transitions:
+            slots = dict(self.slots)
+            slots[name] = len(slots)
+            self.transitions[name] = Shape(slots)
+        return self.transitions[name]
+
+EMPTY_SHAPE = Shape({})
+
+# bumped whenever a prop is assigned on a class, which could change what
+# cached lookups through the extends chain should find
+class_version = 0
+
 class ClassObj:
     def __init__(self, name, scope, extends=None):
         self.name = name
         self.scope = scope
         self.extends = extends
+
+    def find_owner(self, name):
+        """The class in the extends chain that defines name"""
+        cls = self
+        while cls is not None:
+            if name in cls.scope.bindings:
+                return cls
+            cls = cls.extends
+        raise CantFindVariable(f"Prop '{name}' not found on class {self.name}")
+
     def prop_access(self, name):
-        raise ValueError("Don't know how to get props on class")
+        return self.find_owner(name).scope.bindings[name]
+
     def prop_assign(self, name, value):
-        raise ValueError("Don't know how to assign to class")
+        global class_version
+        class_version += 1
+        self.scope.bindings[name] = value
+
     def create_instance(self):
-        raise ValueError("Don't know how to create instance")
+        return Instance(self)
 
-    def get_for_instance(self, instance):
-        return 
+    def __repr__(self):
+        return f"<class {self.name}>"
 
 class Instance:
+    __slots__ = ('cls', 'shape', 'values')
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.shape = EMPTY_SHAPE
+        self.values = []
+
     def prop_access(self, name):
-        raise ValueError("Don't know how to get prop on instance")
+        slot = self.shape.slots.get(name)
+        if slot is not None:
+            return self.values[slot]
+        return bind_method(self.cls.prop_access(name), self)
+
     def prop_assign(self, name, value):
-        raise ValueError("Don't know how to assign to instance")
+        slot = self.shape.slots.get(name)
+        if slot is not None:
+            self.values[slot] = value
+        else:
+            self.shape = self.shape.with_prop(name)
+            self.values.append(value)
+
+    def __repr__(self):
+        props = ', '.join(f'{name}={self.values[slot]!r}' for name, slot in self.shape.slots.items())
+        return f"<{self.cls.name} instance {props}>"
+
+def bind_method(value, instance):
+    if isinstance(value, Closure):
+        return MethodWrapper(value, instance)
+    return value
+
+PROP_CACHES = True  # set to False to compare against uncached prop lookups
+
+class PropCache:
+    """
+    A monomorphic inline cache for one PropAccess node, valid for instances of one shape.
+
+    For props stored on the instance it remembers the slot, for props found on
+    the class it remembers which class in the extends chain defines them, and
+    for assignments that add a prop it remembers the shape to transition to.
+    """
+    __slots__ = ('node', 'shape', 'slot', 'cls', 'owner', 'version', 'next_shape')
+
+    def __init__(self, node):
+        self.node = node  # keeps id(node) from being reused while we're cached under it
+        self.shape = None
+
+def get_prop_cache(node, program):
+    cache = program.prop_caches.get(id(node))
+    if cache is None:
+        cache = program.prop_caches[id(node)] = PropCache(node)
+    return cache
+
+def evaluate_prop_access(node, obj, program):
+    name = node.prop.content
+    if not isinstance(obj, Instance):
+        if isinstance(obj, ClassObj):
+            return obj.prop_access(name)
+        return getattr(obj, name)  # a Python object
+    if not PROP_CACHES:
+        return obj.prop_access(name)
+
+    cache = get_prop_cache(node, program)
+    if cache.shape is obj.shape:
+        if cache.slot is not None:
+            return obj.values[cache.slot]
+        if cache.cls is obj.cls and cache.version == class_version:
+            return bind_method(cache.owner.scope.bindings[name], obj)
+
+    cache.shape = obj.shape
+    cache.slot = obj.shape.slots.get(name)
+    cache.next_shape = None
+    if cache.slot is not None:
+        return obj.values[cache.slot]
+    cache.cls, cache.version = obj.cls, class_version
+    cache.owner = obj.cls.find_owner(name)
+    return bind_method(cache.owner.scope.bindings[name], obj)
+
+def assign_prop(node, obj, value, program):
+    name = node.prop.content
+    if not isinstance(obj, Instance):
+        if isinstance(obj, ClassObj):
+            return obj.prop_assign(name, value)
+        return setattr(obj, name, value)  # a Python object
+    if not PROP_CACHES:
+        return obj.prop_assign(name, value)
+
+    cache = get_prop_cache(node, program)
+    if cache.shape is obj.shape:
+        if cache.next_shape is not None:
+            obj.shape = cache.next_shape
+            obj.values.append(value)
+            return
+        if cache.slot is not None:
+            obj.values[cache.slot] = value
+            return
+
+    cache.shape = obj.shape
+    cache.slot = obj.shape.slots.get(name)
+    cache.next_shape = None
+    obj.prop_assign(name, value)
+    if cache.slot is None:
+        cache.next_shape = obj.shape
 
-def execute_program(stmts, variables):
-    for stmt in stmts:
-        execute(stmt, variables)
+# Off by default: the whole-program type inference it needs runs before every
+# program, REPL entry and run statement, and can take seconds on long call
+# chains, while a specialized call only skips an arity check.
+TYPE_SPECIALIZATION = False  # set to True to specialize the calls type inference proves
+
+def specialize(stmts, program):
+    """
+    Records cheaper ways to evaluate the nodes whose types were proven by type inference.
+
+    A specialization never changes what a node evaluates to: a call only
+    skips its dispatch and arity check after checking it got the expected
+    closure. So types that turn out wrong (e.g. a REPL session rebinding a
+    global an earlier program's types were inferred with) only cost speed.
+    """
+    types = infer_types(stmts, program.analyzer)
+    for node in types.nodes.values():
+        if isinstance(node, Call):
+            callee_type = types.type_of(node.callable)
+            if isinstance(callee_type, FunctionType) and len(node.arguments) == len(callee_type.node.params):
+                program.specialized_calls[id(node)] = (node, callee_type.node)
+
+INLINING = True  # set to False to never inline functions
+MEMOIZATION = True  # set to False to never memoize pure functions
+
+@phase('execute', 'statements', lambda stmts, *args, **kwargs: len(stmts))
+def execute_program(stmts, variables, whole_program=False):
+    """
+    Runs statements in variables. Pass whole_program=True only if no other code
+    can rebind the globals of stmts, which isn't true of REPL input or of
+    programs started by a run statement: inlining and memoization rely on it.
+    """
+    if whole_program and INLINING:
+        stmts = inline_functions(stmts)
+    analyzer = ScopeAnalyzer(assignments_rebind_outer=True)
+    analyzer.discover_symbols(stmts)
+    program = Program(analyzer)
+    if whole_program and MEMOIZATION:
+        for stmt in find_pure_functions(stmts):
+            program.pure_functions[id(stmt.rhs)] = stmt.rhs
+    if TYPE_SPECIALIZATION:
+        specialize(stmts, program)
+    if variables.global_scope is None:
+        variables.global_scope = variables
+    # a program run by a run statement has its own symbol tables and side tables
+    orig_program, variables.program = variables.program, program
+    try:
+        for stmt in stmts:
+            execute(stmt, variables)
+    finally:
+        variables.program = orig_program
 
 def execute(stmt, variables):
     if isinstance(stmt, (BinaryOp, UnaryOp, Token, Call)):
@@ -133,7 +447,7 @@ def execute(stmt, variables):
         value = evaluate(stmt.rhs, variables)
         if isinstance(stmt.lhs, PropAccess):
             left = evaluate(stmt.lhs.left, variables)
-            left.prop_set(value)
+            assign_prop(stmt.lhs, left, value, variables.program)
         elif stmt.lhs.kind == 'Variable':
             variables.set(stmt.lhs.content, value)
         else:
@@ -164,10 +478,11 @@ def execute(stmt, variables):
         raise CalcReturnException(value)
     elif isinstance(stmt, Class):
         cls_variables = variables.create_child_scope()
-        cls = ClassObj(stmt.name, cls_variables, stmt.extends)
+        extends = variables.get(stmt.extends.content) if stmt.extends else None
+        cls = ClassObj(stmt.name.content, cls_variables, extends)
         for s in stmt.body:
             execute(s, cls_variables)
-        print('seting', stmt.name, ' to', cls)
+        if DEBUG: print('setting', stmt.name.content, 'to', cls)
         variables.set(stmt.name.content, cls)
 
 def evaluate(node, variables):
@@ -185,22 +500,26 @@ def evaluate(node, variables):
     elif isinstance(node, Function):
         return Closure(node, variables)
     elif isinstance(node, PropAccess):
-        raise ValueError("Don't know how to evaluate PropAccess")
+        return evaluate_prop_access(node, evaluate(node.left, variables), variables.program)
     elif isinstance(node, Call):
         f = evaluate(node.callable, variables)
         args = [evaluate(expr, variables) for expr in node.arguments]
+        specialized = variables.program.specialized_calls.get(id(node))
+        if specialized is not None and type(f) is Closure and f.function_ast is specialized[1]:
+            return f.memo(*args) if f.memo is not None else f.execute_checked(args)
         if type(f) == type(lambda: None):
             return f(*args)
         elif isinstance(f, Closure):
-            try:
-                f.execute(args)
-            except CalcReturnException as e:
-                return e.value
-            else:
-                return None
-        elif isinstance(f, Class):
+            # not f.execute(args), which would be one more Python frame per calc call
+            if len(args) != len(f.function_ast.params):
+                raise ValueError("bad arity")
+            return f.memo(*args) if f.memo is not None else f.execute_checked(args)
+        elif isinstance(f, MethodWrapper):
+            return f.execute(args)
+        elif isinstance(f, ClassObj):
             return f.create_instance()
-            raise ValueError("Don't know how to call a class")
+        elif callable(f):
+            return f(*args)  # e.g. a method of a Python object
         else:
             raise ValueError("Don't know how to evaluate: {}".format(node))
 
@@ -236,5 +555,5 @@ def run_program(source, with_scope=None):
         for name in builtin_funcs:
             builtin_scope.set(name, builtin_funcs[name])
         variables = builtin_scope.create_child_scope()
-    execute_program(stmts, variables)
+    execute_program(stmts, variables, whole_program=not with_scope)
 
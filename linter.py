@@ -1,36 +1,322 @@
-from parse import BinaryOp, UnaryOp, pprint_tree, parse, Assignment, Token, start_end
-
-def lint(node):
-    """Returns True if there was a problem"""
-    # TODO: make this function lint for something more useful!
-    # Returns True if there's a 7 anywhere
-    if isinstance(node, Token):
-        if node.kind == 'Number' and node.content == 7:
-            return (node.start, node.end)
-    elif isinstance(node, BinaryOp):
-        sevens_on_left = lint(node.left)
-        sevens_on_right = lint(node.right)
-        return sevens_on_left or sevens_on_right
+"""
+A linter made of rules. Each rule has visit_<node type> methods for the
+kinds of node it checks, and one walk over a module calls the visitors of
+every rule on each node, so adding a rule doesn't add a pass over the AST.
+The walk keeps track of the function or class each node is in and looks up
+its symbol table, so rules can ask scope analysis where a name comes from.
+
+Linting a directory spreads the files over a pool of worker processes, and
+what was found in each file is cached under the hash of its source, so a
+file is only linted again when it (or the set of rules) changes.
+
+    python linter.py PATH [PATH ...] [-j WORKERS] [--cache-dir DIR] [--no-cache] [-r RULE ...]
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from parse import (BinaryOp, UnaryOp, Assignment, If, While, Call, Return, Function,
+                   Class, PropAccess, Run, Compile, Token, parse, SpanTable, find_span)
+from tokens import tokenize
+from scope_analysis import ScopeAnalyzer
+from incremental import split_statements
+from interp import builtin_funcs
+import importhack
+import precompile
+
+Problem = namedtuple('Problem', ['rule', 'message', 'start', 'end', 'lineno'])
+LintResult = namedtuple('LintResult', ['path', 'status', 'problems', 'error'])
+
+LINT_VERSION = 1  # bump when rules change what they find, to invalidate cached results
+DEFAULT_CACHE_DIR = '.calclint'
+
+rules = {}  # rule name -> Rule subclass
+
+def rule(name):
+    """Class decorator registering a Rule under name"""
+    def register(cls):
+        cls.name = name
+        rules[name] = cls
+        return cls
+    return register
+
+class Rule:
+    """
+    Subclasses define visit_BinaryOp, visit_Token etc. methods, which are
+    called with each node of that type and the Walk, and can override finish
+    for checks that need to have seen the whole module. A new instance lints
+    each module, so rules can keep what they've seen on self.
+    """
+    name = None
+
+    def finish(self, walk):
+        pass
+
+class Walk:
+    """Where the walk is, and the problems found so far"""
+    def __init__(self, stmts, spans=None, assignments_rebind_outer=True):
+        self.stmts = stmts
+        self.spans = spans
+        self.analyzer = ScopeAnalyzer(assignments_rebind_outer)
+        self.analyzer.discover_symbols(stmts)
+        self.scope = None  # the innermost function or class the current node is in
+        self.rule = None
+        self.problems = []
+
+    def is_global(self, name):
+        """Whether looking up name in the current scope finds a global"""
+        return self.scope is None or name in self.analyzer[self.scope].global_vars
+
+    def span(self, node):
+        span = self.spans.get(node) if self.spans is not None else None
+        return span if span is not None else find_span(node)
+
+    def report(self, node, message, last=None):
+        """Adds a problem with node, or with everything from node to last"""
+        span = self.span(node)
+        end = self.span(last).end if last is not None else span.end
+        self.problems.append(Problem(self.rule.name, message, span.start, end, span.lineno))
+
+def expression_children(node):
+    """
+    The nodes the walk visits inside node, in source order. Tokens are only
+    visited where they're expressions, so a Variable token is always a lookup.
+    """
+    if isinstance(node, BinaryOp):
+        return [node.left, node.right]
     elif isinstance(node, UnaryOp):
-        sevens_on_right = lint(node.right)
-        return sevens_on_right
-
-def lint_program(stmts, source):
-    for stmt in stmts:
-        expr_start, expr_end = start_end(stmt)
-        if isinstance(stmt, (BinaryOp, UnaryOp, Token)):
-            problem = lint(stmt)
-        elif isinstance(stmt, Assignment):
-            problem = lint(stmt.expression)
-
-        if problem:
-            start, end = problem
-            excerpt = source[start:end]
-            front_context = source[start-5:start]
-            back_context = source[end:start+5]
-            nl = '\n'
-            print('problem with expression', source[expr_start:expr_end])
-            print(
-                         f"{front_context}{excerpt}{back_context}{nl}"
-               f"{' '* len(front_context)}{'^'*len(excerpt)}{nl}"
-                "problem found in this expression!")
+        return [node.right]
+    elif isinstance(node, Assignment):
+        # assigning to a variable doesn't look it up, assigning to a prop does look up its object
+        return ([node.lhs] if isinstance(node.lhs, PropAccess) else []) + [node.rhs]
+    elif isinstance(node, If):
+        return [node.condition] + node.body + node.else_body
+    elif isinstance(node, While):
+        return [node.condition] + node.body
+    elif isinstance(node, Call):
+        return [node.callable] + node.arguments
+    elif isinstance(node, Return):
+        return [node.expression] if node.expression is not None else []
+    elif isinstance(node, Function):
+        return node.body
+    elif isinstance(node, Class):
+        return node.body  # the base class is looked up outside, see walk()
+    elif isinstance(node, PropAccess):
+        return [node.left]
+    elif isinstance(node, (Token, Run, Compile)):
+        return []
+    raise ValueError(f"what is this: {repr(node)}")
+
+def lint_statements(stmts, spans=None, rule_names=None):
+    """
+    The problems the rules (all of them unless rule_names says which) find
+    in a module, in the order they appear in the source.
+    """
+    walk = Walk(stmts, spans)
+    checks = [rules[name]() for name in (rule_names or sorted(rules))]
+    visitors = {}  # node type -> (rule, visit method) of the rules that visit it
+    for node_type in (BinaryOp, UnaryOp, Assignment, If, While, Call, Return, Function,
+                      Class, PropAccess, Run, Compile, Token):
+        visitors[node_type] = [(check, getattr(check, 'visit_' + node_type.__name__))
+                               for check in checks if hasattr(check, 'visit_' + node_type.__name__)]
+
+    # an explicit stack, so deeply nested code doesn't hit the recursion limit
+    todo = [(stmt, None) for stmt in reversed(stmts)]
+    while todo:
+        node, scope = todo.pop()
+        walk.scope = scope
+        for check, visit in visitors[type(node)]:
+            walk.rule = check
+            visit(node, walk)
+        inner_scope = node if isinstance(node, (Function, Class)) else scope
+        todo.extend((child, inner_scope) for child in reversed(expression_children(node)))
+        if isinstance(node, Class) and node.extends is not None:
+            todo.append((node.extends, scope))
+
+    walk.scope = None
+    for check in checks:
+        walk.rule = check
+        check.finish(walk)
+    return sorted(walk.problems, key=lambda problem: (problem.start, problem.rule))
+
+def lint_source(source, rule_names=None):
+    # parsing statements one at a time takes linear time, parse() quadratic
+    spans = SpanTable()
+    statements, rest = split_statements(tokenize(source))
+    stmts = [stmt for stmt_tokens in statements + [rest] for stmt in parse(stmt_tokens, spans)]
+    return lint_statements(stmts, spans, rule_names)
+
+@rule('unused-variable')
+class UnusedVariable(Rule):
+    """Variables of a function that are assigned to and never looked up"""
+    def __init__(self):
+        self.assignments = {}  # (id(function), name) -> (function, first assignment to name in it)
+        self.used = set()  # (id(function), name) of lookups
+        self.globals = set()
+
+    def visit_Assignment(self, node, walk):
+        if isinstance(walk.scope, Function) and isinstance(node.lhs, Token):
+            self.assignments.setdefault((id(walk.scope), node.lhs.content), (walk.scope, node))
+        elif walk.scope is None and isinstance(node.lhs, Token):
+            self.globals.add(node.lhs.content)
+
+    def visit_Token(self, node, walk):
+        if node.kind == 'Variable' and walk.scope is not None:
+            self.used.add((id(walk.scope), node.content))
+
+    def finish(self, walk):
+        for key, (function, assignment) in self.assignments.items():
+            # names looked up by nested functions are cell vars instead of locals, and
+            # the interpreter assigns to a global of the same name if there is one
+            name = assignment.lhs.content
+            if key not in self.used and name in walk.analyzer[function].local_vars and name not in self.globals:
+                walk.report(assignment, f"{name} is assigned to but never used")
+
+@rule('unreachable-code')
+class UnreachableCode(Rule):
+    """Statements after a return, or after an if that returns from both branches"""
+    def check(self, stmts, walk):
+        for i, stmt in enumerate(stmts[:-1]):
+            if always_returns(stmt):
+                walk.report(stmts[i + 1], "this code is never run", stmts[-1])
+                return
+
+    def visit_Function(self, node, walk):
+        self.check(node.body, walk)
+
+    def visit_If(self, node, walk):
+        self.check(node.body, walk)
+        self.check(node.else_body, walk)
+
+    def visit_While(self, node, walk):
+        self.check(node.body, walk)
+
+def always_returns(stmt):
+    if isinstance(stmt, Return):
+        return True
+    if isinstance(stmt, If):
+        return (any(always_returns(s) for s in stmt.body) and
+                any(always_returns(s) for s in stmt.else_body))
+    return False
+
+@rule('undefined-global')
+class UndefinedGlobal(Rule):
+    """Globals looked up that no module-level statement assigns and that aren't builtins"""
+    def __init__(self):
+        self.defined = set(builtin_funcs)
+        self.lookups = []
+        self.runs_other_programs = False
+
+    def visit_Assignment(self, node, walk):
+        if walk.scope is None and isinstance(node.lhs, Token):
+            self.defined.add(node.lhs.content)
+
+    def visit_Class(self, node, walk):
+        if walk.scope is None:
+            self.defined.add(node.name.content)
+
+    def visit_Token(self, node, walk):
+        if node.kind == 'Variable' and walk.is_global(node.content):
+            self.lookups.append(node)
+
+    def visit_Run(self, node, walk):
+        self.runs_other_programs = True
+
+    visit_Compile = visit_Run
+
+    def finish(self, walk):
+        if self.runs_other_programs:
+            return  # the program run could define anything
+        for lookup in self.lookups:
+            if lookup.content not in self.defined:
+                walk.report(lookup, f"{lookup.content} is never defined")
+
+def lint_program(stmts, source, spans=None):
+    """Prints the problems in a module with the code they're in"""
+    for problem in lint_statements(stmts, spans):
+        # just the line the problem starts on, so the carets line up
+        excerpt = source[problem.start:problem.end].split('\n')[0]
+        front_context = source[max(problem.start - 5, 0):problem.start].split('\n')[-1]
+        back_context = source[problem.start + len(excerpt):][:5].split('\n')[0]
+        nl = '\n'
+        print(f'line {problem.lineno}: {problem.message} [{problem.rule}]')
+        print(
+                     f"{front_context}{excerpt}{back_context}{nl}"
+           f"{' '* len(front_context)}{'^'*len(excerpt)}")
+
+def cache_key(source_bytes, rule_names):
+    key = hashlib.sha256(f'{LINT_VERSION} {" ".join(rule_names)}\n'.encode())
+    key.update(source_bytes)
+    return key.hexdigest()
+
+def lint_file(path, cache_dir=DEFAULT_CACHE_DIR, rule_names=None):
+    """Lints one .calc file, unless cache_dir has what was found in a file with the same source"""
+    rule_names = sorted(rule_names or rules)
+    try:
+        with open(path, 'rb') as f:
+            source_bytes = f.read()
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, cache_key(source_bytes, rule_names) + '.json')
+            try:
+                with open(cache_path) as f:
+                    return LintResult(path, 'cached', [Problem(*problem) for problem in json.load(f)], None)
+            except (OSError, ValueError, TypeError):
+                pass
+        problems = lint_source(source_bytes.decode('utf-8'), rule_names)
+        if cache_path is not None:
+            importhack.write_atomic(cache_path, json.dumps(problems).encode())
+    except Exception as e:
+        return LintResult(path, 'failed', [], f'{path}: {type(e).__name__}: {e}')
+    return LintResult(path, 'linted', problems, None)
+
+def lint_paths(paths, workers=None, cache_dir=DEFAULT_CACHE_DIR, rule_names=None):
+    """
+    Lints the .calc files under each path (or the file, if it is one),
+    spread over a pool of worker processes. Yields a LintResult per file,
+    in the order the files were found.
+    """
+    files = [filename for path in paths
+             for filename in ([path] if os.path.isfile(path) else precompile.find_calc_files(path))]
+    cache_dirs = [cache_dir] * len(files)
+    rule_name_lists = [rule_names] * len(files)
+    if workers == 1 or len(files) < 2:
+        yield from map(lint_file, files, cache_dirs, rule_name_lists)
+        return
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(files) // (workers * 4))
+        yield from executor.map(lint_file, files, cache_dirs, rule_name_lists, chunksize=chunksize)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Lint .calc files')
+    parser.add_argument('paths', nargs='+', help='.calc files, or directories to lint the .calc files under')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f'where to keep results by source hash (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write cached results")
+    parser.add_argument('-r', '--rule', action='append', choices=sorted(rules), dest='rules',
+                        help='only check this rule (can be given more than once)')
+    args = parser.parse_args(argv)
+
+    counts = {'linted': 0, 'cached': 0, 'failed': 0}
+    n_problems = 0
+    for result in lint_paths(args.paths, args.workers, None if args.no_cache else args.cache_dir, args.rules):
+        counts[result.status] += 1
+        n_problems += len(result.problems)
+        if result.error:
+            print(result.error, file=sys.stderr)
+        for problem in result.problems:
+            print(f'{result.path}:{problem.lineno}: {problem.message} [{problem.rule}]')
+    print(f"{n_problems} problems in {counts['linted'] + counts['cached']} files "
+          f"({counts['cached']} cached), {counts['failed']} failed")
+    return 1 if n_problems or counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,132 @@
+"""
+Automatic memoization of pure functions.
+
+A function is pure here if calling it twice with the same args must give
+the same result and do nothing else observable, so its results can be cached:
+- it's bound once, by a module-level statement, so calls by its name are
+  calls of it (the same requirement as for inlining)
+- its body only assigns to its own locals, and doesn't make functions or
+  classes or touch props
+- the only variables it reads besides its params and locals are globals
+  assigned once by a module-level statement, which can't change later
+- it only calls itself, other pure functions and the builtins in PURE_BUILTINS
+
+Both backends wrap pure functions in a MemoCache, an LRU cache that counts
+its hits and misses:
+
+    >>> from parse import parse
+    >>> from tokens import tokenize
+    >>> stmts = parse(tokenize('fib = (n) => if n < 2 then return n; end; return fib(n - 1) + fib(n - 2); end;'))
+    >>> [stmt.lhs.content for stmt in find_pure_functions(stmts)]
+    ['fib']
+"""
+from collections import OrderedDict, namedtuple
+
+from parse import Assignment, Call, Function, Run, PropAccess, Class, Compile
+from tokens import Token
+from scope_analysis import find_all_variable_lookups
+from inline import walk, count_bindings
+
+MAXSIZE = 1024  # results each MemoCache keeps
+PURE_BUILTINS = {'string', 'length'}
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class MemoCache:
+    """
+    Calls func, remembering the results of the last maxsize distinct calls.
+    Results of calls with unhashable args (e.g. lists, which could change
+    between calls anyway) aren't cached. With tuple_args, func is passed the
+    args as one tuple.
+    """
+    def __init__(self, func, maxsize=None, tuple_args=False):
+        self.func = func
+        self.tuple_args = tuple_args
+        self.maxsize = MAXSIZE if maxsize is None else maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, *args):
+        # 1, 1.0 and True are equal, but functions can tell them apart
+        key = args + tuple(type(arg) for arg in args)
+        try:
+            result = self.results[key]
+        except KeyError:
+            pass
+        except TypeError:
+            return self.func(args) if self.tuple_args else self.func(*args)
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return result
+        self.misses += 1
+        result = self.func(args) if self.tuple_args else self.func(*args)
+        self.results[key] = result
+        if len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+        return result
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.results))
+
+    def cache_clear(self):
+        self.results.clear()
+        self.hits = self.misses = 0
+
+def find_pure_functions(stmts):
+    """The module-level statements that assign pure functions"""
+    if any(isinstance(node, (Run, Compile)) for stmt in stmts for node in walk(stmt)):
+        return []
+    bindings, module_globals = count_bindings(stmts)
+    constants = {stmt.lhs.content for stmt in stmts
+                 if isinstance(stmt, Assignment) and isinstance(stmt.lhs, Token) and
+                 bindings[stmt.lhs.content] == 1}
+
+    # every function that passes the checks that don't depend on other functions,
+    # with the names it calls
+    candidates = {}
+    for stmt in stmts:
+        if (isinstance(stmt, Assignment) and isinstance(stmt.lhs, Token) and
+                isinstance(stmt.rhs, Function) and stmt.lhs.content in constants):
+            callees = called_names(stmt.rhs, bindings, constants, module_globals)
+            if callees is not None:
+                candidates[stmt.lhs.content] = (stmt, callees)
+
+    # then drop the ones that call impure functions until none do
+    changed = True
+    while changed:
+        changed = False
+        for name, (stmt, callees) in list(candidates.items()):
+            if not all(callee in candidates or callee in PURE_BUILTINS and callee not in bindings
+                       for callee in callees):
+                del candidates[name]
+                changed = True
+    return [stmt for stmt, _ in candidates.values()]
+
+def called_names(function, bindings, constants, module_globals):
+    """The names a function calls, or None if it's impure no matter what they are"""
+    params = {param.content for param in function.params}
+    assigned = set()
+    callees = set()
+    for stmt in function.body:
+        for node in walk(stmt):
+            if isinstance(node, (Function, Class, PropAccess, Run, Compile)):
+                return None
+            elif isinstance(node, Assignment):
+                if isinstance(node.lhs, PropAccess):
+                    return None  # walk() gets to the Assignment before the PropAccess in it
+                assigned.add(node.lhs.content)
+            elif isinstance(node, Call):
+                if not (isinstance(node.callable, Token) and node.callable.kind == 'Variable'):
+                    return None
+                callees.add(node.callable.content)
+    # in the interpreter, assigning to a name that's also a global assigns to the global
+    if assigned & module_globals:
+        return None
+
+    readable = params | assigned | constants | (PURE_BUILTINS - set(bindings))
+    for stmt in function.body:
+        if any(lookup.content not in readable for lookup in find_all_variable_lookups(stmt)):
+            return None
+    return callees
@@ -1,5 +1,7 @@
 import opcode
 
+from instrument import phase
+
 class MutableCode:
     def __init__(self, symbol_table, params, scope_analyzer, filename=None, name=None, firstlineno=None):
         self.symbol_table = symbol_table
@@ -14,6 +16,12 @@ class MutableCode:
         self.cellvars = []  # variables we created our own closure cells for
         self.varnames = []  # parameters, then local variables
 
+        # offsets into the lists above, so lookups don't scan the lists
+        self.constant_offsets = {}
+        self.name_offsets = {}
+        self.deref_offsets = {}
+        self.varname_offsets = {}
+
         self.filename = filename or 'fakefilename'
         self.name = name or 'fakename'
         self.firstlineno = firstlineno
@@ -26,33 +34,63 @@ class MutableCode:
         for freevar in symbol_table.free_vars:
             self.freevars.append(freevar)
 
+        # LOAD_DEREF and friends index into cellvars + freevars
+        for i, name in enumerate(self.cellvars + self.freevars):
+            self.deref_offsets[name] = i
+
         for globalvar in symbol_table.global_vars:
-            self.names.append(globalvar)
+            self.register_name(globalvar)
 
-        self.varnames = list(params)
-        for local_var in symbol_table.local_vars:
-            if local_var not in self.varnames:
-                self.varnames.append(local_var)
+        if symbol_table.is_class:
+            # class bodies use LOAD_NAME/STORE_NAME on the class namespace, not fast locals
+            for local_var in symbol_table.local_vars:
+                self.register_name(local_var)
+        else:
+            for param in params:
+                self.register_varname(param)
+            for local_var in symbol_table.local_vars:
+                self.register_varname(local_var)
 
         #TODO: try implementing if
 
     def register_const(self, const):
-        if const in self.constants:
-            return self.constants.index(const)
-        self.constants.append(const)
-        return len(self.constants) - 1
+        """
+        Constants are keyed on type as well as value so 1, 1.0 and True stay distinct
+
+        >>> from scope_analysis import SymbolTable
+        >>> code = MutableCode(SymbolTable(), (), None)
+        >>> code.register_const(1), code.register_const(True), code.register_const(1)
+        (0, 1, 0)
+        """
+        key = (type(const), const)
+        if key not in self.constant_offsets:
+            self.constant_offsets[key] = len(self.constants)
+            self.constants.append(const)
+        return self.constant_offsets[key]
+
+    def register_name(self, name):
+        if name not in self.name_offsets:
+            self.name_offsets[name] = len(self.names)
+            self.names.append(name)
+        return self.name_offsets[name]
+
+    def register_varname(self, name):
+        if name not in self.varname_offsets:
+            self.varname_offsets[name] = len(self.varnames)
+            self.varnames.append(name)
+        return self.varname_offsets[name]
 
     def name_offset(self, name):
-        return self.names.index(name)
+        return self.name_offsets[name]
 
     def cellvar_or_freevar_offset(self, name):
-        return (self.cellvars + self.freevars).index(name)
+        return self.deref_offsets[name]
 
     def cellvar_offset(self, name):
-        return self.cellvars.index(name)
+        return self.deref_offsets[name]
 
     def local_offset(self, name):
-        return self.varnames.index(name)
+        return self.varname_offsets[name]
 
     # LOAD_CLOSURE loads pushes a reference (cellvars + freevars)[i]
 
@@ -66,6 +104,8 @@ class MutableCode:
             # LOAD_DEREF loads pushes a reference (cellvars + freevars)[i]
         elif name in self.symbol_table.free_vars:
             self.add_op(('LOAD_DEREF', self.cellvar_or_freevar_offset(name)), lineno)
+        elif name in self.symbol_table.local_vars and self.symbol_table.is_class:
+            self.add_op(('LOAD_NAME', self.name_offset(name)), lineno)
         elif name in self.symbol_table.local_vars:
             self.add_op(('LOAD_FAST', self.local_offset(name)), lineno)
 
@@ -76,6 +116,8 @@ class MutableCode:
             self.add_op(('STORE_DEREF', self.cellvar_or_freevar_offset(name)), lineno)
         elif name in self.symbol_table.free_vars:
             self.add_op(('STORE_DEREF', self.cellvar_or_freevar_offset(name)), lineno)
+        elif name in self.symbol_table.local_vars and self.symbol_table.is_class:
+            self.add_op(('STORE_NAME', self.name_offset(name)), lineno)
         elif name in self.symbol_table.local_vars:
             self.add_op(('STORE_FAST', self.local_offset(name)), lineno)
 
@@ -110,33 +152,66 @@ class MutableCode:
         """Sets a label to the point to the next bytecode"""
         self.labels[label] = len(self.opcodes)
 
-    def build_firstlineno_lnotab(self):
+    def build_firstlineno_lnotab(self, offsets):
+        """Map bytecode offsets to line numbers, splitting increments that don't fit in a byte"""
         if self.firstlineno is None:
             firstlineno = self.linenos[0]
         else:
             firstlineno = self.firstlineno
         last_bytecode_index = 0
         last_lineno = 0
-        offsets = [last_bytecode_index, last_lineno]
-        for opno, abs_lineno in enumerate(self.linenos):
+        lnotab = bytearray()
+        for bytecode_index, abs_lineno in zip(offsets, self.linenos):
             lineno = abs_lineno - firstlineno
-            bytecode_index = opno * 2
             if lineno > last_lineno:
-                offsets.append(bytecode_index - last_bytecode_index)
+                bytecode_delta = bytecode_index - last_bytecode_index
+                line_delta = lineno - last_lineno
+                while bytecode_delta > 255:
+                    lnotab += bytes([255, 0])
+                    bytecode_delta -= 255
+                while line_delta > 255:
+                    lnotab += bytes([bytecode_delta, 255])
+                    bytecode_delta = 0
+                    line_delta -= 255
+                lnotab += bytes([bytecode_delta, line_delta])
                 last_bytecode_index = bytecode_index
-                offsets.append(lineno - last_lineno)
                 last_lineno = lineno
-        return firstlineno, bytes(offsets)
+        return firstlineno, bytes(lnotab)
 
     def resolve_labels(self):
-        for i in range(len(self.opcodes)):
-            if len(self.opcodes[i]) == 2 and isinstance(self.opcodes[i][1], str):
-                label = self.opcodes[i][1]
-                assert label.startswith('label'), f"bad label name: {self.opcodes[i]}"
-                value = self.labels[label] * 2  # for two bytes per opcode
-                #print('resolving label', self.opcodes[i][1], 'to', value)
-                self.opcodes[i] = (self.opcodes[i][0], value)
-
+        """
+        Returns instructions with labels replaced by jump targets, and the offset of each.
+
+        Arguments over 255 need EXTENDED_ARG prefixes, which move everything after them,
+        which can change jump arguments, so sizes are recomputed until they settle.
+        """
+        sizes = [instruction_size(op_and_arg) for op_and_arg in self.opcodes]
+        while True:
+            offsets = []
+            total = 0
+            for size in sizes:
+                offsets.append(total)
+                total += size
+            offsets.append(total)  # labels may point just past the last instruction
+
+            instructions = []
+            for i, op_and_arg in enumerate(self.opcodes):
+                if len(op_and_arg) == 2 and isinstance(op_and_arg[1], str):
+                    op, label = op_and_arg
+                    assert label.startswith('label'), f"bad label name: {op_and_arg}"
+                    target = offsets[self.labels[label]]
+                    if opcode.opmap[op] in opcode.hasjrel:
+                        target -= offsets[i] + sizes[i]
+                    op_and_arg = (op, target)
+                instructions.append(op_and_arg)
+
+            new_sizes = [max(size, instruction_size(op_and_arg))
+                         for size, op_and_arg in zip(sizes, instructions)]
+            if new_sizes == sizes:
+                return instructions, offsets[:-1]
+            sizes = new_sizes
+
+    @phase('assemble', 'instructions', lambda self: len(self.opcodes))
     def to_code_object(self):
 
         # names = []  # global variables or attribute calls
@@ -144,9 +219,9 @@ class MutableCode:
         # freevars: references to outer scopes
         # cellvars: local variables referenced by inner scopes
 
-        self.resolve_labels()
-        codestring = opcode_strings_to_codestring(self.opcodes)
-        firstlineno, lnotab = self.build_firstlineno_lnotab()
+        instructions, offsets = self.resolve_labels()
+        codestring = opcode_strings_to_codestring(instructions)
+        firstlineno, lnotab = self.build_firstlineno_lnotab(offsets)
         codeobj = module_code_to_pyc_contents(
             argcount=len(self.params),
             nlocals=len(self.varnames),
@@ -176,14 +251,34 @@ class MutableCode:
         s += ')'
         return s
 
+def instruction_size(op_or_op_and_arg):
+    """
+    Number of bytes an instruction takes up, including any EXTENDED_ARG prefixes
+
+    >>> instruction_size('RETURN_VALUE'), instruction_size(('LOAD_CONST', 255)), instruction_size(('LOAD_CONST', 256))
+    (2, 2, 4)
+    """
+    if len(op_or_op_and_arg) != 2:
+        return 2
+    arg = op_or_op_and_arg[1]
+    if isinstance(arg, str):
+        return 2  # an unresolved label, assume it fits until we know better
+    size = 2
+    while arg > 0xff:
+        arg >>= 8
+        size += 2
+    return size
+
 def opcode_strings_to_codestring(opcodes):
     r"""
     Given a list of opcodes as strings, or tuples of opcodes and args, return codestring.
 
     >>> opcode_strings_to_codestring([('LOAD_FAST', 0), 'RETURN_VALUE'])
     b'|\x00S\x00'
+    >>> opcode_strings_to_codestring([('LOAD_CONST', 0x1234)])
+    b'\x90\x12d4'
     """
-    codestring = b''
+    codestring = bytearray()
     for op_or_op_and_arg in opcodes:
         if len(op_or_op_and_arg) == 2:
             op, arg = op_or_op_and_arg
@@ -191,11 +286,19 @@ def opcode_strings_to_codestring(opcodes):
             op = op_or_op_and_arg
             arg = 0
             n = opcode.opmap[op]
-            if n > opcode.HAVE_ARGUMENT:
+            if n >= opcode.HAVE_ARGUMENT:
                 raise ValueError(f"Opcode {op} needs argument")
         n = opcode.opmap[op]
-        codestring += bytes([n, arg])
-    return codestring
+        if arg > 0xff:
+            prefixes = []
+            high = arg >> 8
+            while high:
+                prefixes.append(high & 0xff)
+                high >>= 8
+            for prefix in reversed(prefixes):
+                codestring += bytes([opcode.EXTENDED_ARG, prefix])
+        codestring += bytes([n, arg & 0xff])
+    return bytes(codestring)
 
 def module_code_to_pyc_contents(argcount, nlocals, codestring, constants, names, varnames, firstlineno, lnotab, freevars, cellvars, filename, name):
     """
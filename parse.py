@@ -1,6 +1,9 @@
 from collections import namedtuple
+import io
+import sys
 
 from tokens import Token, tokenize
+from instrument import phase
 
 
 BinaryOp = namedtuple('BinaryOp', ['left', 'op', 'right'])
@@ -16,130 +19,209 @@ PropAccess = namedtuple('PropAccess', ['left', 'prop'])
 Run = namedtuple('Run', ['filename'])
 Compile = namedtuple('Compile', ['filename'])
 
-def pprint_tree(node):
-    print(pformat_full_tree(node))
+def pprint_tree(node, max_depth=None, max_size=None):
+    write_tree(node, sys.stdout, max_depth, max_size)
+    sys.stdout.write('\n')
 
-def pformat_full_tree(node, indent=0):
+def pformat_full_tree(node, indent=0, max_depth=None, max_size=None):
+    """
+    >>> print(pformat_full_tree(parse(tokenize('f = (x) => if x then return 1; end; end;'))[0]))
+    Assignment(lhs=Token(kind='Variable', content='f'),
+               value=Function(params=(x),
+                              body=[If(cond=Token(kind='Variable', content='x'),
+                                       body=[Return(expression=Token(kind='Number', content=1))])]))
+    >>> print(pformat_full_tree(parse(tokenize('a = 1 + 2 * 3;'))[0], max_depth=2))
+    Assignment(lhs=Token(kind='Variable', content='a'),
+               value=BinaryOp(op=Token(kind='Plus'),
+                              left=...,
+                              right=...))
+    """
+    out = io.StringIO()
+    write_tree(node, out, max_depth, max_size, indent)
+    return out.getvalue()
+
+def write_tree(node, out, max_depth=None, max_size=None, indent=0):
+    """
+    Writes the tree under node to out, a node at a time from a stack so deep
+    trees don't recurse. Nodes more than max_depth deep are written as ...,
+    and so is everything after the first max_size characters.
+    """
+    written = 0
+    stack = [(node, indent, 1)]
+    while stack:
+        part = stack.pop()
+        if isinstance(part, str):
+            text = part
+        elif max_depth is not None and part[2] > max_depth:
+            text = '...'
+        else:
+            # replace the node with what it's written as, first on top
+            stack.extend(reversed(tree_parts(*part)))
+            continue
+        if max_size is not None and written + len(text) > max_size:
+            out.write(text[:max_size - written] + '...')
+            return
+        out.write(text)
+        written += len(text)
+
+def tree_parts(node, indent, depth):
+    """The strings and (child, indent, depth) tuples a node is written as"""
     space = ' '*indent
     nl = '\n'
+    depth += 1
     if isinstance(node, Token):
-        return(f"{repr(node)}")
+        return [repr(node)]
     elif isinstance(node, BinaryOp):
-        return(
-                   f"BinaryOp(op={node.op},{nl}"
-            f"{space}         left={pformat_full_tree(node.left, indent+9+5)},{nl}"
-            f"{space}         right={pformat_full_tree(node.right, indent+9+6)})"
-        )
+        return [f"BinaryOp(op={node.op},{nl}"
+                f"{space}         left=", (node.left, indent+9+5, depth),
+                f",{nl}{space}         right=", (node.right, indent+9+6, depth), ")"]
     elif isinstance(node, UnaryOp):
-        return(
-                  f"UnaryOp(op={node.op},{nl}"
-            f"{space}         right={pformat_full_tree(node.right, indent+8+6)})"
-        )
+        return [f"UnaryOp(op={node.op},{nl}"
+                f"{space}         right=", (node.right, indent+8+6, depth), ")"]
     elif isinstance(node, Assignment):
-        return(
-                   f"Assignment(lhs={pformat_full_tree(node.lhs, indent+11+4)},{nl}"
-            f"{space}           value={pformat_full_tree(node.rhs, indent+11+6)})"
-        )
+        return ["Assignment(lhs=", (node.lhs, indent+11+4, depth),
+                f",{nl}{space}           value=", (node.rhs, indent+11+6, depth), ")"]
     elif isinstance(node, Call):
-        s =             f"Call(callable={node.callable},{nl}"
-        if len(node.arguments) == 0:
-            s += f"{space}     arguments=[])"
-        elif len(node.arguments) == 1:
-            s += f"{space}     arguments=[{pformat_full_tree(node.arguments[0], indent+16)}])"
-        else:
-            s += f"{space}     arguments=[{pformat_full_tree(node.arguments[0], indent+16)},{nl}"
-        for argument in node.arguments[1:-1]:
-            s += f"{space}                {pformat_full_tree(argument, indent+16)},{nl}"
-        if len(node.arguments) > 1:
-            s += f"{space}                {pformat_full_tree(node.arguments[-1], indent+16)}])"
-        return s
+        parts = [f"Call(callable={node.callable},{nl}{space}     arguments=["]
+        for i, argument in enumerate(node.arguments):
+            if i:
+                parts.append(f",{nl}{space}                ")
+            parts.append((argument, indent+16, depth))
+        parts.append("])")
+        return parts
     elif isinstance(node, Function):
-        s = f"Function(params=({', '.join(v.content for v in node.params)}),{nl}"
-        s += pformat_body('body', node.body, indent=indent+9)
-        s += ')'
-        return s
+        return ([f"Function(params=({', '.join(v.content for v in node.params)}),{nl}"] +
+                body_parts('body', node.body, indent+9, depth) + [')'])
     elif isinstance(node, If):
-        s = f"If(cond={pformat_full_tree(node.condition, indent+3+5)},{nl}"
-        s += pformat_body('body', node.body, indent=indent+3)
+        parts = ["If(cond=", (node.condition, indent+3+5, depth), f",{nl}"]
+        parts += body_parts('body', node.body, indent+3, depth)
         if node.else_body:
-            s += '\n'
-            s += pformat_body('else_body', node.else_body, indent=indent+3)
-        s += ')'
-        return s
+            parts.append(nl)
+            parts += body_parts('else_body', node.else_body, indent+3, depth)
+        return parts + [')']
     elif isinstance(node, While):
-        s = f"While(cond={pformat_full_tree(node.condition, indent+6+5)},{nl}"
-        s += pformat_body('body', node.body, indent=indent+6)
-        s += ')'
-        return s
+        return (["While(cond=", (node.condition, indent+6+5, depth), f",{nl}"] +
+                body_parts('body', node.body, indent+6, depth) + [')'])
     elif isinstance(node, Run):
-        return f"Run(filename={node.filename})"
+        return [f"Run(filename={node.filename})"]
     elif isinstance(node, Compile):
-        return f"Compile(filename={node.filename})"
+        return [f"Compile(filename={node.filename})"]
     elif isinstance(node, Return):
-        return(f"Return(expression={pformat_full_tree(node.expression, indent+7+11)})")
+        return ["Return(expression=", (node.expression, indent+7+11, depth), ")"]
     elif isinstance(node, PropAccess):
-        return(
-                   f"PropAccess(left={pformat_full_tree(node.left, indent+11+5)},{nl}"
-            f"{space}           prop={pformat_full_tree(node.prop, indent+11+5)})"
-        )
+        return ["PropAccess(left=", (node.left, indent+11+5, depth),
+                f",{nl}{space}           prop=", (node.prop, indent+11+5, depth), ")"]
     elif isinstance(node, Class):
-        s = f"Class(name={node.name},{nl}"
+        parts = [f"Class(name={node.name},{nl}"]
         if node.extends:
-            s += "{space}      extends={pformat_full_tree(node.extends, indent+6+8)},{nl}"
-        s += pformat_body('body', node.body, indent=indent+6)
-        s += ')'
-        return s
+            parts += [f"{space}      extends=", (node.extends, indent+6+8, depth), f",{nl}"]
+        return parts + body_parts('body', node.body, indent+6, depth) + [')']
     else:
         raise ValueError("Can't display tree node: {}".format(node))
 
-def pformat_body(body_name, statements, indent=0):
+def body_parts(body_name, statements, indent, depth):
     space = ' ' * indent
-    s = ''
     nl = '\n'
-    if len(statements) == 0:
-        s += f"{space}{body_name}=[])"
-    elif len(statements) == 1:
-        s += f"{space}{body_name}=[{pformat_full_tree(statements[0], indent+len(body_name)+2)}]"
-    else:
-        s += f"{space}{body_name}=[{pformat_full_tree(statements[0], indent+len(body_name)+2)},{nl}"
-    for statement in statements[1:-1]:
-        s += f"{space}{' '*len(body_name)}  {pformat_full_tree(statement, indent+len(body_name)+2)},{nl}"
-    if len(statements) > 1:
-        s += f"{space}{' '*len(body_name)}  {pformat_full_tree(statements[-1], indent+len(body_name)+2)}])"
-    return s
-
-def start_end(node):
-    if isinstance(node, Token):
-        return (node.start, node.end)
-    elif isinstance(node, BinaryOp):
-        left_start, left_end= start_end(node.left)
-        op_start, op_end = start_end(node.op)
-        right_start, right_end = start_end(node.right)
-        return (
-            min([left_start, op_start, right_start]),
-            max([left_end, op_end, right_end])
-        )
-    elif isinstance(node, UnaryOp):
-        op_start, op_end = start_end(node.op)
-        right_start, right_end = start_end(node.right)
-        return (
-            min([op_start, right_start]),
-            max([op_end, right_end])
-        )
-    elif isinstance(node, Assignment):
-        var_start, var_end = start_end(node.lhs)
-        expr_start, expr_end = start_end(node.rhs)
-        return (
-            min([var_start, expr_start]),
-            max([var_end, expr_end])
-        )
-
-def parse(remaining_tokens):
-    stmts = []
-    while remaining_tokens:
-        stmt, remaining_tokens = parse_statement(remaining_tokens)
-        stmts.append(stmt)
-    return stmts
+    parts = [f"{space}{body_name}=["]
+    for i, statement in enumerate(statements):
+        if i:
+            parts.append(f",{nl}{space}{' '*len(body_name)}  ")
+        parts.append((statement, indent+len(body_name)+2, depth))
+    parts.append("]")
+    return parts
+
+Span = namedtuple('Span', ['start', 'end', 'lineno'])
+
+class SpanTable:
+    """
+    Where in the source each node parse() built came from. Looking a node up
+    is a dict lookup instead of a walk over its subtree, and works for every
+    kind of node, including the ones whose first and last tokens (an if or an
+    end, say) aren't in the AST.
+
+    >>> spans = SpanTable()
+    >>> stmt, = parse(tokenize('if x then\\n  y = 1 + 2;\\nend;'), spans)
+    >>> spans[stmt], spans[stmt.body[0]], spans[stmt.body[0].rhs]
+    (Span(start=0, end=26, lineno=1), Span(start=12, end=21, lineno=2), Span(start=16, end=21, lineno=2))
+    """
+    def __init__(self):
+        self.spans = {}  # id(node) -> (node, Span), the node keeps its id from being reused
+
+    def add(self, node, span):
+        self.spans[id(node)] = (node, span)
+
+    def get(self, node, default=None):
+        if isinstance(node, Token):
+            return Span(node.start, node.end, node.lineno)
+        entry = self.spans.get(id(node))
+        return entry[1] if entry is not None else default
+
+    def __getitem__(self, node):
+        span = self.get(node)
+        if span is None:
+            raise KeyError(node)
+        return span
+
+    def __contains__(self, node):
+        return self.get(node) is not None
+
+    def __len__(self):
+        return len(self.spans)
+
+recording = None  # the SpanTable parse() is adding to, if it was given one
+
+def spanned(node, tokens, remaining_tokens):
+    """node, after recording it was parsed from tokens up to remaining_tokens"""
+    if recording is not None:
+        # remaining_tokens is always the end of tokens, so the last token of node is just before it
+        last = tokens[len(tokens) - len(remaining_tokens) - 1]
+        recording.add(node, Span(tokens[0].start, last.end, tokens[0].lineno))
+    return node
+
+def find_span(node):
+    """
+    The span of the tokens in node, for nodes parse() wasn't asked to record.
+    Tokens that aren't in the AST, like a call's closing paren, are left out.
+
+    >>> find_span(parse(tokenize('a = f(1,\\n  2);'))[0])
+    Span(start=0, end=12, lineno=1)
+    """
+    first = last = None
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, Token):
+            if node.start is not None:
+                if first is None or node.start < first.start:
+                    first = node
+                if last is None or node.end > last.end:
+                    last = node
+        elif isinstance(node, (tuple, list)):
+            todo.extend(node)
+    if first is None:
+        return None
+    return Span(first.start, last.end, first.lineno)
+
+def start_end(node, spans=None):
+    """Where node starts and ends in the source, or None if none of its tokens know"""
+    span = spans.get(node) if spans is not None else None
+    if span is None:
+        span = find_span(node)
+    return span[:2] if span is not None else None
+
+@phase('parse', 'tokens', lambda remaining_tokens, spans=None: len(remaining_tokens))
+def parse(remaining_tokens, spans=None):
+    """The statements in remaining_tokens, adding where each node came from to spans if it's a SpanTable"""
+    global recording
+    outer, recording = recording, spans
+    try:
+        stmts = []
+        while remaining_tokens:
+            stmt, remaining_tokens = parse_statement(remaining_tokens)
+            stmts.append(stmt)
+        return stmts
+    finally:
+        recording = outer
 
 def parse_statement(tokens):
     if len(tokens) >= 2 and tokens[0].kind == 'Variable' and tokens[1].kind == 'Equals':
@@ -169,12 +251,12 @@ def parse_statement(tokens):
 def parse_run_statement(tokens):
     run, filename, *remaining_tokens = tokens
     assert run.kind == 'Run'
-    return Run(filename=filename), remaining_tokens
+    return spanned(Run(filename=filename), tokens, remaining_tokens), remaining_tokens
 
 def parse_compile_statement(tokens):
     run, filename, *remaining_tokens = tokens
     assert run.kind == 'Compile'
-    return Compile(filename=filename), remaining_tokens
+    return spanned(Compile(filename=filename), tokens, remaining_tokens), remaining_tokens
 
 def parse_class_statement(tokens):
     class_, name, *remaining_tokens = tokens
@@ -188,7 +270,7 @@ def parse_class_statement(tokens):
         stmt, remaining_tokens = parse_statement(remaining_tokens)
         statements.append(stmt)
     end, *remaining_tokens = remaining_tokens
-    return Class(name=name, extends=base_class_name, body=statements), remaining_tokens
+    return spanned(Class(name=name, extends=base_class_name, body=statements), tokens, remaining_tokens), remaining_tokens
 
 def parse_assignment_statement(tokens):
     lhs, remaining_tokens = parse_expression(tokens)
@@ -196,7 +278,7 @@ def parse_assignment_statement(tokens):
     assert isinstance(lhs, PropAccess) or lhs.kind == 'Variable', lhs
     assert equals.kind == 'Equals'
     rhs, remaining_tokens = parse_expression(remaining_tokens)
-    return Assignment(lhs=lhs, rhs=rhs), remaining_tokens
+    return spanned(Assignment(lhs=lhs, rhs=rhs), tokens, remaining_tokens), remaining_tokens
 
 def parse_if_statement(tokens):
     """
@@ -219,7 +301,7 @@ def parse_if_statement(tokens):
             stmt, remaining_tokens = parse_statement(remaining_tokens)
             else_statements.append(stmt)
         end, *remaining_tokens = remaining_tokens
-    return If(condition=condition, body=statements, else_body=else_statements), remaining_tokens
+    return spanned(If(condition=condition, body=statements, else_body=else_statements), tokens, remaining_tokens), remaining_tokens
 
 def parse_while_statement(tokens):
     while_, *remaining_tokens = tokens
@@ -232,14 +314,14 @@ def parse_while_statement(tokens):
         stmt, remaining_tokens = parse_statement(remaining_tokens)
         statements.append(stmt)
     end, *remaining_tokens = remaining_tokens
-    return While(condition=condition, body=statements), remaining_tokens
+    return spanned(While(condition=condition, body=statements), tokens, remaining_tokens), remaining_tokens
 
 def parse_return_statement(tokens):
     return_, *remaining_tokens = tokens
     if remaining_tokens[0].kind == 'Semi':
-        return Return(expression=None), remaining_tokens
+        return spanned(Return(expression=None), tokens, remaining_tokens), remaining_tokens
     expression, remaining_tokens = parse_expression(remaining_tokens)
-    return Return(expression=expression), remaining_tokens
+    return spanned(Return(expression=expression), tokens, remaining_tokens), remaining_tokens
 
 def parse_expression(tokens):
     return parse_greater_or_less(tokens)
@@ -250,14 +332,14 @@ def parse_greater_or_less(tokens):
     if remaining_tokens and remaining_tokens[0].kind in ('Greater', 'Less'):
         op, *remaining_tokens = remaining_tokens
         right, remaining_tokens = parse_plus_or_minus(remaining_tokens)
-        expr = BinaryOp(expr, op, right)
+        expr = spanned(BinaryOp(expr, op, right), tokens, remaining_tokens)
 
     elif (remaining_tokens[1:2] and remaining_tokens[0].kind == remaining_tokens[1].kind == 'Equals'):
         eq1, eq2, *remaining_tokens = remaining_tokens
-        op = Token(kind='Equals Equals', content='==', start=eq1.start, end=eq2.end, lineno=None)
+        op = Token(kind='Equals Equals', content='==', start=eq1.start, end=eq2.end, lineno=eq1.lineno)
         assert eq1.kind == 'Equals' and eq2.kind == 'Equals'
         right, remaining_tokens = parse_plus_or_minus(remaining_tokens)
-        expr = BinaryOp(expr, op, right)
+        expr = spanned(BinaryOp(expr, op, right), tokens, remaining_tokens)
 
     return expr, remaining_tokens
 
@@ -267,7 +349,7 @@ def parse_plus_or_minus(tokens):
     while remaining_tokens and remaining_tokens[0].kind in ('Plus', 'Minus'):
         op, *remaining_tokens = remaining_tokens
         right, remaining_tokens = parse_multiply_or_divide(remaining_tokens)
-        expr = BinaryOp(expr, op, right)
+        expr = spanned(BinaryOp(expr, op, right), tokens, remaining_tokens)
 
     return expr, remaining_tokens
 
@@ -277,16 +359,16 @@ def parse_multiply_or_divide(tokens):
     while remaining_tokens and remaining_tokens[0].kind in ('Star', 'Slash', 'Percent'):
         op, *remaining_tokens = remaining_tokens
         right, remaining_tokens = parse_unary_op(remaining_tokens)
-        expr = BinaryOp(expr, op, right)
+        expr = spanned(BinaryOp(expr, op, right), tokens, remaining_tokens)
 
     return expr, remaining_tokens
 
 def parse_unary_op(tokens):
     op = None
     if tokens[0].kind in ('Plus', 'Minus'):
-        op, *tokens = tokens
-        expr, tokens = parse_unary_op(tokens)
-        return tokens, UnaryOp(op=op, right=expr)
+        op, *remaining_tokens = tokens
+        expr, remaining_tokens = parse_unary_op(remaining_tokens)
+        return spanned(UnaryOp(op=op, right=expr), tokens, remaining_tokens), remaining_tokens
     return parse_call_or_prop_access(tokens)
 
 def parse_call_or_prop_access(tokens):
@@ -311,11 +393,11 @@ def parse_call_or_prop_access(tokens):
                     arguments.append(argument)
             right_paren, *remaining_tokens = remaining_tokens
             assert right_paren.kind == 'Right Paren'
-            expr = Call(callable=expr, arguments=arguments)
+            expr = spanned(Call(callable=expr, arguments=arguments), tokens, remaining_tokens)
         elif tok.kind == 'Dot':
             prop, *remaining_tokens = remaining_tokens
             assert prop.kind == "Variable", prop
-            expr = PropAccess(expr, prop)
+            expr = spanned(PropAccess(expr, prop), tokens, remaining_tokens)
         else:
             raise AssertionError("unreachable")
     return expr, remaining_tokens
@@ -382,7 +464,7 @@ def parse_function(tokens):
         stmt, remaining_tokens = parse_statement(remaining_tokens)
         statements.append(stmt)
     end, *remaining_tokens = remaining_tokens
-    return Function(params=parameters, body=statements, token=equals), remaining_tokens
+    return spanned(Function(params=parameters, body=statements, token=equals), tokens, remaining_tokens), remaining_tokens
 
 
 if __name__ == '__main__':
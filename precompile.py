@@ -0,0 +1,95 @@
+"""
+Ahead-of-time compile every .calc file under some directories into __pycache__,
+like the compileall module does for Python files, so that later imports only
+need to unmarshal. With -d the pycs leave out the functions a module never
+calls itself; they get their own names, and are only loaded by programs
+that ask for that with importhack.shim(drop_dead=True).
+
+    python precompile.py DIRECTORY [DIRECTORY ...] [-f] [-j WORKERS] [-q] [-d]
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+import importhack
+
+CompileResult = namedtuple('CompileResult', ['path', 'status', 'seconds', 'error'])
+
+def compile_file(path, force=False, drop_dead=False):
+    """Writes the pyc for one .calc file unless an up-to-date one already exists"""
+    t0 = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            source_bytes = f.read()
+        source_hash = importlib.util.source_hash(source_bytes)
+        bytecode_path = importhack.cache_from_source(path, drop_dead)
+        if not force:
+            try:
+                with open(bytecode_path, 'rb') as f:
+                    header = f.read(16)
+            except OSError:
+                pass
+            else:
+                if importhack.pyc_matches_source(header, source_hash, drop_dead):
+                    return CompileResult(path, 'up to date', time.perf_counter() - t0, None)
+        code = importhack.calc_source_to_code(source_bytes.decode('utf-8'), path, drop_dead)
+        importhack.write_atomic(bytecode_path, importhack.code_to_hash_pyc(code, source_hash, drop_dead))
+    except Exception as e:
+        return CompileResult(path, 'failed', time.perf_counter() - t0, f'{path}: {type(e).__name__}: {e}')
+    return CompileResult(path, 'compiled', time.perf_counter() - t0, None)
+
+def find_calc_files(directory):
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+        for filename in sorted(filenames):
+            if filename.endswith('.calc'):
+                yield os.path.join(dirpath, filename)
+
+def compile_dir(directory, force=False, workers=None, drop_dead=False):
+    """
+    Compiles the .calc files under directory, spread over a pool of worker processes.
+    Yields a CompileResult per file, in the order the files were found.
+    """
+    paths = list(find_calc_files(directory))
+    forces = [force] * len(paths)
+    drop_deads = [drop_dead] * len(paths)
+    if workers == 1 or len(paths) < 2:
+        yield from map(compile_file, paths, forces, drop_deads)
+        return
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(paths) // (workers * 4))
+        yield from executor.map(compile_file, paths, forces, drop_deads, chunksize=chunksize)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Precompile .calc files into __pycache__')
+    parser.add_argument('directories', nargs='+')
+    parser.add_argument('-f', '--force', action='store_true', help='recompile even if up to date')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only report failures')
+    parser.add_argument('-d', '--drop-dead', action='store_true',
+                        help="leave out functions a module never calls, for importhack.shim(drop_dead=True)")
+    args = parser.parse_args(argv)
+
+    counts = {'compiled': 0, 'up to date': 0, 'failed': 0}
+    t0 = time.perf_counter()
+    for directory in args.directories:
+        for result in compile_dir(directory, force=args.force, workers=args.workers, drop_dead=args.drop_dead):
+            counts[result.status] += 1
+            if result.error:
+                print(result.error, file=sys.stderr)
+            elif not args.quiet:
+                print(f'{result.seconds * 1000:9.2f}ms  {result.status:<10}  {result.path}')
+    total = time.perf_counter() - t0
+    print(f"{counts['compiled']} compiled, {counts['up to date']} up to date, "
+          f"{counts['failed']} failed in {total:.2f}s")
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
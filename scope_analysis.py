@@ -1,11 +1,20 @@
+from collections import Counter
+
 from tokens import Token, tokenize
+from instrument import phase
 from parse import BinaryOp, UnaryOp, pprint_tree, parse, Assignment, If, While, Call, Return, Function, Run, PropAccess, Class, Compile, parse_expression
 
 class ScopeAnalyzer:
-    def __init__(self):
+    def __init__(self, assignments_rebind_outer=False):
         self.tables = {}
         self.global_symbol_table = SymbolTable()
+        self.global_name_counts = Counter()  # statements using each global, so they can be removed
+        self.other_prop_assignments = 0  # to props of anything but a method's own instance, like p.x = 1
         self.done = False
+        # The compiler follows Python: assigning to a variable in a function makes
+        # it local. The interpreter instead assigns to the variable of an enclosing
+        # function if there is one, so it asks for that here.
+        self.assignments_rebind_outer = assignments_rebind_outer
 
     def __getitem__(self, node):
         # nodes are namedtuples so identical ones compare equal
@@ -16,32 +25,58 @@ class ScopeAnalyzer:
             self.tables[id(node)] = SymbolTable()
         return self.tables[id(node)]
 
+    @phase('scope analysis', 'statements', lambda self, stmts: len(stmts))
     def discover_symbols(self, stmts):
         """Call on a module-level series of statements to determine all scopes"""
 
         if not isinstance(stmts, list):
             raise ValueError(f"discover_symbols() want a list of statements, not {stmts}")
 
-        # find all assignments - these are global variables
         for stmt in stmts:
-            for assign in find_all_assignments(stmt):
-                if isinstance(assign.lhs, Token) and assign.lhs.kind == 'Variable':
-                    self.global_symbol_table.global_vars.add(assign.lhs.content)
+            self.add_statement(stmt)
 
-        # find all variables - these are global variables
-        for stmt in stmts:
-            for lookup in find_all_variable_lookups(stmt):
-                name = lookup.content
-                self.global_symbol_table.global_vars.add(name)
+        self.done = True
 
-        for stmt in stmts:
-            for nested_scope in find_all_nested_scopes(stmt):
+    def add_statement(self, stmt):
+        """
+        Determines the scopes of one more module-level statement. The scopes
+        nested in a module-level statement don't depend on the others, so
+        statements can be added and removed one at a time.
+        """
+        contents = ScopeContents([stmt])
+
+        # find all assignments and lookups - these are global variables
+        names = contents.assigned_names + [lookup.content for lookup in contents.lookups]
+        self.global_name_counts.update(names)
+        self.global_symbol_table.global_vars.update(names)
+        self.other_prop_assignments += len(find_other_prop_assignments(stmt))
+
+        done, self.done = self.done, False
+        try:
+            for nested_scope in contents.nested_scopes:
                 # nested scopes at this level need no information
                 # about the global scope: variables are assumed global
                 # if when not found regardless of declared global variables
                 determine_scopes(nested_scope, {}, self.global_symbol_table, self)
+        finally:
+            self.done = done
 
-        self.done = True
+    def remove_statement(self, stmt):
+        """Forgets the scopes of a module-level statement added earlier"""
+        contents = ScopeContents([stmt])
+        names = contents.assigned_names + [lookup.content for lookup in contents.lookups]
+        self.global_name_counts.subtract(names)
+        self.other_prop_assignments -= len(find_other_prop_assignments(stmt))
+        for name in names:
+            if self.global_name_counts[name] <= 0:
+                del self.global_name_counts[name]
+                self.global_symbol_table.global_vars.discard(name)
+
+        scopes = contents.nested_scopes
+        while scopes:
+            scope = scopes.pop()
+            self.tables.pop(id(scope), None)
+            scopes.extend(ScopeContents(scope.body).nested_scopes)
 
 class SymbolTable:
     def __init__(self):
@@ -50,6 +85,8 @@ class SymbolTable:
         self.free_vars = {}  # mapping to owning symbol table
         self.cell_vars = set()  # known to be used by others
         self.parent = None
+        self.is_class = False  # class bodies keep their locals in a namespace dict
+        self.instance_vars = set()  # for classes, props assigned on instances by methods
 
     def set_parent(self, parent):
         assert self.parent is None
@@ -76,48 +113,136 @@ class SymbolTable:
 def determine_scopes(func_or_class, declared_outer, parent, symbol_tables):
     symbol_table = symbol_tables[func_or_class]
     symbol_table.set_parent(parent)
+    contents = ScopeContents(func_or_class.body)
 
     if isinstance(func_or_class, Class):
-        raise ValueError("can't do classes yet")
+        # Like Python, names bound in a class body live in the class namespace
+        # and are not visible to the methods defined in it.
+        symbol_table.is_class = True
+        symbol_table.instance_vars = find_instance_vars(func_or_class)
+
+        symbol_table.local_vars.update(contents.assigned_names)
+
+        for lookup in contents.lookups:
+            look_up(lookup.content, symbol_table, declared_outer)
+
+        for nested_scope in contents.nested_scopes:
+            determine_scopes(nested_scope, declared_outer, symbol_table, symbol_tables)
     elif isinstance(func_or_class, Function):
         # find all assignments - these are global variables
+        declared_outer = declared_outer.copy()
         for param in func_or_class.params:
             symbol_table.local_vars.add(param.content)
             # params shadow outer variables
             if param.content in declared_outer:
-                declared_outer.remove(param.content)
-
-        for stmt in func_or_class.body:
-            for assign in find_all_assignments(stmt):
-                if isinstance(assign.lhs, Token) and assign.lhs.kind == 'Variable':
-                    symbol_table.local_vars.add(assign.lhs.content)
-
-        for stmt in func_or_class.body:
-            for lookup in find_all_variable_lookups(stmt):
-                name = lookup.content
-                if name in symbol_table.local_vars:
-                    pass
-                elif name in declared_outer:
-                    declared_outer[name].mark_as_cell_var(name)
+                del declared_outer[param.content]
 
-                    cur = symbol_table
-                    while cur is not declared_outer[name]:
-                        cur.mark_or_add_as_free_var(name, declared_outer[name])
-                        cur = cur.parent
+        rebound_outer = set()
+        for name in contents.assigned_names:
+            if symbol_tables.assignments_rebind_outer and name in declared_outer:
+                rebound_outer.add(name)
+            else:
+                symbol_table.local_vars.add(name)
 
-                else:
-                    symbol_table.global_vars.add(name)
+        names = [lookup.content for lookup in contents.lookups]
+        for name in names + sorted(rebound_outer):
+            look_up(name, symbol_table, declared_outer)
 
         declared = declared_outer.copy()
         for name in symbol_table.local_vars:  # no cellvars yet, if there were we'd add them too
             declared[name] = symbol_table
 
-        for stmt in func_or_class.body:
-            for nested_scope in find_all_nested_scopes(stmt):
-                determine_scopes(nested_scope, declared, symbol_table, symbol_tables)
+        for nested_scope in contents.nested_scopes:
+            determine_scopes(nested_scope, declared, symbol_table, symbol_tables)
     else:
         raise ValueError(f"Expects classes and functions, not {func_or_class}")
 
+def look_up(name, symbol_table, declared_outer):
+    """Records that the scope of symbol_table uses a variable"""
+    if name in symbol_table.local_vars:
+        pass
+    elif name in declared_outer:
+        owner = declared_outer[name]
+        owner.mark_as_cell_var(name)
+
+        cur = symbol_table
+        # once a scope has it as a free var so do the ones between it and the owner
+        while cur is not owner and cur.free_vars.get(name) is not owner:
+            cur.mark_or_add_as_free_var(name, owner)
+            cur = cur.parent
+    else:
+        symbol_table.global_vars.add(name)
+
+class ScopeContents:
+    """
+    The variables a scope assigns and looks up and the functions and classes
+    nested in it, found in a single walk over its statements that doesn't
+    step into those nested scopes. The find_all_* functions below find one
+    of these each.
+
+    >>> contents = ScopeContents(parse(tokenize('a = b; f = (x) => c = x; end; class C end;')))
+    >>> contents.assigned_names, [lookup.content for lookup in contents.lookups]
+    (['a', 'f', 'C'], ['b'])
+    >>> [type(scope).__name__ for scope in contents.nested_scopes]
+    ['Function', 'Class']
+    """
+    def __init__(self, stmts):
+        self.assigned_names = []
+        self.lookups = []
+        self.nested_scopes = []
+        for stmt in stmts:
+            self.visit(stmt)
+
+    def visit(self, node):
+        if isinstance(node, Token):
+            if node.kind == 'Variable':
+                self.lookups.append(node)
+        elif isinstance(node, BinaryOp):
+            self.visit(node.left)
+            self.visit(node.right)
+        elif isinstance(node, UnaryOp):
+            self.visit(node.right)
+        elif isinstance(node, Function):
+            self.nested_scopes.append(node)
+        elif isinstance(node, PropAccess):
+            # the prop is an attribute name, not a variable
+            self.visit(node.left)
+        elif isinstance(node, Call):
+            self.visit(node.callable)
+            for arg in node.arguments:
+                self.visit(arg)
+        elif isinstance(node, Class):
+            self.assigned_names.append(node.name.content)
+            self.nested_scopes.append(node)
+            # the base class is looked up where the class statement is
+            if node.extends:
+                self.visit(node.extends)
+        elif isinstance(node, (Run, Compile)):
+            pass
+        elif isinstance(node, Return):
+            if node.expression is not None:
+                self.visit(node.expression)
+        elif isinstance(node, Assignment):
+            # assigning to a variable doesn't look it up, but assigning to a prop
+            # looks up the object the prop is on
+            if isinstance(node.lhs, PropAccess):
+                self.visit(node.lhs)
+            elif node.lhs.kind == 'Variable':
+                self.assigned_names.append(node.lhs.content)
+            self.visit(node.rhs)
+        elif isinstance(node, If):
+            self.visit(node.condition)
+            for s in node.body:
+                self.visit(s)
+            for s in node.else_body:
+                self.visit(s)
+        elif isinstance(node, While):
+            self.visit(node.condition)
+            for s in node.body:
+                self.visit(s)
+        else:
+            raise ValueError(f"what is this: {repr(node)}")
+
 
 def find_all_assignments(stmt):
     def is_assignment(node):
@@ -126,6 +251,65 @@ def find_all_assignments(stmt):
     find_all_in_tree(is_assignment, stmt, found)
     return found
 
+def find_all_assigned_names(stmt):
+    """Names bound by assignments to variables and by class statements"""
+    def is_binding(node):
+        return (isinstance(node, Class) or
+                isinstance(node, Assignment) and isinstance(node.lhs, Token) and node.lhs.kind == 'Variable')
+    found = []
+    find_all_in_tree(is_binding, stmt, found)
+    return [node.name.content if isinstance(node, Class) else node.lhs.content
+            for node in found]
+
+def find_instance_assignments(cls):
+    """
+    Assignments to props of instances by the methods of a class, found by
+    looking for assignments to props of a method's first parameter (usually
+    called this) in the method and in functions nested in it that don't shadow it.
+    """
+    def find_in_function(func, this):
+        for stmt in func.body:
+            for assign in find_all_assignments(stmt):
+                lhs = assign.lhs
+                if (isinstance(lhs, PropAccess) and isinstance(lhs.left, Token) and
+                        lhs.left.kind == 'Variable' and lhs.left.content == this):
+                    found.append(assign)
+            for nested_scope in find_all_nested_scopes(stmt):
+                if (isinstance(nested_scope, Function) and
+                        this not in [param.content for param in nested_scope.params]):
+                    find_in_function(nested_scope, this)
+
+    found = []
+    for stmt in cls.body:
+        if isinstance(stmt, Assignment) and isinstance(stmt.rhs, Function) and stmt.rhs.params:
+            find_in_function(stmt.rhs, stmt.rhs.params[0].content)
+    return found
+
+def find_instance_vars(cls):
+    """Props set on instances by the methods of a class"""
+    return {assign.lhs.prop.content for assign in find_instance_assignments(cls)}
+
+def find_other_prop_assignments(stmt):
+    """
+    Assignments to props anywhere in a statement that aren't a method
+    setting a prop of its own instance, like p.x = 1 after p = Point();
+
+    >>> sorted(assign.lhs.prop.content for assign in find_other_prop_assignments(parse(tokenize(
+    ...     'f = (p) => class A m = (this) => this.a = 1; p.b = 2; end; end; p.c = 3; end;'))[0]))
+    ['b', 'c']
+    """
+    on_instances = set()
+    found = []
+    stmts = [stmt]
+    while stmts:
+        stmt = stmts.pop()
+        found.extend(assign for assign in find_all_assignments(stmt) if isinstance(assign.lhs, PropAccess))
+        for nested_scope in find_all_nested_scopes(stmt):
+            if isinstance(nested_scope, Class):
+                on_instances.update(id(assign) for assign in find_instance_assignments(nested_scope))
+            stmts.extend(nested_scope.body)
+    return [assign for assign in found if id(assign) not in on_instances]
+
 def find_all_variable_lookups(stmt):
     def is_variable_loookup(node):
         return isinstance(node, Token) and node.kind == 'Variable'
@@ -149,27 +333,38 @@ def find_all_in_tree(condition, node, found):
         find_all_in_tree(condition, node.left, found)
         find_all_in_tree(condition, node.right, found)
     elif isinstance(node, UnaryOp):
-        find_all_in_tree(condition, node.right, round)
+        find_all_in_tree(condition, node.right, found)
     elif isinstance(node, Function): pass
-    elif isinstance(node, PropAccess): pass
+    elif isinstance(node, PropAccess):
+        # the prop is an attribute name, not a variable
+        find_all_in_tree(condition, node.left, found)
     elif isinstance(node, Call):
         find_all_in_tree(condition, node.callable, found)
         for arg in node.arguments:
             find_all_in_tree(condition, arg, found)
-    elif isinstance(node, (Run, Class, Compile)):
+    elif isinstance(node, Class):
+        # the base class is looked up where the class statement is
+        if node.extends:
+            find_all_in_tree(condition, node.extends, found)
+    elif isinstance(node, (Run, Compile)):
         pass
     elif isinstance(node, Return):
-        find_all_in_tree(condition, node.expression, found)
+        if node.expression is not None:
+            find_all_in_tree(condition, node.expression, found)
     elif isinstance(node, Assignment):
-        # no lhs yet because no property assignment to test it with
-        #find_all_in_tree(condition, node.lhs, found)
+        # assigning to a variable doesn't look it up, but assigning to a prop
+        # looks up the object the prop is on
+        if isinstance(node.lhs, PropAccess):
+            find_all_in_tree(condition, node.lhs, found)
         find_all_in_tree(condition, node.rhs, found)
     elif isinstance(node, If):
+        find_all_in_tree(condition, node.condition, found)
         for s in node.body:
             find_all_in_tree(condition, s, found)
         for s in node.else_body:
             find_all_in_tree(condition, s, found)
     elif isinstance(node, While):
+        find_all_in_tree(condition, node.condition, found)
         for s in node.body:
             find_all_in_tree(condition, s, found)
     else:
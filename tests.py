@@ -1,11 +1,36 @@
 import unittest
 import sys
+import os
+import importlib
+import tempfile
+import gc
+import inspect
+import json
+import subprocess
 from textwrap import dedent
+from unittest import mock
 
 from calc import calc_source_to_python_module, calc_source_to_python_code_object
-from parse import parse
+from parse import parse, Call
+import parse as parse_module
 from tokens import tokenize
 from scope_analysis import ScopeAnalyzer
+import importhack
+import interp
+import typeinfer
+import inline
+import scope_analysis
+import compile
+import memoize
+import callgraph
+import incremental
+import debugrepl
+import completer
+import linter
+import instrument
+import calcprofile
+import precompile
+import bundle
 from contextlib import contextmanager
 from io import StringIO
 
@@ -43,6 +68,88 @@ class TestCompile(unittest.TestCase):
               print(c);
             end;"""))
 
+    def test_many_constants_and_names(self):
+        # more than 255 of each needs EXTENDED_ARG
+        source = ''.join(f'a{i} = {i + 1000};\n' for i in range(300))
+        calcmod = calc_source_to_python_module(source)
+        self.assertEqual(calcmod.a0, 1000)
+        self.assertEqual(calcmod.a299, 1299)
+
+    def test_operators(self):
+        calcmod = calc_source_to_python_module(dedent("""
+            f = (x, y) => return -x * 2 + y % 3 - y / 2; end;
+            g = (a) => return a < 3; end;
+            """))
+        self.assertEqual(calcmod.f(4, 5), -8.5)
+        self.assertEqual((calcmod.g(2), calcmod.g(3)), (True, False))
+
+    def test_prop_access_and_method_calls(self):
+        calcmod = calc_source_to_python_module(dedent("""
+            f = (obj) =>
+              obj.items.append(obj.value);
+              obj.value = "b";
+              return obj.items.copy();
+            end;"""))
+        obj = type('Obj', (), {})()
+        obj.items, obj.value = [], 'a'
+        self.assertEqual(calcmod.f(obj), ['a'])
+        self.assertEqual(obj.value, 'b')
+        self.assertEqual(calcmod.f(obj), ['a', 'b'])
+
+    def test_classes_get_slots(self):
+        calcmod = calc_source_to_python_module(dedent("""
+            class Point
+              origin = "origin";
+              init = (this, x) =>
+                this.x = x;
+                this.y = 0;
+              end;
+              getx = (this) =>
+                return this.x;
+              end;
+            end;
+            class Point3 extends Point
+              setz = (this, z) =>
+                this.z = z;
+              end;
+            end;
+            p = Point3();
+            p.init(5);
+            p.setz(7);
+            """))
+        self.assertEqual(calcmod.Point.__slots__, ('x', 'y'))
+        self.assertEqual(calcmod.Point3.__slots__, ('z',))
+        self.assertTrue(issubclass(calcmod.Point3, calcmod.Point))
+        self.assertEqual((calcmod.p.getx(), calcmod.p.y, calcmod.p.z), (5, 0, 7))
+        self.assertEqual(calcmod.Point.origin, 'origin')
+        self.assertFalse(hasattr(calcmod.p, '__dict__'))
+
+    def test_props_assigned_outside_methods(self):
+        source = dedent("""
+            class P
+              init = (this) => this.x = 1; end;
+            end;
+            p = P();
+            p.y = 2;
+            """)
+        calcmod = calc_source_to_python_module(source)
+        self.assertEqual(calcmod.P.__slots__, ('x', '__dict__'))
+        self.assertEqual(calcmod.p.y, 2)
+        self.assertEqual(run_in_interpreter(source).get('p').prop_access('y'), 2)
+
+    def test_class_inside_function(self):
+        calcmod = calc_source_to_python_module(dedent("""
+            make = (greeting) =>
+              class Greeter
+                greet = (this) =>
+                  return greeting;
+                end;
+              end;
+              return Greeter();
+            end;
+            """))
+        self.assertEqual(calcmod.make('hi').greet(), 'hi')
+
 class TestCompiledPythonOutputMatches(unittest.TestCase):
 
     def test_simple(self):
@@ -113,6 +220,28 @@ class TestScopeAnalysis(unittest.TestCase):
         self.assertEqual(foo.cell_vars, {'a', 'e'})
         self.assertEqual(foo.free_vars, dict())
 
+    def test_class(self):
+        ast = parse(tokenize("""
+            class Foo extends Bar
+              a = 1;
+              b = (this) =>
+                this.c = a;
+                set = () => this.d = 1; end;
+                shadowed = (this) => this.e = 1; end;
+              end;
+            end;"""))
+
+        sa = ScopeAnalyzer()
+        sa.discover_symbols(ast)
+
+        self.assertEqual(sa.global_symbol_table.global_vars, {'Foo', 'Bar'})
+        foo = sa[ast[0]]
+        self.assertTrue(foo.is_class)
+        self.assertEqual(foo.local_vars, {'a', 'b'})
+        self.assertEqual(foo.instance_vars, {'c', 'd'})
+        # class-level names aren't visible in methods
+        self.assertEqual(sa[ast[0].body[1].rhs].global_vars, {'a'})
+
     def test_passthrough_freevars(self):
         ast = parse(tokenize("""
             notglobal = () =>
@@ -143,6 +272,988 @@ class TestScopeAnalysis(unittest.TestCase):
         self.assertEqual(foo.free_vars, {'a': not_global})
         self.assertEqual(bar.free_vars, {'b': not_global})
 
+    def test_freevars_through_many_scopes(self):
+        ast = parse(tokenize("""
+            outer = (a) =>
+              f1 = () =>
+                print(a);
+                f2 = () =>
+                  f3 = () =>
+                    print(a);
+                  end;
+                end;
+              end;
+            end;"""))
+
+        sa = ScopeAnalyzer()
+        sa.discover_symbols(ast)
+
+        outer = sa[ast[0].rhs]
+        f1 = ast[0].rhs.body[0].rhs
+        f2 = f1.body[1].rhs
+        f3 = f2.body[0].rhs
+        self.assertEqual(outer.cell_vars, {'a'})
+        for func in (f1, f2, f3):
+            self.assertEqual(sa[func].free_vars, {'a': outer})
+
+class TestTreeFormatting(unittest.TestCase):
+
+    def test_layout(self):
+        stmt, = parse(tokenize('f = () => end;'))
+        self.assertEqual(parse_module.pformat_full_tree(stmt), dedent("""\
+            Assignment(lhs=Token(kind='Variable', content='f'),
+                       value=Function(params=(),
+                                      body=[]))"""))
+
+    def test_deep_trees(self):
+        node = tokenize('1')[0]
+        for _ in range(sys.getrecursionlimit() * 2):
+            node = parse_module.UnaryOp(tokenize('-')[0], node)
+        self.assertEqual(parse_module.pformat_full_tree(node, max_size=100)[-3:], '...')
+        self.assertEqual(parse_module.pformat_full_tree(node, max_depth=3).count('...'), 1)
+
+class TestSpans(unittest.TestCase):
+
+    SOURCE = dedent("""\
+        class Foo
+          get = (this) => return -this.x; end;
+        end;
+        while a == 1 do
+          a = f(1, (2 + 3) * 4);
+        end;
+        run other;
+        """)
+
+    def all_nodes(self, node):
+        if isinstance(node, list):
+            return [n for child in node for n in self.all_nodes(child)]
+        if isinstance(node, tuple) and not isinstance(node, parse_module.Token):
+            return [node] + [n for child in node for n in self.all_nodes(child)]
+        return []
+
+    def text(self, node, spans):
+        span = spans[node]
+        return self.SOURCE[span.start:span.end]
+
+    def test_every_node_has_a_span(self):
+        spans = parse_module.SpanTable()
+        stmts = parse(tokenize(self.SOURCE), spans)
+        self.assertEqual(len({id(node) for node in self.all_nodes(stmts)} - set(spans.spans)), 0)
+        cls, loop, run = stmts
+        self.assertEqual(self.text(cls, spans), self.SOURCE[:self.SOURCE.index(';\nwhile')])
+        self.assertEqual(self.text(cls.body[0].rhs, spans), '(this) => return -this.x; end')
+        self.assertEqual(self.text(cls.body[0].rhs.body[0], spans), 'return -this.x')
+        self.assertEqual(self.text(loop.condition, spans), 'a == 1')
+        self.assertEqual(self.text(loop.body[0].rhs, spans), 'f(1, (2 + 3) * 4)')
+        self.assertEqual(self.text(loop.body[0].rhs.arguments[1], spans), '(2 + 3) * 4')
+        self.assertEqual(self.text(run, spans), 'run other')
+        self.assertEqual([spans[node].lineno for node in [cls, cls.body[0], loop.body[0], run]], [1, 2, 5, 7])
+
+    def test_string_literals_and_last_token(self):
+        source = 'a = "hi";\nb = "x\ny" + c;'
+        spans = parse_module.SpanTable()
+        first, second = parse(tokenize(source), spans)
+        self.assertEqual(source[spans[first].start:spans[first].end], 'a = "hi"')
+        self.assertEqual(source[spans[second].start:spans[second].end], 'b = "x\ny" + c')
+        self.assertEqual((spans[first].lineno, spans[second].lineno), (1, 2))
+        last = tokenize('a = 1;\nbc')[-1]  # ends the source, with nothing after it
+        self.assertEqual((last.start, last.end, last.lineno), (7, 9, 2))
+
+    def test_start_end_without_a_table(self):
+        stmt, = parse(tokenize('x = -(1 + y);'))
+        self.assertEqual(parse_module.start_end(stmt), (0, 11))
+        self.assertNotIn(stmt, parse_module.SpanTable())
+        self.assertIsNone(parse_module.start_end(parse_module.Return(expression=None)))
+
+def run_in_interpreter(source):
+    builtin_scope = interp.Scope()
+    for name in interp.builtin_funcs:
+        builtin_scope.set(name, interp.builtin_funcs[name])
+    variables = builtin_scope.create_child_scope()
+    interp.execute_program(parse(tokenize(source)), variables)
+    return variables
+
+class TestInterpreterClasses(unittest.TestCase):
+
+    source = dedent("""
+        class Point
+          kind = "point";
+          init = (this, x, y) =>
+            this.x = x;
+            this.y = y;
+          end;
+          getx = (this) =>
+            return this.x;
+          end;
+        end;
+        class Point3 extends Point
+          setz = (this, z) =>
+            this.z = z;
+          end;
+        end;
+        getxs = (a, b) =>
+          return a.getx() + b.getx();
+        end;
+        p = Point();
+        p.init(1, 2);
+        q = Point3();
+        q.init(3, 4);
+        q.setz(5);
+        """)
+
+    def test_props_and_methods(self):
+        variables = run_in_interpreter(self.source + 'x = getxs(p, q); kind = q.kind;')
+        p, q = variables.get('p'), variables.get('q')
+        self.assertEqual(variables.get('x'), 4)
+        self.assertEqual(variables.get('kind'), 'point')
+        self.assertEqual((p.prop_access('x'), p.prop_access('y')), (1, 2))
+        self.assertEqual(q.prop_access('z'), 5)
+
+    def test_instances_share_shapes(self):
+        variables = run_in_interpreter(self.source)
+        p, q = variables.get('p'), variables.get('q')
+        self.assertIsInstance(p, interp.Instance)
+        self.assertFalse(hasattr(p, '__dict__'))
+        self.assertEqual(p.shape.slots, {'x': 0, 'y': 1})
+        self.assertIs(q.shape, p.shape.with_prop('z'))
+        self.assertEqual(q.values, [3, 4, 5])
+
+    def test_cached_class_lookups_see_class_changes(self):
+        variables = run_in_interpreter(self.source + dedent("""
+            getkind = (pt) => return pt.kind; end;
+            before = getkind(q);
+            Point.kind = "changed";
+            after = getkind(q);
+            """))
+        self.assertEqual(variables.get('before'), 'point')
+        self.assertEqual(variables.get('after'), 'changed')
+
+    def test_prop_caches_belong_to_their_program(self):
+        variables = run_in_interpreter(self.source)
+        self.assertFalse(hasattr(interp, 'prop_caches'))
+        interp.execute_program(parse(tokenize('getx = (pt) => return pt.x; end; a = getx(p);')), variables)
+        getx = variables.get('getx')
+        prop_access = getx.function_ast.body[0].expression
+        self.assertIn(id(prop_access), getx.program.prop_caches)
+        self.assertIsNot(getx.program, variables.get('Point').prop_access('getx').program)
+        self.assertIsNone(variables.program)
+
+class TestInterpreterClosures(unittest.TestCase):
+
+    def test_closures_share_variables_with_enclosing_functions(self):
+        variables = run_in_interpreter(dedent("""
+            make = () =>
+              n = 0;
+              inc = () =>
+                n = n + 1;
+                return n;
+              end;
+              return inc;
+            end;
+            counter = make();
+            a = counter();
+            b = counter();
+            """))
+        self.assertEqual((variables.get('a'), variables.get('b')), (1, 2))
+
+    def test_assigning_to_global_from_function(self):
+        with CapturedOutput() as (out, _):
+            interp.run_program(open(os.path.join(os.path.dirname(__file__), 'closure.calc')).read())
+        self.assertEqual(out.getvalue(), '7\n')
+
+    def test_frames_collected_when_closures_live_on(self):
+        variables = run_in_interpreter(dedent("""
+            make = (x) =>
+              unused = x;
+              f = () => return x; end;
+              return f;
+            end;
+            f1 = make(1);
+            f2 = make(2);
+            """))
+        gc.collect()
+        self.assertEqual([o for o in gc.get_objects() if isinstance(o, interp.Frame)], [])
+        self.assertEqual(set(variables.get('f1').cells), {'x'})
+
+class TestInlining(unittest.TestCase):
+
+    def inline(self, source):
+        stmts = parse(tokenize(dedent(source)))
+        inliner = inline.Inliner(stmts)
+        return inliner.inline_module(stmts), inliner.inlined
+
+    def test_statement_inlining_renames_locals(self):
+        source = dedent("""
+            hyp = (a, b) => s = a * a + b * b; return s; end;
+            s = 1;
+            f = (a) => x = hyp(a, 4); return x; end;
+            y = s;
+            """)
+        stmts, inlined = self.inline(source)
+        self.assertEqual(inlined, 0)  # hyp's local s would assign to the global s in the interpreter
+
+        source = source.replace('s = 1;', 't = 1;').replace('y = s;', 'y = t; x = hyp(3, 4); z = f(3);')
+        stmts, inlined = self.inline(source)
+        self.assertEqual(inlined, 1)
+        self.assertNotIn('hyp', [lookup.content for lookup in
+                                 scope_analysis.find_all_variable_lookups(stmts[2])])
+        variables = interp.Scope().create_child_scope()
+        interp.execute_program(parse(tokenize(source)), variables, whole_program=True)
+        self.assertEqual((variables.get('x'), variables.get('z')), (25, 25))
+        # module-level calls aren't inlined as statements, their renamed params would be globals
+        self.assertEqual([name for name in variables.bindings if '.' in name], [])
+
+    def test_not_inlined(self):
+        for source in [
+                'f = (n) => return f(n); end; a = f(1);',  # recursive
+                'f = (n) => return n; end; f = 2; a = f(1);',  # reassigned
+                'a = f(1); f = (n) => return n; end;',  # called before it's defined
+                'f = (n) => return n; end; g = (f) => return f(1); end;',  # shadowed
+                'f = (n) => return n; end; a = f(1); run other;',
+                # t isn't assigned on every path before it's read
+                'f = (a) => if a then t = a; end; return t; end; g = (n) => r = f(n); return r; end;',
+                'f = (a) => while a do t = a; end; return t; end; g = (n) => r = f(n); return r; end;',
+                ]:
+            self.assertEqual(self.inline(source)[1], 0, source)
+        self.assertEqual(self.inline("""
+            f = (a) => if a then t = a; else t = 0; end; return t; end;
+            g = (n) => r = f(n); return r; end;
+            """)[1], 1)
+
+    def test_unassigned_local_not_kept_across_loop_iterations(self):
+        source = dedent("""
+            f = (a) => if a > 0 then t = a; end; return t; end;
+            g = (n) =>
+              i = n;
+              while i > 0 - 1 do r = f(i); print(r); i = i - 1; end;
+              return 0;
+            end;
+            g(1);
+            """)
+        with CapturedOutput() as (out, _), self.assertRaises(interp.CantFindVariable):
+            interp.run_program(source)
+        self.assertEqual(out.getvalue(), '1\n')
+        with CapturedOutput() as (out, _), self.assertRaises(UnboundLocalError):
+            calc_source_to_python_module(source)
+        self.assertEqual(out.getvalue(), '1\n')
+
+    def test_args_not_evaluated_twice(self):
+        stmts, inlined = self.inline("""
+            sq = (x) => return x * x; end;
+            a = 1 + sq(g());
+            """)
+        self.assertEqual(inlined, 0)
+
+    def test_args_still_evaluated_in_order(self):
+        stmts, inlined = self.inline("""
+            first = (a, b) => return a; end;
+            sub = (a, b) => return b - a; end;
+            inc = (a) => return a + 1; end;
+            z = 0;
+            x = first(1, 1 / z);
+            y = sub(1 / z, z);
+            w = inc(z * 2) + inc(z);
+            """)
+        self.assertEqual(inlined, 2)
+        self.assertIsInstance(stmts[4].rhs, Call)
+        self.assertIsInstance(stmts[5].rhs, Call)
+        for source in ['z = 0; first = (a, b) => return a; end; print(first(1, 1 / z));',
+                       'z = 0; sub = (a, b) => return b - a; end; print(sub(1 / z, undefined));']:
+            with CapturedOutput(), self.assertRaises(ZeroDivisionError):
+                interp.run_program(source)
+            with CapturedOutput(), self.assertRaises(ZeroDivisionError):
+                calc_source_to_python_module(source)
+
+    @mock.patch.object(compile, 'MEMOIZATION', False)
+    def test_compiled(self):
+        calcmod = calc_source_to_python_module(dedent("""
+            sq = (x) => return x * x; end;
+            hyp = (a, b) => s = sq(a) + sq(b); return s; end;
+            f = (x, y) => z = hyp(x, y); return z + sq(2); end;
+            """))
+        self.assertEqual(calcmod.f(3, 4), 29)
+        self.assertNotIn('hyp', calcmod.f.__code__.co_names)
+        self.assertNotIn('sq', calcmod.f.__code__.co_names)
+
+class TestMemoization(unittest.TestCase):
+
+    FIB = 'fib = (n) => if n < 2 then return n; end; return fib(n - 1) + fib(n - 2); end;\n'
+
+    def pure_names(self, source):
+        return {stmt.lhs.content for stmt in memoize.find_pure_functions(parse(tokenize(dedent(source))))}
+
+    def test_purity(self):
+        self.assertEqual(self.pure_names(self.FIB + """
+            k = 10;
+            scaled = (n) => return fib(n) * k + length(string(n)); end;
+            loud = (n) => print(n); return n; end;
+            callsloud = (n) => return loud(n); end;
+            counter = 0;
+            counts = (n) => counter = counter + 1; return n; end;
+            prop = (p) => return p.x; end;
+            changing = 0;
+            changing = 1;
+            readschanging = () => return changing; end;
+            """), {'fib', 'scaled'})
+        self.assertEqual(self.pure_names(self.FIB + 'run other;'), set())
+
+    def test_functions_setting_props_run_and_compile(self):
+        source = 'setx = (p) => p.x = 1; return p; end;\n'
+        self.assertEqual(self.pure_names(source), set())
+        variables = interp.Scope()
+        interp.execute_program(parse(tokenize(source + 'class P end; q = setx(P());')), variables,
+                               whole_program=True)
+        self.assertEqual(variables.get('q').prop_access('x'), 1)
+        self.assertIsNone(variables.get('setx').memo)
+        calcmod = calc_source_to_python_module(source)
+        obj = type('Obj', (), {})()
+        self.assertEqual(calcmod.setx(obj).x, 1)
+
+    def test_memo_cache(self):
+        calls = []
+        cache = memoize.MemoCache(lambda *args: calls.append(args) or len(calls), maxsize=2)
+        self.assertEqual([cache(1), cache(1), cache(True), cache(2), cache(3), cache(1)], [1, 1, 2, 3, 4, 5])
+        self.assertEqual(cache.cache_info(), memoize.CacheInfo(hits=1, misses=5, maxsize=2, currsize=2))
+        self.assertEqual([cache([]), cache([])], [6, 7])  # unhashable args aren't cached
+        cache.cache_clear()
+        self.assertEqual(cache.cache_info(), memoize.CacheInfo(0, 0, 2, 0))
+        tupled = memoize.MemoCache(lambda args: args, tuple_args=True)
+        self.assertEqual([tupled(1, 2), tupled(1, 2)], [(1, 2), (1, 2)])
+
+    def test_recursion_depth(self):
+        # memoizing shouldn't make a call go through many more Python frames
+        down = 'down = (n) => if n < 1 then return 0; end; return down(n - 1) + 1; end;\n'
+        limit = sys.getrecursionlimit()
+        self.addCleanup(sys.setrecursionlimit, limit)
+        sys.setrecursionlimit(len(inspect.stack()) + 600)
+        for whole_program, depth in [(False, 130), (True, 90)]:
+            variables = interp.Scope()
+            interp.execute_program(parse(tokenize(down + 'x = down(%d);' % depth)), variables,
+                                   whole_program=whole_program)
+            self.assertEqual(variables.get('x'), depth)
+
+    def test_interpreter(self):
+        with CapturedOutput():
+            variables = interp.Scope()
+            interp.execute_program(parse(tokenize(self.FIB + 'x = fib(60);')), variables, whole_program=True)
+        self.assertEqual(variables.get('x'), 1548008755920)
+        self.assertEqual(variables.get('fib').memo.cache_info().misses, 61)
+        self.assertIn(id(variables.get('fib').function_ast), variables.get('fib').program.pure_functions)
+        self.assertFalse(hasattr(interp, 'pure_functions'))
+
+    def test_interpreter_repl_input_not_memoized(self):
+        variables = run_in_interpreter(self.FIB)
+        self.assertIsNone(variables.get('fib').memo)
+
+    def test_compiled(self):
+        calcmod = calc_source_to_python_module(self.FIB + 'x = fib(60);')
+        self.assertEqual(calcmod.x, 1548008755920)
+        self.assertEqual(calcmod.fib.cache_info().misses, 61)
+
+class TestCallGraph(unittest.TestCase):
+
+    SOURCE = dedent("""
+        used = (x) => return helper(x); end;
+        helper = (x) => return x; end;
+        even = (n) => if n == 0 then return 1; end; return odd(n - 1); end;
+        odd = (n) => if n == 0 then return 0; end; return even(n - 1); end;
+        method = () => return 1; end;
+        class Foo
+          get = (this) => return method(); end;
+        end;
+        nested = () => inner = () => return deep(); end; return inner; end;
+        deep = () => return 2; end;
+        a = used(1);
+        """)
+
+    def test_dead_functions(self):
+        stmts = parse(tokenize(self.SOURCE))
+        self.assertEqual(callgraph.find_dead_functions(stmts), {'even', 'odd', 'nested', 'deep'})
+        self.assertEqual(callgraph.find_dead_functions(stmts, keep=['nested']), {'even', 'odd'})
+        self.assertEqual(callgraph.find_dead_functions(stmts + parse(tokenize('run other;'))), set())
+
+    def test_compile_module_drops_dead_functions(self):
+        stmts = parse(tokenize(self.SOURCE))
+        kept, dropped = callgraph.drop_dead_functions(stmts)
+        self.assertLess(callgraph.code_size(kept), callgraph.code_size(stmts))
+
+        module = python_module('')
+        exec(compile.calc_ast_to_python_code_object(stmts, drop_dead=True), module.__dict__)
+        self.assertEqual(module.a, 1)
+        self.assertTrue(hasattr(module, 'method'))
+        self.assertFalse(hasattr(module, 'odd'))
+
+class TestIncremental(unittest.TestCase):
+
+    SOURCE = dedent("""
+        a = 1;
+        f = (x) =>
+          y = x + a;
+          print(y);
+          return y;
+        end;
+        b = f(2);
+        print("a string; with a semicolon");
+        """)
+
+    def assertMatchesFromScratch(self, program):
+        self.assertEqual(''.join(chunk.text for chunk in program.chunks), program.source)
+        self.assertEqual(program.positioned_statements(), parse(tokenize(program.source)))
+        analyzer = ScopeAnalyzer()
+        analyzer.discover_symbols(parse(tokenize(program.source)))
+        self.assertEqual(program.analyzer.global_symbol_table.global_vars,
+                         analyzer.global_symbol_table.global_vars)
+
+    def test_edits_reparse_only_what_they_touch(self):
+        program = incremental.IncrementalProgram(self.SOURCE)
+        f, b = program.statements[1:3]
+        change = program.edit(self.SOURCE.index('x + a'), self.SOURCE.index('x + a') + 1, 'a')
+        self.assertEqual(len(change.added), 1)
+        self.assertIs(program.statements[2], b)
+        self.assertIsNot(program.statements[1], f)
+        self.assertEqual(change.rebound, {'f'})
+        self.assertEqual([chunk.stmt for chunk in change.stale], [b])
+        self.assertMatchesFromScratch(program)
+
+    def test_edits_that_move_statement_boundaries(self):
+        program = incremental.IncrementalProgram(self.SOURCE)
+        end = self.SOURCE.index('end;')
+        program.edit(end, end + 4, '')  # now f's body goes on to the end
+        self.assertEqual(len(program.errors), 1)
+        program.edit(end, end, 'end;')
+        self.assertEqual(program.errors, [])
+        program.update(program.source.replace('print("a string; with a semicolon")', 'c = "a string; with a semicolon"'))
+        program.update(program.source.replace('b = f(2);', 'b = f(2;'))
+        self.assertEqual(len(program.errors), 1)
+        program.update(program.source.replace('b = f(2;', 'b = f(2);'))
+        self.assertMatchesFromScratch(program)
+
+    def test_lex_errors_stay_in_their_statement(self):
+        program = incremental.IncrementalProgram(self.SOURCE.replace('b = f(2)', 'b = f(2) @'))
+        self.assertEqual([lineno for lineno, _ in program.errors], [8])
+        self.assertEqual(len(program.statements), 3)
+
+    def test_line_numbers_after_edits(self):
+        program = incremental.IncrementalProgram(self.SOURCE)
+        program.edit(0, 0, '\n\n')
+        module = python_module('')
+        with CapturedOutput():
+            exec(program.code(), module.__dict__)
+        self.assertEqual(module.f.__code__.co_firstlineno, 5)
+        self.assertEqual(module.b, 3)
+        self.assertMatchesFromScratch(program)
+
+class TestDebugRepl(unittest.TestCase):
+
+    def pending(self, *lines):
+        pending = debugrepl.PendingInput()
+        for line in lines:
+            pending.add(tokenize(line))
+        return pending
+
+    def test_complete_statements(self):
+        self.assertTrue(self.pending('a = 1;').complete)
+        self.assertTrue(self.pending('a = 1; b = 2;').complete)
+        self.assertTrue(self.pending('f = (x) =>', '  if x then return 1; end;', 'end;').complete)
+        self.assertTrue(self.pending('class Foo', '  a = 1;', 'end;').complete)
+        self.assertTrue(self.pending('a = 1 + ;').complete)  # complete, though it won't parse
+
+    def test_incomplete_statements(self):
+        self.assertFalse(self.pending().complete)
+        self.assertFalse(self.pending('a = 1').complete)
+        self.assertFalse(self.pending('f = (x) =>', '  return x;').complete)
+        self.assertFalse(self.pending('while a < 1 do', '  a = a + 1; end').complete)
+
+    def run_compiled(self, compiled, source):
+        for tokens in incremental.split_statements(tokenize(source))[0]:
+            compiled.run(*compiled.compile(tokens))
+
+    def test_compiled_statements_share_variables_with_the_interpreter(self):
+        variables = run_in_interpreter('a = 2; f = (x) => return x * a; end;')
+        compiled = debugrepl.CompiledStatements(variables)
+        self.run_compiled(compiled, 'b = f(3); g = (x) => return x + b; end; c = length("abc");')
+        self.assertEqual(variables.get('b'), 6)
+        self.assertEqual(variables.get('c'), 3)
+        interp.execute_program(parse(tokenize('d = g(1);')), variables)
+        self.assertEqual(variables.get('d'), 7)
+
+    def test_compiled_statements_are_cached(self):
+        compiled = debugrepl.CompiledStatements(interp.Scope().create_child_scope())
+        self.run_compiled(compiled, 'i = 0; i = i + 1; i = i + 1;')
+        self.assertEqual(compiled.variables.get('i'), 2)
+        self.assertEqual(len(compiled.cache), 2)
+
+    def test_statements_that_dont_compile_are_interpreted(self):
+        compiled = debugrepl.CompiledStatements(interp.Scope().create_child_scope())
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'other.calc'), 'w') as f:
+                f.write('x = 1;')
+            orig_cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                with CapturedOutput():
+                    self.run_compiled(compiled, 'run other; y = x + 1;')
+            finally:
+                os.chdir(orig_cwd)
+        self.assertEqual(compiled.variables.get('y'), 2)
+
+class TestCompleter(unittest.TestCase):
+
+    def complete(self, complete, text):
+        matches = []
+        while complete(text, len(matches)) is not None:
+            matches.append(complete(text, len(matches)))
+        return matches
+
+    def test_keywords_modules_and_variables(self):
+        scope = interp.Scope()
+        scope.set('printer', 1)
+        variables = scope.create_child_scope()
+        with tempfile.TemporaryDirectory() as directory:
+            open(os.path.join(directory, 'primes.calc'), 'w').close()
+            complete = completer.Completer(variables, directory)
+            self.assertEqual(self.complete(complete, 'pr'), ['primes', 'printer'])
+            self.assertEqual(self.complete(complete, 'e'), ['else', 'end;', 'extends'])
+            self.assertEqual(self.complete(complete, 'x'), [])
+
+            variables.set('prod', 2)
+            open(os.path.join(directory, 'process.calc'), 'w').close()
+            self.assertEqual(self.complete(complete, 'pr'), ['primes', 'printer', 'process', 'prod'])
+
+    def test_compiled_repl_builtins_not_completed(self):
+        variables = interp.Scope().create_child_scope()
+        debugrepl.CompiledStatements(variables)
+        variables.set('abs', 1)
+        with tempfile.TemporaryDirectory() as directory:
+            complete = completer.Completer(variables, directory)
+            self.assertEqual(self.complete(complete, '_'), [])
+            self.assertEqual(self.complete(complete, 'ab'), ['abs'])
+
+class TestLinter(unittest.TestCase):
+
+    SOURCE = dedent("""\
+        f = (x) =>
+          unused = 1;
+          y = x + missing;
+          return y;
+          print(y);
+        end;
+        g = (a) =>
+          if a then return 1; else return 2; end;
+          counter = 0;
+        end;
+        counter = 0;
+        h = () => counter = 1; return; end;
+        make = () => n = 0; inc = () => n = n + 1; return n; end; return inc; end;
+        class C extends Base
+          k = 1;
+          m = (this) => return k; end;
+        end;
+        print(f(1));
+        """)
+
+    def test_rules(self):
+        problems = linter.lint_source(self.SOURCE)
+        self.assertEqual([(problem.rule, problem.lineno) for problem in problems], [
+            ('unused-variable', 2), ('undefined-global', 3), ('unreachable-code', 5),
+            ('unreachable-code', 9), ('undefined-global', 14), ('undefined-global', 16)])
+        self.assertEqual(self.SOURCE[problems[1].start:problems[1].end], 'missing')
+        self.assertEqual(self.SOURCE[problems[2].start:problems[2].end], 'print(y)')
+        self.assertEqual(linter.lint_source(self.SOURCE + 'run other;', ['undefined-global']), [])
+
+    def test_one_walk_drives_every_rule(self):
+        visited = []
+
+        class CountTokens(linter.Rule):
+            def visit_Token(self, node, walk):
+                visited.append(node.content)
+
+        with mock.patch.dict(linter.rules):
+            linter.rule('count-tokens')(CountTokens)
+            linter.lint_source('a = b + 1; f = (x) => return x.y; end;')
+        self.assertEqual(visited, ['b', 1, 'x'])
+
+    def test_lint_program(self):
+        with CapturedOutput() as (out, _):
+            linter.lint_program(parse(tokenize(self.SOURCE)), self.SOURCE)
+        self.assertIn('line 3: missing is never defined [undefined-global]\n x + missing;\n     ^^^^^^^\n', out.getvalue())
+
+    def test_lint_paths_caches_by_source(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_dir = os.path.join(directory, 'cache')
+            for name, source in [('a.calc', 'x = y;'), ('b.calc', 'x = 1;'), ('c.calc', 'x = ;')]:
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(source)
+            results = list(linter.lint_paths([directory], workers=2, cache_dir=cache_dir))
+            self.assertEqual([r.status for r in results], ['linted', 'linted', 'failed'])
+            self.assertEqual([len(r.problems) for r in results], [1, 0, 0])
+
+            with open(os.path.join(directory, 'b.calc'), 'w') as f:
+                f.write('x = y;')  # the same source as a.calc
+            with mock.patch('linter.lint_source', side_effect=AssertionError('linted again')):
+                results = list(linter.lint_paths([directory], workers=1, cache_dir=cache_dir))
+            self.assertEqual([r.status for r in results], ['cached', 'cached', 'failed'])
+            self.assertEqual(results[1].problems, results[0].problems)
+
+class TestInstrument(unittest.TestCase):
+
+    def setUp(self):
+        instrument.enable()
+        instrument.reset()
+        self.addCleanup(instrument.reset)
+        self.addCleanup(instrument.disable)
+
+    def test_phases(self):
+        calc_source_to_python_module('f = (x) => return x + 1; end; a = f(1);')
+        with CapturedOutput():
+            interp.run_program('print(1); print(2);')
+        report = instrument.report()['phases']
+        calls = {name: phase['calls'] for name, phase in report.items()}
+        self.assertEqual((calls['tokenize'], calls['parse'], calls['codegen'], calls['execute']), (2, 2, 1, 1))
+        self.assertEqual(calls['execute compiled'], 0)
+        self.assertGreaterEqual(calls['scope analysis'], 2)  # inlining analyses the program too
+        self.assertEqual(report['execute']['size'], 2)
+        self.assertEqual(report['codegen']['size'], 2)
+
+    def test_nested_calls_are_timed_once(self):
+        @instrument.phase('countdown', 'steps', lambda n: n)
+        def countdown(n):
+            return countdown(n - 1) if n else 0
+        self.addCleanup(instrument.phases.pop, 'countdown')
+
+        with mock.patch('time.perf_counter', side_effect=[1.0, 3.0]):  # only read around the outermost call
+            countdown(3)
+        phase = instrument.phases['countdown']
+        self.assertEqual((phase.calls, phase.size, phase.seconds, phase.depth), (4, 6, 2.0, 0))
+
+    def test_disabled(self):
+        instrument.disable()
+        interp.run_program('a = 1;')
+        self.assertEqual(sum(phase['calls'] for phase in instrument.report()['phases'].values()), 0)
+
+    def test_report_written_at_exit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            program, report = os.path.join(directory, 'a.calc'), os.path.join(directory, 'report.json')
+            with open(program, 'w') as f:
+                f.write('a = 1 + 2;')
+            subprocess.check_call([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugrepl.py'),
+                                   '--instrument', report, program])
+            with open(report) as f:
+                phases = json.load(f)['phases']
+        self.assertEqual(phases['tokenize']['size'], 10)
+        self.assertEqual(phases['execute']['calls'], 1)
+
+class TestProfiler(unittest.TestCase):
+
+    SOURCE = dedent("""\
+        fib = (n) =>
+          if n < 2 then return n; end;
+          return fib(n - 1) + fib(n - 2);
+        end;
+        x = fib(5);
+        """)
+
+    def test_lines_and_functions(self):
+        originals = interp.execute, interp.evaluate, interp.Closure.execute_checked
+        with calcprofile.Profiler('fib.calc') as profiler:
+            variables = run_in_interpreter(self.SOURCE)
+        self.assertEqual((interp.execute, interp.evaluate, interp.Closure.execute_checked), originals)
+        self.assertEqual(variables.get('x'), 5)
+
+        hits = {lineno: hits for filename, lineno, hits, seconds in profiler.lines()}
+        self.assertEqual(hits, {1: 1, 2: 23, 3: 7, 5: 1})  # 15 calls of fib, 8 of them returning on line 2
+        self.assertEqual([(name, calls) for name, calls, seconds in profiler.functions()], [('fib (fib.calc:1)', 15)])
+        self.assertAlmostEqual(sum(seconds for *_, seconds in profiler.lines()), sum(profiler.stacks.values()), delta=0.01)
+        with CapturedOutput() as (out, _):
+            profiler.print_report(self.SOURCE)
+        self.assertIn('fib.calc     3         7', out.getvalue())
+        self.assertIn('return fib(n - 1) + fib(n - 2);', out.getvalue())
+
+    def test_collapsed_stacks(self):
+        with calcprofile.Profiler('fib.calc') as profiler:
+            run_in_interpreter(self.SOURCE)
+        out = StringIO()
+        profiler.write_collapsed(out)
+        stacks = [line.rsplit(' ', 1)[0] for line in out.getvalue().splitlines()]
+        self.assertIn('<module>', stacks)
+        self.assertIn('<module>;fib (fib.calc:1);fib (fib.calc:1);fib (fib.calc:1);fib (fib.calc:1)', stacks)
+        self.assertEqual(max(stack.count(';') for stack in stacks), 5)  # fib(5) calls fib(4)... fib(1)
+
+    def test_run_statements(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'other.calc'), 'w') as f:
+                f.write('\n\nf = () => return 1; end;')
+            orig_cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                with calcprofile.Profiler('main.calc') as profiler:
+                    run_in_interpreter('run other;\na = f();')
+            finally:
+                os.chdir(orig_cwd)
+        self.assertEqual([line[:3] for line in profiler.lines()],
+                         [('main.calc', 1, 1), ('main.calc', 2, 1), ('other.calc', 3, 2)])
+        self.assertEqual(profiler.functions()[0][:2], ('f (other.calc:3)', 1))
+
+class TestLineProfiler(unittest.TestCase):
+
+    SOURCE = dedent("""\
+        make = (k) =>
+          add = (x) =>
+            return x + k;
+          end;
+          return add;
+        end;
+        add3 = make(3);
+        i = 0;
+        while i < 9 do
+          i = add3(i);
+        end;
+        """)
+
+    def profile(self, source):
+        code = compile.calc_ast_to_python_code_object(parse(tokenize(source)), 'adder.calc')
+        module = python_module('')
+        trace = sys.gettrace()
+        with calcprofile.LineProfiler() as profiler:
+            exec(code, module.__dict__)
+        self.assertIs(sys.gettrace(), trace)
+        return profiler, module
+
+    def test_lines_of_closures(self):
+        profiler, module = self.profile(self.SOURCE)
+        self.assertEqual(module.i, 9)
+        hits = {lineno: hits for filename, lineno, hits, seconds in profiler.lines()}
+        self.assertEqual(hits, {1: 1, 2: 1, 3: 3, 5: 1, 7: 1, 8: 1, 9: 4, 10: 3})
+        self.assertEqual(sorted((profiler.labels[code], calls) for code, calls in profiler.calls.items()),
+                         [('adder.calc (module)', 1), ('adder.calc:1 (k)', 1), ('adder.calc:2 (x)', 3)])
+        self.assertEqual(profiler.running, [])
+        self.assertLessEqual(sum(seconds for *_, seconds in profiler.lines()), profiler.seconds)
+
+    def test_exceptions_leave_calc_frames(self):
+        with self.assertRaises(NameError):
+            self.profile('f = () => return missing; end;\nf();')
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'adder.calc')
+            with open(path, 'w') as f:
+                f.write(self.SOURCE)
+            with CapturedOutput() as (out, _):
+                calcprofile.main(['--compiled', path])
+        report = out.getvalue().splitlines()
+        self.assertEqual(len([line for line in report if 'adder.calc' in line]), 11)  # 8 lines, 3 functions
+        self.assertIn('return x + k;', out.getvalue())
+        self.assertEqual(report[-3].split(), ['3', f'{path}:2', '(x)'])
+
+class TestTypeInference(unittest.TestCase):
+
+    def infer(self, source):
+        stmts = parse(tokenize(dedent(source)))
+        return stmts, typeinfer.infer_types(stmts)
+
+    def test_recursive_function(self):
+        stmts, types = self.infer("""
+            fib = (n) =>
+              if n < 2 then return n; else return fib(n - 1) + fib(n - 2); end;
+            end;
+            x = fib(10);
+            """)
+        self.assertEqual(types.type_of(stmts[1].rhs), int)
+
+    def test_flow_sensitive(self):
+        stmts, types = self.infer("""
+            a = 1;
+            b = a;
+            a = "s";
+            c = a;
+            i = 0;
+            while i < 3 do
+              i = i + 1;
+            end;
+            """)
+        self.assertEqual([types.type_of(s.rhs) for s in stmts[:4]], [int, int, str, str])
+        self.assertEqual(types.type_of(stmts[5].condition), bool)
+
+    def test_branches_join(self):
+        stmts, types = self.infer("""
+            if 1 then a = 1; b = 1; else a = 2; b = "two"; end;
+            c = a;
+            d = b;
+            """)
+        self.assertEqual((types.type_of(stmts[1].rhs), types.type_of(stmts[2].rhs)), (int, object))
+
+    def test_builtins_and_closures(self):
+        stmts, types = self.infer("""
+            make = (a) => g = () => return a; end; return g; end;
+            x = make(3)();
+            y = length(print("hi"));
+            """)
+        self.assertEqual((types.type_of(stmts[1].rhs), types.type_of(stmts[2].rhs)), (int, int))
+
+    def test_escaping_functions_take_anything(self):
+        stmts, types = self.infer("""
+            f = (x) => return x + 1; end;
+            a = f(1);
+            something.callback = f;
+            """)
+        self.assertEqual(types.type_of(stmts[0].rhs.body[0].expression), object)
+
+    @mock.patch.object(interp, 'TYPE_SPECIALIZATION', True)
+    def test_interpreter_specializes_proven_calls(self):
+        source = dedent("""
+            add = (x, y) => return x + y; end;
+            total = add(1, 2) * 3;
+            apply = (f) => return f(1); end;
+            """)
+        stmts = parse(tokenize(source))
+        builtin_scope = interp.Scope()
+        variables = builtin_scope.create_child_scope()
+        interp.execute_program(stmts, variables)
+        self.assertEqual(variables.get('total'), 9)
+        self.assertIn(id(stmts[1].rhs.left), variables.get('add').program.specialized_calls)
+        # calls that weren't proven still check their number of args
+        with self.assertRaisesRegex(ValueError, 'bad arity'):
+            interp.execute_program(parse(tokenize('x = apply(add);')), variables)
+
+    def test_interpreter_doesnt_specialize_by_default(self):
+        variables = run_in_interpreter('add = (x, y) => return x + y; end; total = add(1, 2);')
+        self.assertEqual(variables.get('total'), 3)
+        self.assertEqual(variables.get('add').program.specialized_calls, {})
+
+    @mock.patch.object(interp, 'TYPE_SPECIALIZATION', True)
+    def test_specialized_call_checks_callee(self):
+        variables = run_in_interpreter("""
+            f = (x) => return x; end;
+            g = (x) => return x + 1; end;
+            a = f(1);
+            """)
+        # a later program rebinding f doesn't confuse the call specialized by the first
+        variables.set('f', variables.get('g'))
+        interp.execute_program(parse(tokenize('b = f(1);')), variables)
+        self.assertEqual(variables.get('b'), 2)
+
+class TestImport(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        self.addCleanup(self.restore_import_system, list(sys.path_hooks), list(sys.meta_path),
+                        dict(sys.path_importer_cache))
+        importhack.shim()
+        for patcher in [mock.patch.object(sys, 'dont_write_bytecode', False),
+                        mock.patch.object(sys, 'path', [self.tmpdir.name] + sys.path)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def restore_import_system(self, path_hooks, meta_path, path_importer_cache):
+        # shim() swaps in the calc finder, which shouldn't leak into other tests
+        sys.path_hooks[:] = path_hooks
+        sys.meta_path[:] = meta_path
+        sys.path_importer_cache.clear()
+        sys.path_importer_cache.update(path_importer_cache)
+
+    def tearDown(self):
+        for name in ['calcimporttest', 'calcpkg', 'calcpkg.sub']:
+            sys.modules.pop(name, None)
+        os.chdir(self.orig_cwd)
+        self.tmpdir.cleanup()
+
+    def write(self, filename, source):
+        with open(filename, 'w') as f:
+            f.write(source)
+
+    def fresh_import(self, name):
+        sys.modules.pop(name, None)
+        return importlib.import_module(name)
+
+    def test_pyc_reused_until_source_changes(self):
+        self.write('calcimporttest.calc', 'a = 1;')
+        mod = self.fresh_import('calcimporttest')
+        self.assertEqual(mod.a, 1)
+        self.assertTrue(os.path.exists(mod.__cached__))
+
+        with mock.patch('importhack.calc_source_to_code', side_effect=AssertionError('recompiled')):
+            mod = self.fresh_import('calcimporttest')
+        self.assertEqual(mod.a, 1)
+
+        self.write('calcimporttest.calc', 'a = 2;')
+        mod = self.fresh_import('calcimporttest')
+        self.assertEqual(mod.a, 2)
+
+    def test_package(self):
+        os.mkdir('calcpkg')
+        self.write(os.path.join('calcpkg', '__init__.calc'), 'a = 1;')
+        self.write(os.path.join('calcpkg', 'sub.calc'), 'b = 2;')
+        sub = importlib.import_module('calcpkg.sub')
+        self.assertEqual(sub.b, 2)
+        self.assertEqual(sys.modules['calcpkg'].a, 1)
+        self.assertEqual(sys.modules['calcpkg'].__path__, [os.path.join(self.tmpdir.name, 'calcpkg')])
+
+    def test_lazy_import_runs_on_first_attribute_access(self):
+        importhack.shim(lazy=True)
+        self.addCleanup(importhack.shim)
+        self.write('calcimporttest.calc', 'a = 1; print("executed");')
+        with CapturedOutput() as (out, _):
+            mod = self.fresh_import('calcimporttest')
+            self.assertEqual(out.getvalue(), '')
+            self.assertEqual(mod.a, 1)
+            self.assertEqual(out.getvalue(), 'executed\n')
+
+    def test_precompile_skips_up_to_date_files(self):
+        os.mkdir('lib')
+        self.write(os.path.join('lib', 'calcimporttest.calc'), 'a = 1;')
+        self.write(os.path.join('lib', 'broken.calc'), 'a = ;')
+        results = list(precompile.compile_dir('lib', workers=2))
+        self.assertEqual([r.status for r in results], ['failed', 'compiled'])
+
+        results = list(precompile.compile_dir('lib', workers=2))
+        self.assertEqual([r.status for r in results], ['failed', 'up to date'])
+
+        sys.path.insert(0, os.path.join(self.tmpdir.name, 'lib'))
+        with mock.patch('importhack.calc_source_to_code', side_effect=AssertionError('recompiled')):
+            self.assertEqual(self.fresh_import('calcimporttest').a, 1)
+
+    def test_import_after_drop_dead_precompile(self):
+        os.mkdir('lib')
+        self.write(os.path.join('lib', 'calcimporttest.calc'), 'helper = (x) => return x + 1; end; a = 1;')
+        sys.path.insert(0, os.path.join(self.tmpdir.name, 'lib'))
+        results = list(precompile.compile_dir('lib', workers=1, drop_dead=True))
+        self.assertEqual([r.status for r in results], ['compiled'])
+
+        # an ordinary import doesn't get the pyc without helper
+        self.assertEqual(self.fresh_import('calcimporttest').helper(1), 2)
+        self.assertEqual([r.status for r in precompile.compile_dir('lib', workers=1, drop_dead=True)],
+                         ['up to date'])
+        self.assertEqual([r.status for r in precompile.compile_dir('lib', workers=1)], ['up to date'])
+
+        importhack.shim(drop_dead=True)
+        self.addCleanup(importhack.shim)
+        with mock.patch('importhack.calc_source_to_code', side_effect=AssertionError('recompiled')):
+            mod = self.fresh_import('calcimporttest')
+        self.assertEqual(mod.a, 1)
+        self.assertFalse(hasattr(mod, 'helper'))
+
+    def test_bundle(self):
+        os.makedirs(os.path.join('src', 'calcpkg'))
+        self.write(os.path.join('src', 'calcimporttest.calc'), 'a = 1;')
+        self.write(os.path.join('src', 'calcpkg', '__init__.calc'), 'a = 2;')
+        self.write(os.path.join('src', 'calcpkg', 'sub.calc'), 'b = 3;')
+        names = bundle.build_bundle('src', 'app.bundle')
+        self.assertEqual(names, ['calcimporttest', 'calcpkg', 'calcpkg.sub'])
+
+        importhack.shim(bundles=['app.bundle'])
+        self.addCleanup(importhack.shim)
+        self.assertEqual(self.fresh_import('calcimporttest').a, 1)
+        self.assertEqual(self.fresh_import('calcpkg.sub').b, 3)
+        self.assertEqual(sys.modules['calcpkg'].a, 2)
+
+    def test_found_via_sys_path_not_cwd(self):
+        os.mkdir('elsewhere')
+        self.write(os.path.join('elsewhere', 'calcimporttest.calc'), 'a = 3;')
+        sys.path.insert(0, os.path.join(self.tmpdir.name, 'elsewhere'))
+        self.assertEqual(self.fresh_import('calcimporttest').a, 3)
+
 
 if __name__ == '__main__':
     unittest.main()
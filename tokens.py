@@ -1,5 +1,7 @@
 from collections import namedtuple
 
+from instrument import phase
+
 class Token(namedtuple('Token', ['kind', 'content', 'start', 'end', 'lineno'])):
     @staticmethod
     def from_string(s, start=0, lineno=0):
@@ -46,6 +48,7 @@ class Token(namedtuple('Token', ['kind', 'content', 'start', 'end', 'lineno'])):
             return f'"{self.content}"'
         return f"Token(kind='{self.kind}')"
 
+@phase('tokenize', 'characters', len)
 def tokenize(string):
     """
     >>> tokenize('1 - 22')
@@ -61,13 +64,17 @@ def tokenize(string):
         if c == '"':
             if in_string:
                 token_string += c
-                tokens.append(Token.from_string(token_string, i-len(token_string), lineno))
+                # the closing quote is part of the token, so it started len - 1 characters ago
+                tokens.append(Token.from_string(token_string, i+1-len(token_string), string_lineno))
                 token_string = ''
             else:
                 token_string += c
+                string_lineno = lineno
             in_string = not in_string
         elif in_string:
             token_string += c
+            if c == '\n':
+                lineno += 1
         elif c in (' ', '\n'):
             if token_string:
                 tokens.append(Token.from_string(token_string, i-len(token_string), lineno))
@@ -88,7 +95,7 @@ def tokenize(string):
             raise ValueError('Unknown character: {}'.format(c))
 
     if token_string:
-        tokens.append(Token.from_string(token_string, i-len(token_string)))
+        tokens.append(Token.from_string(token_string, i+1-len(token_string), lineno))
 
     return tokens
 
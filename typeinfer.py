@@ -1,4 +1,7 @@
-from parse import BinaryOp, UnaryOp, pprint_tree, parse, Assignment, Token, start_end
+from parse import BinaryOp, UnaryOp, pprint_tree, parse, Assignment, Token, start_end, If, While, Call, Return, Function, Run, PropAccess, Class, Compile
+from scope_analysis import ScopeAnalyzer
+
+NoneType = type(None)
 
 signatures = {
     ('Plus', int, int): int,
@@ -9,31 +12,329 @@ signatures = {
     ('Minus', int): int,
     ('Plus', int): int,
     ('Star', int, int): int,
-    ('Slash', int, int): int,
+    ('Star', str, int): str,
+    ('Slash', int, int): float,
+    ('Percent', int, int): int,
     ('Greater', int, int): bool,
     ('Less', int, int): bool,
+    ('Greater', str, str): bool,
+    ('Less', str, str): bool,
+    ('Equals Equals', int, int): bool,
+    ('Equals Equals', str, str): bool,
     ('String', int): str,
 }
 
+# what the functions in interp.builtin_funcs return, given their argument type
+builtin_return_types = {
+    'print': lambda arg_type: arg_type,
+    'string': lambda arg_type: str,
+    'length': lambda arg_type: int,
+}
+
+class FunctionType:
+    """The type of values that are closures of one particular Function node"""
+    __slots__ = ('node',)
+
+    def __init__(self, node):
+        self.node = node
+
+    def __repr__(self):
+        return f"FunctionType({', '.join(p.content for p in self.node.params)})"
+
+class BuiltinType:
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"BuiltinType({self.name})"
+
+class Env:
+    """Types of the variables of one body that are tracked statement by statement"""
+    def __init__(self, symbol_table, function=None, is_class=False):
+        self.symbol_table = symbol_table
+        self.function = function
+        self.is_class = is_class
+        self.vars = {}
+
+    def copy(self):
+        env = Env(self.symbol_table, self.function, self.is_class)
+        env.vars = dict(self.vars)
+        return env
+
+class TypeInferrer:
+    """
+    Whole-program, flow-sensitive type inference.
+
+    Types are Python types (int, str, bool, float, NoneType), FunctionType and
+    BuiltinType for things that can be called, None for "no value has reached
+    here yet", and object for "could be anything".
+
+    Locals that no other scope can see are tracked statement by statement,
+    through ifs and to a fixed point around whiles. Everything else (globals
+    used from functions, variables captured by closures, params, return
+    values) gets a summary type joined over every assignment in the program.
+    The program is re-inferred until no summary changes. A function's params
+    are the join of the arguments at its call sites, unless the function
+    escapes somewhere we can't see calls from (a prop, an unknown callee, a
+    class body), in which case they could be anything.
+
+    The result is memoized per node: type_of(node) is the join of the types
+    the node had every time it was evaluated.
+    """
+    def __init__(self, stmts, analyzer):
+        self.stmts = stmts  # keeps nodes alive so their ids stay unique
+        self.analyzer = analyzer
+        self.summaries = {}
+        self.escaped = set()
+        self.types = {}
+        self.nodes = {}  # id(node) -> node, for every node that has a type
+        self.function_types = {}
+        self.opaque = False  # set when a run statement could do anything to globals
+        self.changed = False
+
+        global_table = analyzer.global_symbol_table
+        self.global_names = set(global_table.global_vars)
+        self.shared_globals = set()
+        if analyzer.assignments_rebind_outer:
+            # assignments in functions may change globals of the same name
+            for table in analyzer.tables.values():
+                self.shared_globals |= table.local_vars & self.global_names
+
+    def infer_program(self):
+        while True:
+            self.changed = False
+            self.types = {}
+            self.nodes = {}
+            env = Env(self.analyzer.global_symbol_table)
+            self.infer_body(self.stmts, env)
+            if not self.changed:
+                return self
+
+    def type_of(self, node):
+        return self.types.get(id(node))
+
+    # lattice
+
+    def join(self, a, b):
+        if a is None or a is b or a == b:
+            return b
+        if b is None:
+            return a
+        self.escape(a)
+        self.escape(b)
+        return object
+
+    def escape(self, t):
+        """Calls of t may now happen where we can't see them"""
+        if isinstance(t, FunctionType) and id(t.node) not in self.escaped:
+            self.escaped.add(id(t.node))
+            self.changed = True
+
+    def join_summary(self, key, t):
+        old = self.summaries.get(key)
+        new = self.join(old, t)
+        if new is not old and new != old:
+            self.summaries[key] = new
+            self.changed = True
+
+    def record(self, node, t):
+        self.nodes[id(node)] = node
+        self.types[id(node)] = self.join(self.types.get(id(node)), t)
+        return t
+
+    def function_type(self, node):
+        if id(node) not in self.function_types:
+            self.function_types[id(node)] = FunctionType(node)
+        return self.function_types[id(node)]
+
+    # variables
+
+    def owner(self, name, table):
+        if name in table.local_vars or name in table.cell_vars:
+            return table
+        if name in table.free_vars:
+            return table.free_vars[name]
+        return self.analyzer.global_symbol_table
+
+    def is_tracked(self, name, env):
+        table = env.symbol_table
+        if env.is_class or name in table.cell_vars or name in self.shared_globals:
+            return False
+        if table is self.analyzer.global_symbol_table:
+            return not self.opaque
+        return name in table.local_vars
+
+    def read_var(self, name, env):
+        if self.is_tracked(name, env) and name in env.vars:
+            return env.vars[name]
+        owner = self.owner(name, env.symbol_table)
+        if owner is self.analyzer.global_symbol_table:
+            if self.opaque:
+                return object
+            if name not in self.global_names or (owner, name) not in self.summaries:
+                if name in builtin_return_types:
+                    return BuiltinType(name)
+        if (owner, name) in self.summaries:
+            return self.summaries[(owner, name)]
+        return object if self.opaque else None
+
+    def write_var(self, name, t, env):
+        if env.is_class:
+            self.escape(t)  # class namespaces are read through props
+        if self.is_tracked(name, env):
+            env.vars[name] = t
+        owner = self.owner(name, env.symbol_table)
+        self.join_summary((owner, name), t)
+
+    # statements
+
+    def infer_body(self, stmts, env):
+        for stmt in stmts:
+            self.infer_stmt(stmt, env)
+
+    def infer_stmt(self, stmt, env):
+        if isinstance(stmt, (BinaryOp, UnaryOp, Token, Call, PropAccess, Function)):
+            self.infer(stmt, env)
+        elif isinstance(stmt, Assignment):
+            t = self.infer(stmt.rhs, env)
+            if isinstance(stmt.lhs, PropAccess):
+                self.infer(stmt.lhs.left, env)
+                self.escape(t)
+            else:
+                self.write_var(stmt.lhs.content, t, env)
+            self.record(stmt, t)
+        elif isinstance(stmt, If):
+            self.infer(stmt.condition, env)
+            then_env, else_env = env.copy(), env.copy()
+            self.infer_body(stmt.body, then_env)
+            self.infer_body(stmt.else_body, else_env)
+            env.vars = self.join_vars(then_env.vars, else_env.vars)
+        elif isinstance(stmt, While):
+            while True:
+                before = dict(env.vars)
+                self.infer(stmt.condition, env)
+                body_env = env.copy()
+                self.infer_body(stmt.body, body_env)
+                env.vars = self.join_vars(before, body_env.vars)
+                if env.vars == before:
+                    break
+        elif isinstance(stmt, Return):
+            t = NoneType if stmt.expression is None else self.infer(stmt.expression, env)
+            if env.function is not None:
+                self.join_summary(('return', id(env.function)), t)
+        elif isinstance(stmt, Class):
+            if stmt.extends:
+                self.infer(stmt.extends, env)
+            class_env = Env(self.analyzer[stmt], is_class=True)
+            self.infer_body(stmt.body, class_env)
+            self.write_var(stmt.name.content, object, env)
+        elif isinstance(stmt, (Run, Compile)):
+            if not self.opaque:
+                self.opaque = True
+                self.changed = True
+                for t in self.function_types.values():
+                    self.escape(t)
+
+    def join_vars(self, a, b):
+        # a variable set on only one path could hold anything left over from before
+        return {name: self.join(a[name], b[name]) if name in a and name in b else object
+                for name in set(a) | set(b)}
+
+    # expressions
+
+    def infer(self, node, env):
+        return self.record(node, self.infer_expression(node, env))
+
+    def infer_expression(self, node, env):
+        if isinstance(node, Token):
+            if node.kind == 'Number': return int
+            elif node.kind == 'String': return str
+            elif node.kind == 'Variable': return self.read_var(node.content, env)
+            return object
+        elif isinstance(node, BinaryOp):
+            left_type = self.infer(node.left, env)
+            right_type = self.infer(node.right, env)
+            if left_type is None or right_type is None:
+                return None
+            return signatures.get((node.op.kind, left_type, right_type), object)
+        elif isinstance(node, UnaryOp):
+            expression_type = self.infer(node.right, env)
+            if expression_type is None:
+                return None
+            return signatures.get((node.op.kind, expression_type), object)
+        elif isinstance(node, Function):
+            self.infer_function(node)
+            return self.function_type(node)
+        elif isinstance(node, Call):
+            return self.infer_call(node, env)
+        elif isinstance(node, PropAccess):
+            self.infer(node.left, env)
+            return object
+        return object
+
+    def infer_function(self, node):
+        env = Env(self.analyzer[node], function=node)
+        for i, param in enumerate(node.params):
+            t = object if id(node) in self.escaped or self.opaque else self.summaries.get(('param', id(node), i))
+            self.write_var(param.content, t, env)
+        self.infer_body(node.body, env)
+        if not always_returns(node.body):
+            self.join_summary(('return', id(node)), NoneType)
+
+    def infer_call(self, node, env):
+        callee_type = self.infer(node.callable, env)
+        arg_types = [self.infer(arg, env) for arg in node.arguments]
+        if callee_type is None:
+            return None
+        elif isinstance(callee_type, FunctionType):
+            fn = callee_type.node
+            if len(arg_types) != len(fn.params):
+                return object  # an error at runtime
+            for i, t in enumerate(arg_types):
+                self.join_summary(('param', id(fn), i), t)
+            return self.summaries.get(('return', id(fn)))
+        elif isinstance(callee_type, BuiltinType) and len(arg_types) == 1:
+            if arg_types[0] is None:
+                return None
+            return builtin_return_types[callee_type.name](arg_types[0])
+        for t in arg_types:
+            self.escape(t)
+        return object
+
+def always_returns(stmts):
+    if not stmts:
+        return False
+    last = stmts[-1]
+    if isinstance(last, If):
+        return always_returns(last.body) and always_returns(last.else_body)
+    return isinstance(last, Return)
+
+def infer_types(stmts, analyzer=None):
+    """
+    >>> from tokens import tokenize
+    >>> stmts = parse(tokenize('inc = (x) => return x + 1; end; a = inc(2); a = "s"; b = a;'))
+    >>> types = infer_types(stmts)
+    >>> types.type_of(stmts[1].rhs), types.type_of(stmts[3].rhs)
+    (<class 'int'>, <class 'str'>)
+    """
+    if analyzer is None:
+        analyzer = ScopeAnalyzer()
+        analyzer.discover_symbols(stmts)
+    return TypeInferrer(stmts, analyzer).infer_program()
+
 def type_infer(node):
-    if isinstance(node, Token):
-        if node.kind == 'Number': return int
-    elif isinstance(node, BinaryOp):
-        left_type = type_infer(node.left)
-        right_type = type_infer(node.right)
-        result_type = signatures[(node.op.kind, left_type, right_type)]
-        return result_type
-    elif isinstance(node, UnaryOp):
-        expression_type = type_infer(node.right)
-        result_type = signatures[(node.op.kind, expression_type)]
-        return result_type
-
-def type_infer_program(stmts, source):
+    return infer_types([node]).type_of(node)
+
+def type_infer_program(stmts, source, spans=None):
+    types = infer_types(stmts)
+    def text(node):
+        span = start_end(node, spans)
+        return source[span[0]:span[1]] if span else type(node).__name__
+
     for stmt in stmts:
-        start, end = start_end(stmt)
-        if isinstance(stmt, (BinaryOp, UnaryOp, Token)):
-            inferred_type = type_infer(stmt)
-            print(source[start:end], '<------ inferred type: ', inferred_type)
-        elif isinstance(stmt, Assignment):
-            inferred_type = type_infer(stmt.expression)
-            print(source[start:end], '<------ inferred type of expression: ', inferred_type)
+        if isinstance(stmt, (BinaryOp, UnaryOp, Token, Call)):
+            print(text(stmt), '<------ inferred type: ', types.type_of(stmt))
+        elif isinstance(stmt, Assignment) and isinstance(stmt.lhs, Token):
+            print(stmt.lhs.content, '=', text(stmt.rhs), '<------ inferred type of expression: ', types.type_of(stmt.rhs))